@@ -1,11 +1,86 @@
 import os
 import sys
+from typing import Optional
 from dotenv import load_dotenv
 from fastapi import FastAPI
 from llama_cpp.server.app import create_app
+from llama_cpp.server.model import LlamaProxy
 from llama_cpp.server.settings import ModelSettings, ServerSettings
 import uvicorn
 
+from admission import (
+    AdmissionController,
+    install_admission_control,
+    read_admission_settings,
+)
+from batching import (
+    create_batch_scheduler,
+    install_batch_scheduler,
+    read_batching_settings,
+)
+from cpu_tuning import autotune_threads, read_autotune_settings
+from embeddings import install_embeddings, read_embedding_settings
+from fast_stream import install_fast_stream, read_fast_stream_settings
+from kv_cache import (
+    KV_CACHE_TYPES,
+    ContextWindow,
+    install_context_window,
+    read_context_window_settings,
+    read_kv_cache_settings,
+)
+from metrics import (
+    ServerMetrics,
+    install_metrics,
+    make_prompt_token_counter,
+    read_metrics_enabled,
+)
+from model_registry import (
+    create_model_registry,
+    estimate_kv_cache_bytes,
+    install_model_registry,
+    read_model_registry_settings,
+)
+from prefix_cache import (
+    PrefixKVCache,
+    install_prefix_cache,
+    read_prefix_cache_settings,
+)
+from profiling import install_profiling, read_profile_mode, read_profiling_settings
+from replicas import (
+    create_replica_pool,
+    install_replica_pool,
+    read_replica_count,
+    replica_model_settings,
+    split_threads,
+)
+from response_cache import (
+    ResponseCache,
+    install_response_cache,
+    read_response_cache_settings,
+)
+from schema_grammar import install_grammar_cache, read_grammar_settings
+from server_hooks import get_default_llama_proxy
+from sessions import SessionStore, install_sessions, read_session_settings
+from speculative import (
+    PROMPT_LOOKUP,
+    install_speculative_decoding,
+    read_speculative_settings,
+)
+from startup import (
+    StartupApp,
+    prefetch_model_file,
+    read_startup_settings,
+    start_in_background,
+    warmup_llama,
+)
+from supervisor import (
+    install_worker_stats,
+    read_worker_count,
+    read_worker_settings,
+    run_supervisor,
+)
+from token_router import install_token_router, read_router_settings
+
 def validate_environment():
     """Проверяет и валидирует переменные окружения"""
     load_dotenv()
@@ -29,17 +104,52 @@ def validate_environment():
     if n_threads <= 0:
         raise ValueError("N_THREADS должен быть положительным числом")
     
+    # Режим профилирования проверяется вместе с основными параметрами
+    read_profile_mode()
+    
     return model_path, n_ctx, n_threads
 
-def create_model_settings(model_path: str, n_ctx: int, n_threads: int) -> ModelSettings:
+def create_model_settings(
+    model_path: str,
+    n_ctx: int,
+    n_threads: int,
+    use_mlock: bool = False,
+    n_threads_batch: Optional[int] = None,
+    n_batch: int = 512,
+    draft_model: Optional[str] = None,
+    draft_tokens: int = 10,
+    embedding: bool = False,
+    kv_cache_type: str = "f16",
+    flash_attn: bool = False,
+) -> ModelSettings:
     """Создает настройки модели с обработкой ошибок"""
+    # Без явного значения llama_cpp использует для prefill все CPU
+    thread_settings = {"n_threads": n_threads}
+    if n_threads_batch is not None:
+        thread_settings["n_threads_batch"] = n_threads_batch
+    # Квантованный KV-кэш уменьшает память на токен контекста
+    if kv_cache_type != "f16":
+        thread_settings["type_k"] = KV_CACHE_TYPES[kv_cache_type]
+        thread_settings["type_v"] = KV_CACHE_TYPES[kv_cache_type]
+    if flash_attn:
+        thread_settings["flash_attn"] = True
+    # Модели эмбеддингов вычисляют каждый вход целиком в одном ubatch
+    if embedding:
+        thread_settings["embedding"] = True
+        thread_settings["n_ubatch"] = n_batch
+    # С draft_model llama_cpp сохраняет логиты всех позиций для проверки черновика
+    if draft_model is not None:
+        thread_settings["draft_model"] = draft_model
+        thread_settings["draft_model_num_pred_tokens"] = draft_tokens
     try:
         # Сначала пробуем с chat_format
         model_settings = ModelSettings(
             model=model_path,
             n_ctx=n_ctx,
-            n_threads=n_threads,
-            n_batch=512,
+            **thread_settings,
+            n_batch=n_batch,
+            use_mmap=True,
+            use_mlock=use_mlock,
             chat_format="chatml",
             verbose=False
         )
@@ -52,8 +162,10 @@ def create_model_settings(model_path: str, n_ctx: int, n_threads: int) -> ModelS
             model_settings = ModelSettings(
                 model=model_path,
                 n_ctx=n_ctx,
-                n_threads=n_threads,
-                n_batch=512,
+                **thread_settings,
+                n_batch=n_batch,
+                use_mmap=True,
+                use_mlock=use_mlock,
                 verbose=False
             )
             print("Настройки модели созданы без chat_format")
@@ -70,46 +182,282 @@ def create_server_settings() -> ServerSettings:
         disable_ping_events=False
     )
 
-def main():
-    """Основная функция приложения"""
+def main(startup: Optional[StartupApp] = None):
+    """Основная функция приложения
+
+    startup получает отметки фаз старта; без него фазы только выводятся.
+    """
+    startup = startup or StartupApp()
     try:
         # Валидация окружения
         model_path, n_ctx, n_threads = validate_environment()
         print(f"Загрузка модели: {model_path}")
         print(f"Параметры: n_ctx={n_ctx}, n_threads={n_threads}")
         
+        # Автоподбор потоков и размера батча под CPU хоста
+        tuning = {"n_threads": n_threads, "n_threads_batch": None, "n_batch": 512}
+        autotune_settings = read_autotune_settings()
+        if autotune_settings is not None:
+            with startup.track_phase("autotune"):
+                tuning = autotune_threads(model_path, **autotune_settings)
+            n_threads = tuning["n_threads"]
+        
+        # Число реплик модели и доли потоков для каждой из них
+        replicas = read_replica_count(n_threads)
+        thread_slices = split_threads(n_threads, replicas)
+        batching, batch_slots = read_batching_settings()
+        prefix_cache_settings = read_prefix_cache_settings()
+        response_cache_settings = read_response_cache_settings()
+        fast_stream_settings = read_fast_stream_settings()
+        speculative_settings = read_speculative_settings()
+        session_settings = read_session_settings()
+        embedding_settings = read_embedding_settings()
+        profiling_settings = read_profiling_settings()
+        grammar_settings = read_grammar_settings()
+        kv_cache_settings = read_kv_cache_settings()
+        context_window_settings = read_context_window_settings()
+        worker_settings = read_worker_settings()
+        if worker_settings is not None:
+            # Файлы кэшей принадлежат одному процессу, у каждого рабочего свой каталог
+            worker_dir = f"worker-{worker_settings['index']}"
+            if prefix_cache_settings is not None and prefix_cache_settings["disk_dir"]:
+                prefix_cache_settings["disk_dir"] = os.path.join(prefix_cache_settings["disk_dir"], worker_dir)
+            if session_settings is not None:
+                session_settings["directory"] = os.path.join(session_settings["directory"], worker_dir)
+            if profiling_settings is not None:
+                profiling_settings["directory"] = os.path.join(profiling_settings["directory"], worker_dir)
+        metrics_enabled = read_metrics_enabled()
+        registry_settings = read_model_registry_settings()
+        if registry_settings is not None and (replicas > 1 or batching):
+            raise ValueError("MODELS_CONFIG нельзя совмещать с REPLICAS > 1 и BATCHING")
+        # Сессии и черновые модели подключаются только к основной модели
+        if registry_settings is not None and (
+            session_settings is not None or speculative_settings is not None
+        ):
+            raise ValueError("MODELS_CONFIG нельзя совмещать с SESSIONS и спекулятивным декодированием")
+        admission_settings = read_admission_settings(
+            replicas * (batch_slots if batching else 1)
+        )
+        router_settings = read_router_settings(replicas * (batch_slots if batching else 1))
+        startup_settings = read_startup_settings()
+        
+        if startup_settings["prefetch"]:
+            with startup.track_phase("prefetch"):
+                n_bytes = prefetch_model_file(model_path)
+                print(f"Файл модели прочитан в page cache: {n_bytes // (1024 * 1024)} МБ")
+        
+        draft_settings = {}
+        if speculative_settings is not None:
+            draft_settings = {
+                "draft_model": speculative_settings["draft_model_path"] or PROMPT_LOOKUP,
+                "draft_tokens": speculative_settings["draft_tokens"],
+            }
+        
         # Создание настроек модели
-        model_settings = create_model_settings(model_path, n_ctx, n_threads)
+        model_settings = create_model_settings(
+            model_path,
+            n_ctx,
+            thread_slices[0],
+            use_mlock=startup_settings["use_mlock"],
+            n_threads_batch=tuning["n_threads_batch"],
+            n_batch=tuning["n_batch"],
+            **kv_cache_settings,
+            **draft_settings,
+        )
+        if replicas > 1:
+            model_settings = replica_model_settings(model_settings, thread_slices[0])
         print("Настройки модели созданы")
         
         # Создание настроек сервера
         server_settings = create_server_settings()
         print("Настройки сервера созданы")
         
-        # Создание FastAPI приложения
-        app: FastAPI = create_app(
-            server_settings=server_settings,
-            model_settings=[model_settings]  # передаем как список
-        )
+        # Создание FastAPI приложения (модель загружается через mmap)
+        with startup.track_phase("load"):
+            app: FastAPI = create_app(
+                server_settings=server_settings,
+                model_settings=[model_settings]  # передаем как список
+            )
         print("FastAPI приложение создано")
         
+        # Все загруженные экземпляры модели
+        llamas = [get_default_llama_proxy()()]
+        
+        registry = None
+        if registry_settings is not None:
+            registry = create_model_registry(model_settings, llamas[0], **registry_settings)
+            install_model_registry(app, registry, model_settings)
+            print(f"Реестр моделей создан: {list(registry)}")
+        
+        if replicas > 1:
+            with startup.track_phase("load_replicas"):
+                pool = create_replica_pool(model_settings, thread_slices)
+            install_replica_pool(app, pool)
+            llamas = [replica.proxy() for replica in pool.replicas]
+            print(f"Пул реплик создан: {replicas} реплик, потоки {thread_slices}")
+        
+        kv_bytes = sum(estimate_kv_cache_bytes(llama) for llama in llamas)
+        print(
+            f"Оценка памяти KV-кэша: {kv_bytes / (1024 * 1024):.1f} МБ "
+            f"(тип {kv_cache_settings['kv_cache_type']}, flash attention "
+            f"{'вкл' if kv_cache_settings['flash_attn'] else 'выкл'}, n_ctx={n_ctx} x {len(llamas)})"
+        )
+        
+        speculative_stats = None
+        if speculative_settings is not None:
+            with startup.track_phase("load_draft"):
+                speculative_stats = install_speculative_decoding(
+                    app, llamas, **speculative_settings
+                )
+            print(f"Спекулятивное декодирование включено: {speculative_settings}")
+        
+        # Прогрев до подключения кэшей, чтобы служебный промпт в них не попал
+        if startup_settings["warmup_prompt"]:
+            with startup.track_phase("warmup"):
+                for llama in llamas:
+                    warmup_llama(
+                        llama,
+                        startup_settings["warmup_prompt"],
+                        startup_settings["warmup_tokens"],
+                    )
+        
+        if prefix_cache_settings is not None:
+            prefix_cache = PrefixKVCache(**prefix_cache_settings)
+            install_prefix_cache(app, prefix_cache, llamas, registry)
+            print(f"Кэш префиксов KV включен: {prefix_cache_settings}")
+        
+        # Сессии подключаются поверх кэша префиксов и передают ему остальные запросы
+        if session_settings is not None:
+            session_store = SessionStore(**session_settings)
+            install_sessions(app, session_store, llamas)
+            print(f"Сессии KV включены: {session_settings}, сохранено сессий: {session_store.stats()['sessions']}")
+        
+        # Схема заменяется грамматикой во внутреннем middleware: очереди и кэш
+        # ответов видят исходное тело запроса
+        grammar_cache = None
+        if grammar_settings is not None:
+            grammar_cache = install_grammar_cache(app, **grammar_settings)
+            print(f"Кэш грамматик JSON-схем включен: {grammar_settings}")
+        
+        # Контроль допуска подключается раньше кэша ответов, чтобы
+        # попадания в кэш отдавались без ожидания в очереди
+        if admission_settings is not None:
+            admission = AdmissionController(**admission_settings)
+            install_admission_control(app, admission)
+            print(f"Контроль допуска включен: {admission_settings}")
+        
+        # Маршрутизатор снаружи контроля допуска: в очередь допуска запросы
+        # попадают уже в порядке полос
+        token_router = None
+        if router_settings is not None:
+            token_router = install_token_router(app, llamas[0], **router_settings)
+            print(f"Маршрутизатор по стоимости в токенах включен: {router_settings}")
+        
+        if response_cache_settings is not None:
+            response_cache = ResponseCache(**response_cache_settings)
+            install_response_cache(app, response_cache, model_settings.chat_format)
+            print(f"Кэш ответов для temperature=0 включен: {response_cache_settings}")
+        
+        # Маршруты планировщика батчей подключаются позже и перекрывают эти
+        if fast_stream_settings is not None:
+            install_fast_stream(app, **fast_stream_settings)
+            print(f"Облегченная отдача потоков включена: {fast_stream_settings}")
+        
+        scheduler = None
+        if batching:
+            scheduler = create_batch_scheduler(batch_slots, n_ctx)
+            install_batch_scheduler(app, scheduler)
+            print(f"Непрерывный батчинг включен: {batch_slots} слотов по {n_ctx} токенов")
+            print(f"KV-кэш планировщика: еще {estimate_kv_cache_bytes(scheduler.llama) * batch_slots / (1024 * 1024):.1f} МБ")
+        
+        # Окно подключается после прогрева и после создания планировщика
+        if context_window_settings is not None:
+            install_context_window(
+                app, llamas, ContextWindow(**context_window_settings), scheduler, registry
+            )
+            print(f"Скользящее окно контекста включено: {context_window_settings}")
+        
+        # Пулинг задается в собственном контексте эмбеддингов, а не в ModelSettings
+        if embedding_settings is not None:
+            embedding_llama = llamas[0]
+            if embedding_settings["model_path"] is not None:
+                with startup.track_phase("load_embeddings"):
+                    embedding_llama = LlamaProxy.load_llama_from_model_settings(
+                        create_model_settings(
+                            embedding_settings["model_path"],
+                            embedding_settings["batch_tokens"],
+                            thread_slices[0],
+                            n_threads_batch=tuning["n_threads_batch"],
+                            n_batch=embedding_settings["batch_tokens"],
+                            embedding=True,
+                        )
+                    )
+            batcher = install_embeddings(
+                app,
+                embedding_llama,
+                embedding_settings["pooling"],
+                embedding_settings["batch_tokens"],
+                embedding_settings["max_wait_ms"],
+                embedding_settings["cache_bytes"],
+            )
+            print(f"Быстрый путь эмбеддингов включен: {embedding_settings}, пулинг {batcher.pooling}")
+        
+        if worker_settings is not None:
+            install_worker_stats(app, **worker_settings)
+            print(f"Рабочий процесс {worker_settings['index']}: статистика по адресу /extras/workers")
+        
+        if profiling_settings is not None:
+            install_profiling(app, llamas, **profiling_settings, registry=registry)
+            print(f"Профилирование запросов включено: {profiling_settings}, самые медленные - /extras/profiles")
+        
+        # Метрики подключаются последними, чтобы видеть очередь и кэш ответов
+        if metrics_enabled:
+            metrics = ServerMetrics()
+            if speculative_stats is not None:
+                metrics.register(speculative_stats)
+            if token_router is not None:
+                metrics.register(token_router)
+            if grammar_cache is not None:
+                metrics.register(grammar_cache)
+            install_metrics(app, metrics, make_prompt_token_counter(llamas[0]))
+            print("Метрики доступны по адресу /metrics")
+        
         return app
         
     except Exception as e:
         print(f"Ошибка при инициализации приложения: {e}")
         sys.exit(1)
 
+def run_server(sockets=None) -> int:
+    """Запускает uvicorn; порт открывается сразу, модель загружается в фоне
+
+    sockets - уже созданные сокеты рабочего процесса супервизора.
+    """
+    startup = StartupApp()
+    server = uvicorn.Server(
+        uvicorn.Config(
+            startup,
+            host="0.0.0.0",
+            port=12000,
+            reload=False,
+            access_log=True
+        )
+    )
+    start_in_background(
+        startup, main, on_failure=lambda: setattr(server, "should_exit", True)
+    )
+    # Запуск сервера
+    server.run(sockets=sockets)
+    return 1 if startup.failed else 0
+
 # Создаем приложение только если модуль запускается напрямую
 if __name__ == "__main__":
-    app = main()
-    # Запуск сервера
-    uvicorn.run(
-        app,
-        host="0.0.0.0",
-        port=12000,
-        reload=False,
-        access_log=True
-    )
+    # Готовность сообщается через /health/ready
+    load_dotenv()
+    workers = read_worker_count()
+    if workers > 1:
+        sys.exit(run_supervisor(workers, "0.0.0.0", 12000, run_server))
+    sys.exit(run_server())
 else:
     # Для импорта из других модулей создаем приложение только при необходимости
     app = None
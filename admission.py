@@ -0,0 +1,241 @@
+"""
+Контроль допуска запросов: ограничение одновременных запросов, очередь
+с приоритетами и ранний отказ 429/503 при перегрузке
+"""
+
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import Optional
+
+from fastapi import APIRouter, FastAPI
+from fastapi.responses import JSONResponse
+
+from env_settings import read_bool, read_float, read_int
+
+# Пути, которые занимают модель и поэтому проходят через очередь
+ADMISSION_PATHS = {
+    "/v1/completions",
+    "/v1/chat/completions",
+    "/v1/embeddings",
+    "/v1/engines/copilot-codex/completions",
+}
+
+PRIORITY_HEADER = b"x-priority"
+
+# Меньшее значение - более высокий приоритет
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+
+def read_admission_settings(default_max_in_flight: int) -> Optional[dict]:
+    """Читает настройки ADMISSION_*; возвращает None, если контроль выключен"""
+    if not read_bool("ADMISSION"):
+        return None
+    return {
+        "max_in_flight": read_int("ADMISSION_MAX_IN_FLIGHT", default_max_in_flight),
+        "max_queue": read_int("ADMISSION_MAX_QUEUE", 64, minimum=0),
+        "queue_timeout": read_float("ADMISSION_QUEUE_TIMEOUT", 30.0),
+    }
+
+
+class AdmissionRejected(Exception):
+    """Запрос отклонен контролем допуска"""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+class AdmissionController:
+    """Семафор с ограниченной приоритетной очередью ожидания
+
+    Освободившийся слот передается ожидающему запросу с наивысшим
+    приоритетом (внутри приоритета - в порядке поступления). Если очередь
+    заполнена, новый запрос получает 429, либо, если его приоритет выше,
+    из очереди вытесняется самый поздний запрос с наименьшим приоритетом.
+    Запрос, не дождавшийся слота за queue_timeout секунд, получает 503.
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int, queue_timeout: float):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self._waiters: list = []
+        self._counter = itertools.count()
+
+        self.admitted = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.shed_for_priority = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.service_time_total = 0.0
+        self.completed = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def retry_after(self) -> int:
+        """Оценка в секундах, через сколько очередь продвинется"""
+        if self.completed == 0:
+            return 1
+        avg_service = self.service_time_total / self.completed
+        return max(1, math.ceil(avg_service * (self.queued + 1) / self.max_in_flight))
+
+    def _remove_waiter(self, entry):
+        self._waiters.remove(entry)
+        heapq.heapify(self._waiters)
+
+    async def acquire(self, priority: int) -> float:
+        """Ждет свободный слот и возвращает время ожидания в очереди"""
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return 0.0
+
+        if self.queued >= self.max_queue:
+            worst = max(self._waiters, default=None)
+            if worst is None or worst[0] <= priority:
+                self.rejected_queue_full += 1
+                raise AdmissionRejected(429, "Server is overloaded, queue is full")
+            self._remove_waiter(worst)
+            self.shed_for_priority += 1
+            worst[2].set_exception(
+                AdmissionRejected(503, "Request was shed for higher priority traffic")
+            )
+
+        started = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._counter), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if entry in self._waiters:
+                self._remove_waiter(entry)
+            elif future.done() and not future.cancelled() and future.exception() is None:
+                # Слот уже был передан этому запросу - возвращаем его
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                self.rejected_timeout += 1
+                raise AdmissionRejected(503, "Request timed out waiting in queue")
+            raise
+
+        wait = time.perf_counter() - started
+        self.admitted += 1
+        self.queue_wait_total += wait
+        self.queue_wait_max = max(self.queue_wait_max, wait)
+        return wait
+
+    def release(self):
+        """Передает слот следующему ожидающему или освобождает его"""
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def record_service_time(self, seconds: float):
+        self.completed += 1
+        self.service_time_total += seconds
+
+    def stats(self) -> dict:
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "queue_timeout": self.queue_timeout,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "shed_for_priority": self.shed_for_priority,
+            "avg_queue_wait_seconds": round(
+                self.queue_wait_total / max(self.admitted, 1), 4
+            ),
+            "max_queue_wait_seconds": round(self.queue_wait_max, 4),
+            "avg_service_seconds": round(
+                self.service_time_total / max(self.completed, 1), 4
+            ),
+            "completed": self.completed,
+        }
+
+
+def request_priority(scope) -> int:
+    for name, value in scope["headers"]:
+        if name == PRIORITY_HEADER:
+            return PRIORITIES.get(value.decode("latin-1").strip().lower(), 0)
+    return PRIORITIES["interactive"]
+
+
+class AdmissionMiddleware:
+    """ASGI middleware, пропускающее запросы к модели через AdmissionController
+
+    Время ожидания в очереди кладется в scope["state"]["queue_wait"] и
+    возвращается клиенту в заголовке X-Queue-Wait-Ms, отдельно от времени
+    генерации. Слот удерживается до конца ответа, включая потоковый.
+    """
+
+    def __init__(self, app, controller: AdmissionController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in ADMISSION_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            wait = await self.controller.acquire(request_priority(scope))
+        except AdmissionRejected as e:
+            response = JSONResponse(
+                status_code=e.status_code,
+                content={
+                    "error": {
+                        "message": e.message,
+                        "type": "server_overloaded",
+                        "code": e.status_code,
+                    }
+                },
+                headers={"Retry-After": str(self.controller.retry_after())},
+            )
+            await response(scope, receive, send)
+            return
+
+        state = scope.setdefault("state", {})
+        state["queue_wait"] = state.get("queue_wait", 0.0) + wait
+        wait_header = f"{wait * 1000:.1f}".encode("latin-1")
+
+        async def send_with_wait(message):
+            if message["type"] == "http.response.start":
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-queue-wait-ms", wait_header)
+                ]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_wait)
+        finally:
+            self.controller.record_service_time(time.perf_counter() - started)
+            self.controller.release()
+
+
+def install_admission_control(app: FastAPI, controller: AdmissionController):
+    """Подключает контроль допуска к приложению и добавляет маршрут статистики"""
+    app.add_middleware(AdmissionMiddleware, controller=controller)
+
+    router = APIRouter()
+
+    @router.get("/extras/admission", summary="Admission stats", tags=["Extras"])
+    async def get_admission_stats():
+        return controller.stats()
+
+    app.include_router(router)
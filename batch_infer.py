@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Пакетная генерация по JSONL-файлу без HTTP-сервера
+
+Каждая строка входного файла - тело запроса completions ({"prompt": ...})
+или chat ({"messages": [...]}) с необязательным полем "id". Планировщик
+получает новые строки по мере завершения старых, результаты пишутся в
+выходной JSONL в порядке входного файла; после каждого окна записанных
+строк сохраняется контрольная точка, с которой обработка продолжается
+после сбоя.
+
+Пример:
+    python batch_infer.py prompts.jsonl results.jsonl --slots 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from llama_cpp.server.model import LlamaProxy
+from llama_cpp.server.types import CreateChatCompletionRequest, CreateCompletionRequest
+from pydantic import ValidationError
+
+from batching import (
+    BatchScheduler,
+    BatchSequence,
+    build_sampler,
+    chat_supported,
+    completion_supported,
+    read_batching_settings,
+    sampling_kwargs,
+    stop_list,
+)
+from chat_prompt import render_chat_prompt
+from Main import create_model_settings, validate_environment
+
+
+def read_checkpoint(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_checkpoint(path: str, checkpoint: dict):
+    """Атомарно сохраняет контрольную точку"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def resume_checkpoint(checkpoint_path: str, output_path: str) -> dict:
+    """Контрольная точка для продолжения или новая, если продолжить нельзя
+
+    Если выходной файл удален или короче сохраненного смещения, записанные
+    результаты потеряны, и обработка начинается с начала входного файла.
+    """
+    checkpoint = read_checkpoint(checkpoint_path)
+    if checkpoint is not None and checkpoint["output_offset"]:
+        output_size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+        if output_size < checkpoint["output_offset"]:
+            print(
+                f"Выходной файл {output_path} не соответствует контрольной точке, "
+                "обработка начинается заново"
+            )
+            checkpoint = None
+    return checkpoint or {"input_offset": 0, "output_offset": 0, "lines": 0}
+
+
+# Контекст загружаемой модели: планировщик создает собственный, а от
+# модели нужны только веса и токенизатор. Не меньше n_batch по умолчанию,
+# так как llama_cpp ограничивает n_batch размером контекста
+WEIGHTS_ONLY_N_CTX = 512
+
+
+def read_window(f, size: int) -> List[Tuple[bytes, int]]:
+    """Читает до size непустых строк со смещением после каждой, не загружая файл целиком"""
+    lines = []
+    while len(lines) < size:
+        line = f.readline()
+        if not line:
+            break
+        if line.strip():
+            lines.append((line, f.tell()))
+    return lines
+
+
+class BatchJob:
+    """Прогон JSONL-файла через BatchScheduler"""
+
+    def __init__(self, llama, scheduler: BatchScheduler, default_max_tokens: int, sort_by_length: bool):
+        self.llama = llama
+        self.scheduler = scheduler
+        self.default_max_tokens = default_max_tokens
+        self.sort_by_length = sort_by_length
+        self.completion_tokens = 0
+
+    def prepare(self, line_no: int, line: bytes) -> Tuple[dict, Optional[BatchSequence]]:
+        """Разбирает строку и создает последовательность; при ошибке возвращает запись с error"""
+        result = {"line": line_no}
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError("Each line must be a JSON object")
+            result["id"] = record.pop("id", None)
+            record.setdefault("max_tokens", self.default_max_tokens)
+            record["stream"] = False
+
+            if "messages" in record:
+                body = CreateChatCompletionRequest.model_validate(record)
+                rendered = render_chat_prompt(self.llama, body.messages) if chat_supported(body) else None
+                if rendered is None:
+                    raise ValueError("Unsupported chat request parameters or chat_format")
+                prompt_tokens, format_stop = rendered
+                stop = stop_list(body.stop) + format_stop
+            else:
+                body = CreateCompletionRequest.model_validate(record)
+                if isinstance(body.prompt, list):
+                    if len(body.prompt) > 1:
+                        raise ValueError("Only a single prompt per line is supported")
+                    body.prompt = body.prompt[0] if body.prompt else ""
+                if not completion_supported(body):
+                    raise ValueError("Unsupported completion request parameters")
+                prompt_tokens = self.llama.tokenize(body.prompt.encode("utf-8"), True, True)
+                stop = stop_list(body.stop)
+
+            sequence = BatchSequence(
+                prompt_tokens,
+                build_sampler(self.llama, **sampling_kwargs(body)),
+                body.max_tokens if body.max_tokens is not None else self.scheduler.slot_ctx,
+                stop,
+            )
+            return result, sequence
+        except (ValueError, ValidationError) as e:
+            result["error"] = str(e)
+            return result, None
+
+    async def collect(self, result: dict, sequence: BatchSequence) -> dict:
+        try:
+            pieces = [piece async for piece in sequence.stream()]
+        except Exception as e:
+            result["error"] = str(e)
+            return result
+        result["text"] = "".join(pieces)
+        result["finish_reason"] = sequence.finish_reason
+        result["usage"] = {
+            "prompt_tokens": sequence.n_prompt,
+            "completion_tokens": sequence.completion_tokens,
+            "total_tokens": sequence.n_prompt + sequence.completion_tokens,
+        }
+        self.completion_tokens += sequence.completion_tokens
+        return result
+
+    def feed(self, lines: List[Tuple[int, bytes]]) -> List[Tuple[int, dict, Optional[asyncio.Task]]]:
+        """Ставит строки в планировщик; задача None - строка уже завершилась ошибкой"""
+        prepared = [(line_no, *self.prepare(line_no, line)) for line_no, line in lines]
+
+        # Похожие по длине промпты попадают в планировщик вместе, поэтому
+        # слоты освобождаются и заполняются равномерно
+        order = [item for item in prepared if item[2] is not None]
+        if self.sort_by_length:
+            order.sort(key=lambda item: item[2].n_prompt)
+
+        tasks = {}
+        for line_no, result, sequence in order:
+            try:
+                self.scheduler.submit(sequence)
+            except ValueError as e:
+                sequence.sampler.close()
+                result["error"] = str(e)
+                continue
+            tasks[line_no] = asyncio.ensure_future(self.collect(result, sequence))
+        return [(line_no, result, tasks.get(line_no)) for line_no, result, _ in prepared]
+
+
+async def run_pipeline(
+    job,
+    input_file,
+    output_file,
+    first_line: int,
+    window: int,
+    on_checkpoint: Callable[[int, int, int], None],
+) -> int:
+    """Прогоняет входной файл, не давая планировщику простаивать
+
+    В обработке держится до window строк; когда их остается половина,
+    читаются следующие. Результаты пишутся непрерывным префиксом в порядке
+    входного файла, и после каждых window записанных строк (и в конце)
+    вызывается on_checkpoint(смещение входа, смещение выхода, число строк).
+    Возвращает число обработанных строк.
+    """
+    in_flight: Dict[asyncio.Task, int] = {}
+    finished: Dict[int, dict] = {}
+    offsets: Dict[int, int] = {}
+    next_line = written = checkpointed = first_line
+    input_offset = input_file.tell()
+    exhausted = False
+
+    while True:
+        if not exhausted and len(in_flight) <= window // 2:
+            batch = []
+            for line, offset in read_window(input_file, window - len(in_flight)):
+                offsets[next_line] = offset
+                batch.append((next_line, line))
+                next_line += 1
+            exhausted = not batch
+            for line_no, result, task in job.feed(batch):
+                if task is None:
+                    finished[line_no] = result
+                else:
+                    in_flight[task] = line_no
+
+        while written in finished:
+            result = finished.pop(written)
+            output_file.write(json.dumps(result, ensure_ascii=False).encode("utf-8") + b"\n")
+            input_offset = offsets.pop(written)
+            written += 1
+
+        done = exhausted and not in_flight
+        if written - checkpointed >= window or (done and written > checkpointed):
+            output_file.flush()
+            os.fsync(output_file.fileno())
+            on_checkpoint(input_offset, output_file.tell(), written)
+            checkpointed = written
+        if done:
+            return written - first_line
+
+        if in_flight:
+            completed, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for task in completed:
+                finished[in_flight.pop(task)] = task.result()
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600:d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+async def run_batch(args, llama, scheduler: BatchScheduler):
+    checkpoint_path = args.checkpoint or f"{args.output}.checkpoint"
+    checkpoint = resume_checkpoint(checkpoint_path, args.output)
+    if checkpoint["lines"]:
+        print(
+            f"Продолжение с контрольной точки: {checkpoint['lines']} строк уже обработано"
+        )
+
+    job = BatchJob(llama, scheduler, args.max_tokens, not args.no_sort)
+    total_bytes = os.path.getsize(args.input)
+    started = time.perf_counter()
+    last_report = started
+
+    mode = "r+b" if checkpoint["output_offset"] else "wb"
+    with open(args.input, "rb") as input_file, open(args.output, mode) as output_file:
+        input_file.seek(checkpoint["input_offset"])
+        # Все, что записано после контрольной точки, будет сгенерировано заново
+        output_file.truncate(checkpoint["output_offset"])
+        output_file.seek(checkpoint["output_offset"])
+
+        first_line, first_offset = checkpoint["lines"], checkpoint["input_offset"]
+
+        def on_checkpoint(input_offset: int, output_offset: int, lines: int):
+            nonlocal last_report
+            write_checkpoint(
+                checkpoint_path,
+                {"input_offset": input_offset, "output_offset": output_offset, "lines": lines},
+            )
+
+            now = time.perf_counter()
+            if now - last_report >= args.report_every:
+                last_report = now
+                elapsed = now - started
+                n_done = lines - first_line
+                done_bytes = input_offset - first_offset
+                remaining = total_bytes - input_offset
+                eta = remaining / (done_bytes / elapsed) if done_bytes else 0.0
+                print(
+                    f"Обработано {lines} строк "
+                    f"({input_offset * 100 / max(total_bytes, 1):.1f}%): "
+                    f"{n_done / elapsed:.2f} запр/с, "
+                    f"{job.completion_tokens / elapsed:.1f} ток/с, "
+                    f"осталось ~{format_duration(eta)}"
+                )
+
+        done_lines = await run_pipeline(
+            job, input_file, output_file, first_line, args.window, on_checkpoint
+        )
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"Готово: {done_lines} строк за {format_duration(elapsed)}, "
+        f"{done_lines / max(elapsed, 1e-9):.2f} запр/с, "
+        f"{job.completion_tokens / max(elapsed, 1e-9):.1f} ток/с, "
+        f"средний батч {scheduler.stats()['avg_batch_tokens']} токенов"
+    )
+
+
+def main(argv=None):
+    """Точка входа пакетной генерации"""
+    _, default_slots = read_batching_settings()
+    parser = argparse.ArgumentParser(description="Пакетная генерация по JSONL без HTTP-сервера")
+    parser.add_argument("input", help="Входной JSONL с телами запросов completions/chat")
+    parser.add_argument("output", help="Выходной JSONL с результатами")
+    parser.add_argument("--checkpoint", help="Файл контрольной точки (по умолчанию OUTPUT.checkpoint)")
+    parser.add_argument("--slots", type=int, default=default_slots, help="Число одновременно декодируемых последовательностей")
+    parser.add_argument("--window", type=int, default=256, help="Строк в обработке и между контрольными точками")
+    parser.add_argument("--max-tokens", type=int, default=256, help="max_tokens для строк без этого поля")
+    parser.add_argument("--no-sort", action="store_true", help="Не группировать промпты окна по длине")
+    parser.add_argument("--report-every", type=float, default=10.0, help="Интервал вывода прогресса в секундах")
+    args = parser.parse_args(argv)
+
+    model_path, n_ctx, n_threads = validate_environment()
+    model_settings = create_model_settings(model_path, WEIGHTS_ONLY_N_CTX, n_threads)
+    print(f"Загрузка модели: {model_path}")
+    llama = LlamaProxy.load_llama_from_model_settings(model_settings)
+    scheduler = BatchScheduler(llama, args.slots, n_ctx)
+    print(f"Планировщик: {args.slots} слотов по {n_ctx} токенов")
+
+    asyncio.run(run_batch(args, llama, scheduler))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,603 @@
+"""
+Непрерывный батчинг: одновременные запросы completions/chat декодируются
+в общих батчах llama_decode, каждый в своей последовательности KV-кэша
+"""
+
+import asyncio
+import codecs
+import collections
+import json
+import threading
+import time
+import uuid
+from typing import List, Optional, Tuple
+
+import llama_cpp
+import llama_cpp._internals as internals
+import llama_cpp.server.app as llama_server_app
+from fastapi import APIRouter, Depends, FastAPI, Request
+from llama_cpp.server.errors import RouteErrorHandler
+from llama_cpp.server.types import CreateChatCompletionRequest, CreateCompletionRequest
+from sse_starlette.sse import EventSourceResponse
+from starlette.concurrency import run_in_threadpool
+
+from chat_prompt import render_chat_prompt
+from env_settings import read_bool, read_int
+from server_hooks import get_default_llama_proxy, override_routes
+
+
+def read_batching_settings() -> Tuple[bool, int]:
+    """Читает BATCHING и BATCH_SLOTS (число одновременных последовательностей)"""
+    enabled = read_bool("BATCHING")
+    slots = read_int("BATCH_SLOTS", 4)
+    return enabled, slots
+
+
+def build_sampler(
+    llama: llama_cpp.Llama,
+    *,
+    temperature: float,
+    top_k: int,
+    top_p: float,
+    min_p: float,
+    typical_p: float,
+    repeat_penalty: float,
+    frequency_penalty: float,
+    presence_penalty: float,
+    mirostat_mode: int,
+    mirostat_tau: float,
+    mirostat_eta: float,
+    seed: Optional[int] = None,
+    grammar: Optional[llama_cpp.LlamaGrammar] = None,
+) -> internals.LlamaSampler:
+    """Собирает цепочку сэмплеров так же, как Llama._init_sampler
+
+    В отличие от Llama._init_sampler, не читает общее состояние модели
+    (seed, input_ids), поэтому цепочки разных запросов независимы.
+    """
+    if seed is None:
+        seed = llama_cpp.LLAMA_DEFAULT_SEED
+
+    sampler = internals.LlamaSampler()
+    sampler.add_penalties(
+        n_vocab=llama.n_vocab(),
+        special_eos_id=llama.token_eos(),
+        linefeed_id=llama.token_nl(),
+        penalty_last_n=llama.last_n_tokens_size,
+        penalty_repeat=repeat_penalty,
+        penalty_freq=frequency_penalty,
+        penalty_present=presence_penalty,
+        penalize_nl=True,
+        ignore_eos=False,
+    )
+
+    if grammar is not None:
+        sampler.add_grammar(llama._model, grammar)
+
+    if temperature < 0.0:
+        sampler.add_softmax()
+        sampler.add_dist(seed)
+    elif temperature == 0.0:
+        sampler.add_greedy()
+    elif mirostat_mode == 1:
+        sampler.add_mirostat(llama.n_vocab(), seed, mirostat_tau, mirostat_eta, 100)
+    elif mirostat_mode == 2:
+        sampler.add_mirostat_v2(seed, mirostat_tau, mirostat_eta)
+    else:
+        sampler.add_top_k(top_k)
+        sampler.add_typical(typical_p, 1)
+        sampler.add_top_p(top_p, 1)
+        sampler.add_min_p(min_p, 1)
+        sampler.add_temp(temperature)
+        sampler.add_dist(seed)
+    return sampler
+
+
+def stop_holdback(text: str, stops: List[str]) -> int:
+    """Сколько символов в конце текста могут оказаться началом стоп-строки"""
+    holdback = 0
+    for stop in stops:
+        for size in range(min(len(stop) - 1, len(text)), holdback, -1):
+            if text.endswith(stop[:size]):
+                holdback = size
+                break
+    return holdback
+
+
+class BatchSequence:
+    """Состояние одного запроса внутри планировщика
+
+    Поток декодирования пишет в последовательность через _push()/_finish(),
+    обработчик запроса читает фрагменты текста через stream().
+    """
+
+    def __init__(
+        self,
+        prompt_tokens: List[int],
+        sampler,
+        max_tokens: int,
+        stop: List[str],
+    ):
+        self.prompt_tokens = prompt_tokens
+        self.sampler = sampler
+        self.max_tokens = max_tokens
+        self.stop = [s for s in stop if s]
+        self.pending = list(prompt_tokens)
+        self.n_past = 0
+        self.next_token: Optional[int] = None
+        self.completion_tokens = 0
+        self.finish_reason: Optional[str] = None
+        self.cancelled = False
+        self.slot: Optional[int] = None
+        self.submitted_at = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self._text = ""
+        self._sent = 0
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    @property
+    def n_prompt(self) -> int:
+        return len(self.prompt_tokens)
+
+    def _send(self, item):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def _push(self, piece: bytes):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self._text += self._decoder.decode(piece)
+
+        for stop in self.stop:
+            index = self._text.find(stop, max(0, self._sent - len(stop)))
+            if index != -1:
+                self._text = self._text[:index]
+                self._finish("stop")
+                return
+
+        end = len(self._text) - stop_holdback(self._text, self.stop)
+        if end > self._sent:
+            self._send(self._text[self._sent:end])
+            self._sent = end
+
+    def _finish(self, reason: str):
+        if len(self._text) > self._sent:
+            self._send(self._text[self._sent:])
+            self._sent = len(self._text)
+        self.finish_reason = reason
+        self._send(None)
+
+    def _fail(self, error: Exception):
+        self.finish_reason = "error"
+        self._send(error)
+
+    @property
+    def finished(self) -> bool:
+        return self.finish_reason is not None
+
+    async def stream(self):
+        """Асинхронно отдает фрагменты текста по мере их генерации"""
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            if not self.finished:
+                self.cancelled = True
+
+
+class BatchScheduler:
+    """Цикл декодирования, объединяющий все активные запросы в один батч
+
+    Планировщик создает собственный llama_context на весах уже загруженной
+    модели: n_slots последовательностей по slot_ctx токенов в общем KV-кэше.
+    На каждом шаге в батч сначала попадают токены декодирования всех
+    активных последовательностей, а оставшийся бюджет n_batch заполняется
+    кусками промптов, ожидающих prefill.
+    """
+
+    def __init__(self, llama: llama_cpp.Llama, n_slots: int, slot_ctx: int):
+        self.llama = llama
+        self.n_slots = n_slots
+        self.slot_ctx = slot_ctx
+        self.n_batch = llama.n_batch
+        # ContextWindow, укорачивающий промпты длиннее слота
+        self.context_window = None
+
+        params = llama_cpp.llama_context_params.from_buffer_copy(llama.context_params)
+        params.n_ctx = n_slots * slot_ctx
+        params.n_seq_max = n_slots
+        self._ctx = internals.LlamaContext(
+            model=llama._model, params=params, verbose=llama.verbose
+        )
+        self._batch = internals.LlamaBatch(
+            n_tokens=self.n_batch, embd=0, n_seq_max=n_slots, verbose=llama.verbose
+        )
+
+        self._slots: List[Optional[BatchSequence]] = [None] * n_slots
+        self._pending: collections.deque = collections.deque()
+        self._cond = threading.Condition()
+
+        self.requests_total = 0
+        self.decode_steps = 0
+        self.batch_tokens_total = 0
+
+        self._thread = threading.Thread(
+            target=self._run, name="batch-scheduler", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, sequence: BatchSequence):
+        if self.context_window is not None:
+            sequence.prompt_tokens = self.context_window.fit(
+                sequence.prompt_tokens, self.slot_ctx, self.llama.token_bos()
+            )
+            sequence.pending = list(sequence.prompt_tokens)
+        if sequence.n_prompt == 0:
+            raise ValueError("Prompt must contain at least one token")
+        if sequence.n_prompt >= self.slot_ctx:
+            raise ValueError(
+                f"Requested tokens ({sequence.n_prompt}) exceed context window "
+                f"of {self.slot_ctx}"
+            )
+        # Как в llama_cpp: max_tokens <= 0 - генерация до конца контекста слота
+        n_free = self.slot_ctx - sequence.n_prompt
+        if sequence.max_tokens <= 0:
+            sequence.max_tokens = n_free
+        else:
+            sequence.max_tokens = min(sequence.max_tokens, n_free)
+        with self._cond:
+            self._pending.append(sequence)
+            self.requests_total += 1
+            self._cond.notify()
+
+    def _active(self) -> List[BatchSequence]:
+        return [seq for seq in self._slots if seq is not None]
+
+    def _admit(self):
+        for slot, seq in enumerate(self._slots):
+            if seq is not None:
+                continue
+            while self._pending:
+                candidate = self._pending.popleft()
+                if not candidate.cancelled:
+                    candidate.slot = slot
+                    self._ctx.kv_cache_seq_rm(slot, -1, -1)
+                    self._slots[slot] = candidate
+                    break
+
+    def _release(self, seq: BatchSequence):
+        self._slots[seq.slot] = None
+        self._ctx.kv_cache_seq_rm(seq.slot, -1, -1)
+        seq.sampler.close()
+
+    def _add_token(self, token: int, pos: int, seq_id: int, logits: bool) -> int:
+        batch = self._batch.batch
+        i = batch.n_tokens
+        batch.token[i] = token
+        batch.pos[i] = pos
+        batch.seq_id[i][0] = seq_id
+        batch.n_seq_id[i] = 1
+        batch.logits[i] = logits
+        batch.n_tokens = i + 1
+        return i
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._active():
+                    self._cond.wait()
+                self._admit()
+            self._step()
+
+    def _step(self):
+        for seq in self._active():
+            if seq.cancelled:
+                self._release(seq)
+
+        self._batch.reset()
+        budget = self.n_batch
+        sample_at: List[Tuple[BatchSequence, int]] = []
+
+        # Токены декодирования идут первыми, чтобы prefill длинных промптов
+        # не останавливал генерацию у остальных клиентов
+        for seq in self._active():
+            if seq.next_token is not None and budget > 0:
+                index = self._add_token(seq.next_token, seq.n_past, seq.slot, True)
+                seq.n_past += 1
+                seq.next_token = None
+                sample_at.append((seq, index))
+                budget -= 1
+
+        # Prefill по частям в пределах n_batch, короткие промпты первыми,
+        # чтобы длинный prefill не задерживал первый токен коротких запросов
+        for seq in sorted(self._active(), key=lambda seq: len(seq.pending)):
+            if not seq.pending or budget <= 0:
+                continue
+            chunk = seq.pending[:budget]
+            del seq.pending[: len(chunk)]
+            for offset, token in enumerate(chunk):
+                last = offset == len(chunk) - 1 and not seq.pending
+                index = self._add_token(token, seq.n_past + offset, seq.slot, last)
+            seq.n_past += len(chunk)
+            budget -= len(chunk)
+            if not seq.pending:
+                sample_at.append((seq, index))
+
+        if self._batch.n_tokens() == 0:
+            return
+
+        try:
+            self._ctx.decode(self._batch)
+        except Exception as e:
+            for seq in self._active():
+                seq._fail(e)
+                self._release(seq)
+            return
+
+        self.decode_steps += 1
+        self.batch_tokens_total += self._batch.n_tokens()
+
+        for seq, index in sample_at:
+            token = seq.sampler.sample(self._ctx, index)
+            self._accept(seq, token)
+
+    def _accept(self, seq: BatchSequence, token: int):
+        seq.completion_tokens += 1
+        if llama_cpp.llama_token_is_eog(self.llama._model.vocab, token):
+            seq._finish("stop")
+        else:
+            seq._push(self.llama.detokenize([token]))
+            if not seq.finished and seq.completion_tokens >= seq.max_tokens:
+                seq._finish("length")
+
+        if seq.finished:
+            self._release(seq)
+        else:
+            seq.next_token = token
+
+    def stats(self) -> dict:
+        with self._cond:
+            active = len(self._active())
+            pending = len(self._pending)
+        return {
+            "slots": self.n_slots,
+            "slot_ctx": self.slot_ctx,
+            "active": active,
+            "pending": pending,
+            "requests_total": self.requests_total,
+            "decode_steps": self.decode_steps,
+            "avg_batch_tokens": round(
+                self.batch_tokens_total / max(self.decode_steps, 1), 2
+            ),
+        }
+
+
+def sampling_kwargs(body) -> dict:
+    """Параметры build_sampler() из тела запроса completions/chat"""
+    return dict(
+        temperature=body.temperature,
+        top_k=body.top_k,
+        top_p=body.top_p,
+        min_p=body.min_p,
+        typical_p=1.0,
+        repeat_penalty=body.repeat_penalty,
+        frequency_penalty=body.frequency_penalty,
+        presence_penalty=body.presence_penalty,
+        mirostat_mode=body.mirostat_mode,
+        mirostat_tau=body.mirostat_tau,
+        mirostat_eta=body.mirostat_eta,
+        seed=body.seed,
+        grammar=llama_cpp.LlamaGrammar.from_string(body.grammar)
+        if body.grammar is not None
+        else None,
+    )
+
+
+def stop_list(stop) -> List[str]:
+    """Приводит поле stop запроса к списку строк"""
+    if stop is None:
+        return []
+    return [stop] if isinstance(stop, str) else list(stop)
+
+
+def completion_supported(body: CreateCompletionRequest) -> bool:
+    """Можно ли выполнить запрос completions в планировщике батчей"""
+    return (
+        not body.echo
+        and body.suffix is None
+        and body.logprobs is None
+        and body.logit_bias is None
+        and body.min_tokens == 0
+    )
+
+
+def chat_supported(body: CreateChatCompletionRequest) -> bool:
+    """Можно ли выполнить запрос chat в планировщике батчей"""
+    return (
+        not body.tools
+        and not body.functions
+        and body.response_format is None
+        and not body.logprobs
+        and body.logit_bias is None
+        and body.min_tokens == 0
+    )
+
+
+def create_batching_router(scheduler: BatchScheduler) -> APIRouter:
+    """Маршруты completions/chat, отправляющие запросы в планировщик
+
+    Запросы с параметрами, которые планировщик не поддерживает (tools,
+    response_format, logprobs, echo и т.п.), передаются исходным
+    обработчикам llama_cpp.
+    """
+    router = APIRouter(route_class=RouteErrorHandler)
+    llama = scheduler.llama
+
+    async def run_sequence(sequence: BatchSequence, stream: bool, make_chunk):
+        scheduler.submit(sequence)
+        created = int(time.time())
+
+        if not stream:
+            text = "".join([piece async for piece in sequence.stream()])
+            return make_chunk(text, sequence.finish_reason, created, final=True)
+
+        async def events():
+            try:
+                first = True
+                async for piece in sequence.stream():
+                    chunk = make_chunk(piece, None, created, first=first)
+                    yield dict(data=json.dumps(chunk))
+                    first = False
+                yield dict(
+                    data=json.dumps(
+                        make_chunk("", sequence.finish_reason, created, first=first)
+                    )
+                )
+                yield dict(data="[DONE]")
+            finally:
+                if not sequence.finished:
+                    sequence.cancelled = True
+
+        return EventSourceResponse(
+            events(),
+            sep="\n",
+            ping_message_factory=llama_server_app._ping_message_factory,
+        )
+
+    def usage(sequence: BatchSequence) -> dict:
+        return {
+            "prompt_tokens": sequence.n_prompt,
+            "completion_tokens": sequence.completion_tokens,
+            "total_tokens": sequence.n_prompt + sequence.completion_tokens,
+        }
+
+    @router.post(
+        "/v1/completions",
+        dependencies=[Depends(llama_server_app.authenticate)],
+        include_in_schema=False,
+    )
+    async def create_completion(request: Request, body: CreateCompletionRequest):
+        if isinstance(body.prompt, list):
+            assert len(body.prompt) <= 1
+            body.prompt = body.prompt[0] if len(body.prompt) > 0 else ""
+
+        if not completion_supported(body):
+            return await llama_server_app.create_completion(request, body)
+
+        prompt_tokens = await run_in_threadpool(
+            llama.tokenize, body.prompt.encode("utf-8"), True, True
+        )
+        sequence = BatchSequence(
+            prompt_tokens,
+            build_sampler(llama, **sampling_kwargs(body)),
+            body.max_tokens if body.max_tokens is not None else scheduler.slot_ctx,
+            stop_list(body.stop),
+        )
+        completion_id = f"cmpl-{uuid.uuid4()}"
+        model = body.model or llama.model_path
+
+        def make_chunk(text, finish_reason, created, first=False, final=False):
+            chunk = {
+                "id": completion_id,
+                "object": "text_completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "text": text,
+                        "index": 0,
+                        "logprobs": None,
+                        "finish_reason": finish_reason,
+                    }
+                ],
+            }
+            if final:
+                chunk["usage"] = usage(sequence)
+            return chunk
+
+        return await run_sequence(sequence, body.stream, make_chunk)
+
+    @router.post(
+        "/v1/chat/completions",
+        dependencies=[Depends(llama_server_app.authenticate)],
+        include_in_schema=False,
+    )
+    async def create_chat_completion(
+        request: Request, body: CreateChatCompletionRequest
+    ):
+        rendered = None
+        if chat_supported(body):
+            rendered = await run_in_threadpool(
+                render_chat_prompt, llama, body.messages
+            )
+        if rendered is None:
+            return await llama_server_app.create_chat_completion(request, body)
+
+        prompt_tokens, format_stop = rendered
+        sequence = BatchSequence(
+            prompt_tokens,
+            build_sampler(llama, **sampling_kwargs(body)),
+            body.max_tokens if body.max_tokens is not None else scheduler.slot_ctx,
+            stop_list(body.stop) + format_stop,
+        )
+        completion_id = f"chatcmpl-{uuid.uuid4()}"
+        model = body.model or llama.model_path
+
+        def make_chunk(text, finish_reason, created, first=False, final=False):
+            if final:
+                return {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": created,
+                    "model": model,
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": {"role": "assistant", "content": text},
+                            "logprobs": None,
+                            "finish_reason": finish_reason,
+                        }
+                    ],
+                    "usage": usage(sequence),
+                }
+            delta = {"role": "assistant"} if first else {}
+            if text:
+                delta["content"] = text
+            return {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "delta": delta,
+                        "logprobs": None,
+                        "finish_reason": finish_reason,
+                    }
+                ],
+            }
+
+        return await run_sequence(sequence, body.stream, make_chunk)
+
+    @router.get("/extras/batching", summary="Batching stats", tags=["Extras"])
+    async def get_batching_stats():
+        return scheduler.stats()
+
+    return router
+
+
+def create_batch_scheduler(n_slots: int, slot_ctx: int) -> BatchScheduler:
+    """Создает планировщик на модели по умолчанию, загруженной create_app()"""
+    return BatchScheduler(get_default_llama_proxy()(), n_slots, slot_ctx)
+
+
+def install_batch_scheduler(app: FastAPI, scheduler: BatchScheduler):
+    """Перекрывает маршруты completions/chat маршрутами планировщика"""
+    override_routes(app, create_batching_router(scheduler))
@@ -0,0 +1,468 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест сервера с детерминированной заглушкой модели
+
+Приложение собирается тем же Main.main(), что и в продакшене, но вместо
+загрузки GGUF каждая модель подменяется FakeLlama с настраиваемой
+задержкой на токен. Сервер запускается через uvicorn на свободном порту,
+нагрузка подается по HTTP с заданной конкурентностью. Результаты можно
+сравнить с сохраненным базовым JSON, чтобы ловить регрессии в CI.
+
+Пример:
+    python benchmark.py --concurrency 8 --requests 200 --stream --baseline bench.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import itertools
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from typing import Dict, List, Optional
+
+import httpx
+import llama_cpp
+import uvicorn
+from llama_cpp.server.model import LlamaProxy
+
+_WORDS = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+_completion_ids = itertools.count()
+
+LATENCY_PERCENTILES = (50, 95, 99)
+
+
+class FakeLlama:
+    """Детерминированная заглушка llama_cpp.Llama
+
+    Токен промпта - одно слово, токен ответа - одно слово из фиксированного
+    словаря, поэтому при одинаковом промпте ответ всегда одинаков. Время
+    prefill и декодирования имитируется задержками на токен. Chat-запросы
+    проходят через настоящий chat handler llama_cpp.
+    """
+
+    __call__ = llama_cpp.Llama.__call__
+    create_chat_completion = llama_cpp.Llama.create_chat_completion
+
+    def __init__(self, settings, token_delay: float = 0.0, prefill_delay: float = 0.0):
+        self.model_path = settings.model
+        self.chat_format = settings.chat_format
+        self.chat_handler = None
+        self._chat_handlers = {}
+        self.metadata = {}
+        self.verbose = False
+        self._n_ctx = settings.n_ctx
+        self.token_delay = token_delay
+        self.prefill_delay = prefill_delay
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        tokens = [zlib.crc32(word) % 32000 + 3 for word in text.split()]
+        return [self.token_bos()] + tokens if add_bos else tokens
+
+    def token_bos(self) -> int:
+        return 1
+
+    def token_eos(self) -> int:
+        return 2
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def set_cache(self, cache):
+        pass
+
+    def close(self):
+        pass
+
+    def create_completion(self, prompt, max_tokens: Optional[int] = 16, stream: bool = False, model=None, **kwargs):
+        if isinstance(prompt, str):
+            prompt = self.tokenize(prompt.encode("utf-8"))
+        n_prompt = len(prompt)
+        if max_tokens is None or max_tokens <= 0:
+            max_tokens = self._n_ctx - n_prompt
+        pieces = [" " + _WORDS[(n_prompt + i) % len(_WORDS)] for i in range(max_tokens)]
+
+        completion_id = f"cmpl-fake-{next(_completion_ids)}"
+        created = int(time.time())
+        model = model or self.model_path
+        usage = {
+            "prompt_tokens": n_prompt,
+            "completion_tokens": len(pieces),
+            "total_tokens": n_prompt + len(pieces),
+        }
+
+        def chunk(text, finish_reason):
+            return {
+                "id": completion_id,
+                "object": "text_completion",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {"text": text, "index": 0, "logprobs": None, "finish_reason": finish_reason}
+                ],
+            }
+
+        def generate():
+            time.sleep(self.prefill_delay * n_prompt)
+            for piece in pieces:
+                time.sleep(self.token_delay)
+                yield chunk(piece, None)
+            yield chunk("", "length")
+
+        if stream:
+            return generate()
+
+        for _ in generate():
+            pass
+        return {**chunk("".join(pieces), "length"), "usage": usage}
+
+
+@contextlib.contextmanager
+def fake_llama_backend(token_delay: float, prefill_delay: float):
+    """Подменяет загрузку моделей в LlamaProxy на FakeLlama"""
+    original_loader = LlamaProxy.load_llama_from_model_settings
+    LlamaProxy.load_llama_from_model_settings = staticmethod(
+        lambda settings: FakeLlama(settings, token_delay, prefill_delay)
+    )
+    try:
+        yield
+    finally:
+        LlamaProxy.load_llama_from_model_settings = original_loader
+
+
+@contextlib.contextmanager
+def patched_environ(updates: Dict[str, str]):
+    original = {name: os.environ.get(name) for name in updates}
+    os.environ.update(updates)
+    try:
+        yield
+    finally:
+        for name, value in original.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+@contextlib.contextmanager
+def uninterrupted_streams():
+    """Выключает interrupt_requests в настройках сервера из Main
+
+    С interrupt_requests llama_cpp обрывает текущий поток, как только
+    приходит следующий запрос, и при конкурентной нагрузке замерялись бы
+    оборванные ответы.
+    """
+    import Main
+
+    original = Main.create_server_settings
+
+    def create_server_settings():
+        settings = original()
+        settings.interrupt_requests = False
+        return settings
+
+    Main.create_server_settings = create_server_settings
+    try:
+        yield
+    finally:
+        Main.create_server_settings = original
+
+
+def build_app(token_delay: float, prefill_delay: float):
+    """Собирает приложение через Main.main() поверх FakeLlama
+
+    MODEL_PATH указывает на пустой временный файл. Непрерывный батчинг
+    и замер потоков работают с настоящим llama_context, поэтому выключаются.
+    """
+    from Main import main
+
+    with tempfile.NamedTemporaryFile(suffix=".gguf", delete=False) as model_file:
+        model_path = model_file.name
+    overrides = {"MODEL_PATH": model_path, "BATCHING": "0", "AUTOTUNE_BENCHMARK": "0"}
+    try:
+        with patched_environ(overrides), fake_llama_backend(token_delay, prefill_delay), \
+                uninterrupted_streams():
+            return main()
+    finally:
+        os.unlink(model_path)
+
+
+@contextlib.contextmanager
+def serve_in_background(app):
+    """Запускает uvicorn на свободном порту 127.0.0.1 и возвращает базовый URL"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(app, lifespan="off", log_level="warning", access_log=False)
+    )
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("Сервер для нагрузочного теста не запустился")
+        time.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+        sock.close()
+
+
+def parse_length_distribution(spec: str):
+    """Разбирает распределение длины промпта в словах
+
+    fixed:N, uniform:A-B или choice:A,B,C. Возвращает функцию rng -> длина.
+    """
+    kind, _, value = spec.partition(":")
+    try:
+        if kind == "fixed":
+            length = int(value)
+            sample = lambda rng: length
+        elif kind == "uniform":
+            low, high = (int(v) for v in value.split("-"))
+            sample = lambda rng: rng.randint(low, high)
+        elif kind == "choice":
+            lengths = [int(v) for v in value.split(",")]
+            sample = lambda rng: rng.choice(lengths)
+        else:
+            raise ValueError(kind)
+    except ValueError:
+        raise ValueError(
+            f"Неверное распределение длины промпта: {spec} "
+            "(ожидается fixed:N, uniform:A-B или choice:A,B,C)"
+        )
+    return sample
+
+
+def make_request_bodies(config: dict) -> List[dict]:
+    """Детерминированный набор тел запросов для заданной конфигурации"""
+    rng = random.Random(config["seed"])
+    sample = parse_length_distribution(config["prompt_lengths"])
+    bodies = []
+    for _ in range(config["requests"]):
+        prompt = " ".join(rng.choice(_WORDS) for _ in range(max(sample(rng), 1)))
+        body = {"max_tokens": config["max_tokens"], "temperature": 0.0, "stream": config["stream"]}
+        if config["endpoint"] == "chat":
+            body["messages"] = [{"role": "user", "content": prompt}]
+        else:
+            body["prompt"] = prompt
+        bodies.append(body)
+    return bodies
+
+
+def _event_text(event: dict, endpoint: str) -> str:
+    choice = event["choices"][0]
+    if endpoint == "chat":
+        return choice.get("delta", {}).get("content") or ""
+    return choice.get("text") or ""
+
+
+async def send_request(client: httpx.AsyncClient, path: str, body: dict, endpoint: str) -> dict:
+    """Выполняет один запрос и измеряет TTFT, полную задержку и число токенов
+
+    Поток без чанка с finish_reason считается оборванным и учитывается как ошибка.
+    """
+    started = time.perf_counter()
+    ttft = None
+    tokens = 0
+    finished = False
+    if body["stream"]:
+        async with client.stream("POST", path, json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                return {"status": response.status_code}
+            async for line in response.aiter_lines():
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                event = json.loads(line[6:])
+                if any(choice.get("finish_reason") is not None for choice in event["choices"]):
+                    finished = True
+                if _event_text(event, endpoint):
+                    tokens += 1
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+                elif "usage" in event:
+                    # При FAST_STREAM в одном событии может быть несколько токенов
+                    tokens = event["usage"]["completion_tokens"]
+        if not finished:
+            return {"status": "interrupted"}
+    else:
+        response = await client.post(path, json=body)
+        if response.status_code != 200:
+            return {"status": response.status_code}
+        tokens = response.json()["usage"]["completion_tokens"]
+    return {
+        "status": 200,
+        "ttft": ttft,
+        "latency": time.perf_counter() - started,
+        "tokens": tokens,
+    }
+
+
+async def run_load(base_url: str, config: dict) -> dict:
+    """Подает нагрузку замкнутым циклом из concurrency клиентов"""
+    path = "/v1/chat/completions" if config["endpoint"] == "chat" else "/v1/completions"
+    bodies = iter(make_request_bodies(config))
+    samples = []
+
+    async def worker(client):
+        for body in bodies:
+            try:
+                samples.append(await send_request(client, path, body, config["endpoint"]))
+            except httpx.HTTPError as e:
+                samples.append({"status": type(e).__name__})
+
+    limits = httpx.Limits(max_connections=config["concurrency"])
+    async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(client) for _ in range(config["concurrency"])))
+        duration = time.perf_counter() - started
+    return summarize(samples, duration)
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """Перцентиль по методу ближайшего ранга"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(-(-p * len(ordered) // 100)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(samples: List[dict], duration: float) -> dict:
+    """Сводит замеры отдельных запросов в итоговые метрики"""
+    ok = [s for s in samples if s["status"] == 200]
+    errors: Dict[str, int] = {}
+    for s in samples:
+        if s["status"] != 200:
+            errors[str(s["status"])] = errors.get(str(s["status"]), 0) + 1
+
+    result = {
+        "requests": len(samples),
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "req_per_s": round(len(ok) / duration, 3) if duration > 0 else 0.0,
+        "tokens_per_s": round(sum(s["tokens"] for s in ok) / duration, 3) if duration > 0 else 0.0,
+    }
+    for name in ("ttft", "latency"):
+        values = [s[name] for s in ok if s[name] is not None]
+        result[name] = {
+            f"p{p}": round(percentile(values, p), 6) if values else None
+            for p in LATENCY_PERCENTILES
+        }
+    return result
+
+
+def compare_with_baseline(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Возвращает описания регрессий относительно базового прогона
+
+    Пропускная способность считается регрессией, если упала больше чем на
+    tolerance, задержки - если выросли больше чем на tolerance.
+    """
+    regressions = []
+    for name in ("req_per_s", "tokens_per_s"):
+        old, new = baseline.get(name), results.get(name)
+        if old and new is not None and new < old * (1 - tolerance):
+            regressions.append(f"{name}: {new:g} < {old:g}")
+    for name in ("ttft", "latency"):
+        for key, old in (baseline.get(name) or {}).items():
+            new = results.get(name, {}).get(key)
+            if old and new is not None and new > old * (1 + tolerance):
+                regressions.append(f"{name}.{key}: {new * 1000:.1f} мс > {old * 1000:.1f} мс")
+    if results.get("errors") and not baseline.get("errors"):
+        regressions.append(f"ошибки: {results['errors']}")
+    return regressions
+
+
+def run_benchmark(config: dict) -> dict:
+    """Собирает приложение, подает нагрузку и возвращает результаты с конфигурацией"""
+    app = build_app(config["token_delay_ms"] / 1000, config["prefill_delay_ms"] / 1000)
+    with serve_in_background(app) as base_url:
+        results = asyncio.run(run_load(base_url, config))
+    return {"config": config, **results}
+
+
+def format_results(results: dict) -> str:
+    def ms(value):
+        return "-" if value is None else f"{value * 1000:.1f} мс"
+
+    lines = [
+        f"Запросов: {results['requests']}, ошибок: {sum(results['errors'].values())} {results['errors'] or ''}",
+        f"Длительность: {results['duration_s']:.2f} с",
+        f"Пропускная способность: {results['req_per_s']:.2f} запр/с, {results['tokens_per_s']:.1f} ток/с",
+    ]
+    for name, title in (("ttft", "TTFT"), ("latency", "Полная задержка")):
+        values = ", ".join(f"{key}={ms(value)}" for key, value in results[name].items())
+        lines.append(f"{title}: {values}")
+    return "\n".join(lines)
+
+
+def main(argv=None) -> int:
+    """Точка входа нагрузочного теста; возвращает 1 при регрессии"""
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сервера с заглушкой модели")
+    parser.add_argument("--concurrency", type=int, default=4, help="Число одновременных клиентов")
+    parser.add_argument("--requests", type=int, default=100, help="Всего запросов")
+    parser.add_argument("--endpoint", choices=["completions", "chat"], default="chat")
+    parser.add_argument("--stream", action="store_true", help="Потоковые ответы (SSE)")
+    parser.add_argument("--prompt-lengths", default="uniform:16-256",
+                        help="Длина промпта в словах: fixed:N, uniform:A-B или choice:A,B,C")
+    parser.add_argument("--max-tokens", type=int, default=32, help="max_tokens каждого запроса")
+    parser.add_argument("--token-delay-ms", type=float, default=2.0, help="Задержка заглушки на токен ответа")
+    parser.add_argument("--prefill-delay-ms", type=float, default=0.05, help="Задержка заглушки на токен промпта")
+    parser.add_argument("--seed", type=int, default=0, help="Seed генератора промптов")
+    parser.add_argument("--output", help="Сохранить результаты в JSON")
+    parser.add_argument("--baseline", help="Базовый JSON для сравнения")
+    parser.add_argument("--update-baseline", action="store_true", help="Перезаписать базовый JSON результатами")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Допустимое ухудшение (доля)")
+    args = parser.parse_args(argv)
+
+    config = {
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "endpoint": args.endpoint,
+        "stream": args.stream,
+        "prompt_lengths": args.prompt_lengths,
+        "max_tokens": args.max_tokens,
+        "token_delay_ms": args.token_delay_ms,
+        "prefill_delay_ms": args.prefill_delay_ms,
+        "seed": args.seed,
+    }
+    parse_length_distribution(config["prompt_lengths"])
+
+    results = run_benchmark(config)
+    print(format_results(results))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"Базовые результаты сохранены в {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("⚠️ Конфигурация отличается от базового прогона, сравнение может быть некорректным")
+        regressions = compare_with_baseline(results, baseline, args.tolerance)
+        if regressions:
+            print("❌ Регрессии относительно базового прогона:")
+            for regression in regressions:
+                print(f"   {regression}")
+            return 1
+        print("✅ Регрессий относительно базового прогона нет")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""
+Рендеринг chat-шаблона в токены без вызова create_chat_completion()
+"""
+
+from typing import List, Optional, Tuple
+
+import llama_cpp
+from llama_cpp import llama_chat_format
+
+# Форматтеры, которые можно применить к сообщениям напрямую
+_CHAT_FORMATTERS = {
+    "chatml": llama_chat_format.format_chatml,
+    "llama-2": llama_chat_format.format_llama2,
+    "llama-3": llama_chat_format.format_llama3,
+    "mistral-instruct": llama_chat_format.format_mistral_instruct,
+    "gemma": llama_chat_format.format_gemma,
+    "qwen": llama_chat_format.format_qwen,
+    "zephyr": llama_chat_format.format_zephyr,
+}
+
+
+def get_chat_formatter(llama: llama_cpp.Llama):
+    """Возвращает форматтер для chat_format модели или None, если его нет"""
+    if llama.chat_handler is not None:
+        return None
+
+    if llama.chat_format in _CHAT_FORMATTERS:
+        return _CHAT_FORMATTERS[llama.chat_format]
+
+    if llama.chat_format == "chat_template.default":
+        eos_token_id = llama.token_eos()
+        bos_token_id = llama.token_bos()
+        return llama_chat_format.Jinja2ChatFormatter(
+            template=llama.metadata["tokenizer.chat_template"],
+            eos_token=llama._model.token_get_text(eos_token_id)
+            if eos_token_id != -1
+            else "",
+            bos_token=llama._model.token_get_text(bos_token_id)
+            if bos_token_id != -1
+            else "",
+        )
+
+    return None
+
+
+def render_chat_prompt(
+    llama: llama_cpp.Llama, messages: List[dict]
+) -> Optional[Tuple[List[int], List[str]]]:
+    """Токенизирует сообщения так же, как это делает chat handler llama_cpp
+
+    Возвращает токены промпта и стоп-строки формата, либо None, если
+    chat_format модели нельзя отрендерить вне create_chat_completion().
+    """
+    formatter = get_chat_formatter(llama)
+    if formatter is None:
+        return None
+
+    result = formatter(messages=messages)
+    tokens = llama.tokenize(
+        result.prompt.encode("utf-8"),
+        add_bos=not result.added_special,
+        special=True,
+    )
+
+    stop = result.stop or []
+    if isinstance(stop, str):
+        stop = [stop]
+    return tokens, list(stop)
@@ -0,0 +1,313 @@
+"""
+Определение топологии CPU и автоматический подбор числа потоков и размера батча
+"""
+
+import glob
+import hashlib
+import json
+import math
+import os
+import platform
+import time
+from typing import Dict, List, Optional, Tuple
+
+import llama_cpp
+
+from env_settings import read_bool
+
+DEFAULT_TUNING_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "llama-fastapi", "autotune.json"
+)
+
+
+def read_autotune_settings() -> Optional[dict]:
+    """Читает настройки AUTOTUNE_*; возвращает None, если автоподбор выключен"""
+    if not read_bool("AUTOTUNE"):
+        return None
+    return {
+        "benchmark": read_bool("AUTOTUNE_BENCHMARK"),
+        "cache_path": os.getenv("AUTOTUNE_CACHE") or DEFAULT_TUNING_CACHE,
+    }
+
+
+def _read_text(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def parse_cpu_list(text: str) -> List[int]:
+    """Разбирает список CPU в формате ядра Linux, например 0-3,8,10-11"""
+    cpus = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def read_cgroup_cpu_limit() -> Optional[float]:
+    """Квота CPU контейнера в ядрах (cgroup v2 или v1); None без ограничения"""
+    cpu_max = _read_text("/sys/fs/cgroup/cpu.max")
+    if cpu_max is not None:
+        quota, _, period = cpu_max.partition(" ")
+        if quota != "max" and period:
+            return int(quota) / int(period)
+        return None
+
+    quota = _read_text("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read_text("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    if quota is not None and period is not None and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def detect_cpu_topology() -> dict:
+    """Собирает доступные процессу логические CPU, физические ядра, NUMA-узлы и квоту
+
+    В "cores" - логические CPU, сгруппированные по физическим ядрам; ядра
+    упорядочены по сокету и номеру первого CPU, так что соседние ядра обычно
+    относятся к одному NUMA-узлу.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+
+    # Физическое ядро - уникальная пара (сокет, core_id)
+    cores: Dict[Tuple[int, str], List[int]] = {}
+    for cpu in cpus:
+        topology = f"/sys/devices/system/cpu/cpu{cpu}/topology"
+        core_id = _read_text(f"{topology}/core_id")
+        package_id = _read_text(f"{topology}/physical_package_id")
+        if core_id is None:
+            key = (0, f"cpu{cpu}")
+        else:
+            key = (int(package_id or 0), core_id)
+        cores.setdefault(key, []).append(cpu)
+
+    numa_nodes: Dict[int, List[int]] = {}
+    allowed = set(cpus)
+    for node_path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*")):
+        node_cpus = [c for c in parse_cpu_list(_read_text(f"{node_path}/cpulist") or "") if c in allowed]
+        if node_cpus:
+            numa_nodes[int(node_path.rsplit("node", 1)[1])] = node_cpus
+
+    return {
+        "logical_cpus": len(cpus),
+        "physical_cores": len(cores),
+        "numa_nodes": len(numa_nodes) or 1,
+        "largest_numa_node_cpus": max((len(c) for c in numa_nodes.values()), default=len(cpus)),
+        "cgroup_cpu_limit": read_cgroup_cpu_limit(),
+        "cores": [cores[key] for key in sorted(cores, key=lambda key: (key[0], cores[key][0]))],
+    }
+
+
+def list_physical_cores() -> List[List[int]]:
+    """Доступные процессу логические CPU, сгруппированные по физическим ядрам"""
+    return detect_cpu_topology()["cores"]
+
+
+def split_cpu_sets(cores: List[List[int]], n_sets: int) -> List[List[int]]:
+    """Делит CPU на n_sets непересекающихся наборов из соседних физических ядер
+
+    Если наборов больше, чем физических ядер, делятся логические CPU.
+    """
+    units = cores
+    if n_sets > len(cores):
+        units = [[cpu] for core in cores for cpu in core]
+    if n_sets > len(units):
+        raise ValueError(
+            f"Нельзя выделить {n_sets} непересекающихся наборов CPU из {len(units)} доступных"
+        )
+
+    base, extra = divmod(len(units), n_sets)
+    sets = []
+    start = 0
+    for i in range(n_sets):
+        size = base + (1 if i < extra else 0)
+        sets.append(sorted(cpu for unit in units[start:start + size] for cpu in unit))
+        start += size
+    return sets
+
+
+def choose_thread_settings(topology: dict) -> Tuple[dict, str]:
+    """Эвристический выбор потоков декодирования, prefill и размера батча
+
+    Декодирование упирается в пропускную способность памяти, поэтому
+    берется по одному потоку на физическое ядро (в пределах одного
+    NUMA-узла). Prefill упирается в вычисления и использует все доступные
+    логические CPU. Оба значения ограничиваются квотой cgroup.
+    """
+    reasons = []
+    logical = topology["logical_cpus"]
+    physical = topology["physical_cores"]
+
+    n_threads = physical
+    reasons.append(f"{physical} физических ядер из {logical} логических CPU")
+
+    if topology["numa_nodes"] > 1:
+        smt = max(logical // max(physical, 1), 1)
+        node_cores = max(topology["largest_numa_node_cpus"] // smt, 1)
+        if node_cores < n_threads:
+            n_threads = node_cores
+            reasons.append(
+                f"{topology['numa_nodes']} NUMA-узла: декодирование в пределах одного узла"
+            )
+
+    n_threads_batch = logical
+    limit = topology["cgroup_cpu_limit"]
+    if limit is not None:
+        quota = max(int(math.floor(limit)), 1)
+        if quota < n_threads_batch:
+            reasons.append(f"квота cgroup {limit:g} CPU")
+        n_threads = min(n_threads, quota)
+        n_threads_batch = min(n_threads_batch, quota)
+
+    if n_threads_batch <= 4:
+        n_batch = 256
+    elif n_threads_batch <= 16:
+        n_batch = 512
+    else:
+        n_batch = 1024
+
+    settings = {
+        "n_threads": max(n_threads, 1),
+        "n_threads_batch": max(n_threads_batch, 1),
+        "n_batch": n_batch,
+    }
+    return settings, "; ".join(reasons)
+
+
+def tuning_fingerprint(model_path: str, topology: dict) -> str:
+    """Ключ кэша: модель, процессор и доступные процессу ресурсы"""
+    payload = {
+        "model": os.path.abspath(model_path),
+        "model_size": os.path.getsize(model_path),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "topology": {k: v for k, v in topology.items() if k != "cores"},
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def load_cached_tuning(cache_path: str, fingerprint: str) -> Optional[dict]:
+    try:
+        with open(cache_path) as f:
+            return json.load(f).get(fingerprint)
+    except (OSError, ValueError):
+        return None
+
+
+def save_cached_tuning(cache_path: str, fingerprint: str, tuning: dict):
+    try:
+        with open(cache_path) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache[fingerprint] = tuning
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    tmp_path = f"{cache_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp_path, cache_path)
+
+
+def _candidates(best_guess: int, maximum: int) -> List[int]:
+    values = {best_guess, maximum, max(best_guess // 2, 1), max(best_guess * 3 // 4, 1)}
+    return sorted(v for v in values if 1 <= v <= maximum)
+
+
+def benchmark_thread_settings(model_path: str, settings: dict) -> dict:
+    """Короткий замер на этом хосте: скорость декодирования и prefill при разном числе потоков
+
+    Модель загружается отдельно с небольшим контекстом; число потоков
+    меняется через llama_set_n_threads без перезагрузки.
+    """
+    n_prompt = min(settings["n_batch"], 128)
+    n_decode = 16
+    llama = llama_cpp.Llama(
+        model_path=model_path,
+        n_ctx=n_prompt + n_decode + 8,
+        n_batch=settings["n_batch"],
+        n_threads=settings["n_threads"],
+        n_threads_batch=settings["n_threads_batch"],
+        logits_all=False,
+        verbose=False,
+    )
+    try:
+        text = b"The quick brown fox jumps over the lazy dog. " * n_prompt
+        prompt = llama.tokenize(text)[:n_prompt]
+        maximum = settings["n_threads_batch"]
+
+        def measure(n_threads: int, n_threads_batch: int, decode: bool) -> float:
+            llama_cpp.llama_set_n_threads(llama._ctx.ctx, n_threads, n_threads_batch)
+            llama.reset()
+            llama._ctx.kv_cache_clear()
+            if not decode:
+                started = time.perf_counter()
+                llama.eval(prompt)
+                return len(prompt) / (time.perf_counter() - started)
+            llama.eval(prompt[:8])
+            started = time.perf_counter()
+            for token in prompt[8 : 8 + n_decode]:
+                llama.eval([token])
+            return n_decode / (time.perf_counter() - started)
+
+        decode_speed = {
+            n: measure(n, settings["n_threads_batch"], decode=True)
+            for n in _candidates(settings["n_threads"], maximum)
+        }
+        n_threads = max(decode_speed, key=decode_speed.get)
+        prefill_speed = {
+            n: measure(n_threads, n, decode=False)
+            for n in _candidates(settings["n_threads_batch"], maximum)
+        }
+        n_threads_batch = max(prefill_speed, key=prefill_speed.get)
+    finally:
+        llama.close()
+
+    print(
+        "Замер потоков: декодирование "
+        + ", ".join(f"{n}={s:.1f} ток/с" for n, s in decode_speed.items())
+        + "; prefill "
+        + ", ".join(f"{n}={s:.1f} ток/с" for n, s in prefill_speed.items())
+    )
+    return {**settings, "n_threads": n_threads, "n_threads_batch": n_threads_batch}
+
+
+def autotune_threads(model_path: str, benchmark: bool, cache_path: str) -> dict:
+    """Подбирает n_threads, n_threads_batch и n_batch для этого хоста
+
+    С benchmark результат замера сохраняется в cache_path и при следующих
+    запусках на том же хосте с той же моделью берется из кэша.
+    """
+    topology = detect_cpu_topology()
+    summary = {k: v for k, v in topology.items() if k != "cores"}
+    print(f"Топология CPU: {summary}")
+    settings, reason = choose_thread_settings(topology)
+
+    if benchmark:
+        fingerprint = tuning_fingerprint(model_path, topology)
+        cached = load_cached_tuning(cache_path, fingerprint)
+        if cached is not None:
+            settings = cached
+            reason += f"; результат замера из кэша {cache_path}"
+        else:
+            settings = benchmark_thread_settings(model_path, settings)
+            save_cached_tuning(cache_path, fingerprint, settings)
+            reason += f"; замер на хосте сохранен в {cache_path}"
+
+    print(
+        f"Автоподбор потоков: n_threads={settings['n_threads']}, "
+        f"n_threads_batch={settings['n_threads_batch']}, n_batch={settings['n_batch']} "
+        f"({reason})"
+    )
+    return settings
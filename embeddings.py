@@ -0,0 +1,393 @@
+"""
+Быстрый путь /v1/embeddings: микробатчи из входов одновременных запросов
+и кэш векторов по хэшу содержимого
+"""
+
+import asyncio
+import base64
+import collections
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Literal, Optional, Tuple
+
+import llama_cpp
+import llama_cpp._internals as internals
+import llama_cpp.server.app as llama_server_app
+import numpy as np
+from fastapi import APIRouter, Depends, FastAPI, HTTPException
+from fastapi.responses import JSONResponse, Response
+from llama_cpp.server.errors import RouteErrorHandler
+from llama_cpp.server.types import CreateEmbeddingRequest
+from pydantic import Field
+from starlette.concurrency import run_in_threadpool
+
+from env_settings import read_bool, read_float, read_int
+from server_hooks import override_routes
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+MB = 1024 * 1024
+
+POOLING_TYPES = {
+    "model": llama_cpp.LLAMA_POOLING_TYPE_UNSPECIFIED,
+    "mean": llama_cpp.LLAMA_POOLING_TYPE_MEAN,
+    "cls": llama_cpp.LLAMA_POOLING_TYPE_CLS,
+    "last": llama_cpp.LLAMA_POOLING_TYPE_LAST,
+}
+
+# Ограничение llama.cpp на число последовательностей в одном контексте
+MAX_SEQUENCES = 64
+
+
+def read_embedding_settings() -> Optional[dict]:
+    """Читает настройки EMBEDDINGS/EMBEDDING_*; возвращает None, если быстрый путь выключен"""
+    if not read_bool("EMBEDDINGS"):
+        return None
+    model_path = os.getenv("EMBEDDING_MODEL_PATH") or None
+    if model_path is not None and not os.path.exists(model_path):
+        raise FileNotFoundError(f"Файл модели эмбеддингов не найден: {model_path}")
+    pooling = (os.getenv("EMBEDDING_POOLING") or "model").strip().lower()
+    if pooling not in POOLING_TYPES:
+        raise ValueError(
+            f"EMBEDDING_POOLING должен быть одним из: {', '.join(POOLING_TYPES)}"
+        )
+    return {
+        "model_path": model_path,
+        "pooling": pooling,
+        "batch_tokens": read_int("EMBEDDING_BATCH_TOKENS", 2048),
+        "max_wait_ms": read_float("EMBEDDING_MAX_WAIT_MS", 5.0),
+        "cache_bytes": read_int("EMBEDDING_CACHE_MB", 256, minimum=0) * MB,
+    }
+
+
+def content_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+
+class VectorCache:
+    """LRU-кэш векторов в одном заранее выделенном массиве float32
+
+    Ключ - хэш текста входа; в словаре хранится только номер строки
+    массива, поэтому накладные расходы на запись - несколько десятков байт.
+    """
+
+    def __init__(self, capacity_bytes: int, n_embd: int):
+        self.n_embd = n_embd
+        self.capacity = capacity_bytes // (n_embd * 4)
+        self._vectors = np.zeros((self.capacity, n_embd), dtype=np.single)
+        self._n_tokens = np.zeros(self.capacity, dtype=np.intc)
+        self._rows: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: bytes) -> Optional[Tuple[np.ndarray, int]]:
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(key)
+            self.hits += 1
+            return self._vectors[row].copy(), int(self._n_tokens[row])
+
+    def put(self, key: bytes, vector: np.ndarray, n_tokens: int):
+        if self.capacity == 0:
+            return
+        with self._lock:
+            row = self._rows.pop(key, None)
+            if row is None:
+                if len(self._rows) < self.capacity:
+                    row = len(self._rows)
+                else:
+                    _, row = self._rows.popitem(last=False)
+                    self.evictions += 1
+            self._vectors[row] = vector
+            self._n_tokens[row] = n_tokens
+            self._rows[key] = row
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._rows),
+                "capacity": self.capacity,
+                "bytes": len(self._rows) * self.n_embd * 4,
+                "capacity_bytes": self._vectors.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+class _Item:
+    __slots__ = ("tokens", "future", "loop", "queued_at")
+
+    def __init__(self, tokens: List[int], future: asyncio.Future):
+        self.tokens = tokens
+        self.future = future
+        self.loop = future.get_loop()
+        self.queued_at = time.perf_counter()
+
+
+class EmbeddingBatcher:
+    """Вычисляет эмбеддинги входов всех запросов общими батчами llama_decode
+
+    Как и планировщик батчей completions, создает собственный llama_context
+    на весах загруженной модели: режим эмбеддингов с выбранным пулингом,
+    до MAX_SEQUENCES последовательностей и batch_tokens токенов за проход.
+    Получив первый вход, поток ждет до max_wait_ms остальные, пока
+    бюджет токенов не заполнится.
+    """
+
+    def __init__(self, llama: llama_cpp.Llama, pooling: str, batch_tokens: int, max_wait_ms: float):
+        self.llama = llama
+        self.batch_tokens = batch_tokens
+        self.max_wait = max_wait_ms / 1000
+        self.n_embd = llama.n_embd()
+
+        params = llama_cpp.llama_context_params.from_buffer_copy(llama.context_params)
+        params.n_ctx = batch_tokens
+        params.n_batch = batch_tokens
+        # Неавторегрессионные модели требуют всю последовательность в одном ubatch
+        params.n_ubatch = batch_tokens
+        params.n_seq_max = MAX_SEQUENCES
+        params.embeddings = True
+        params.pooling_type = POOLING_TYPES[pooling]
+        self._ctx = internals.LlamaContext(model=llama._model, params=params, verbose=llama.verbose)
+        if self._ctx.pooling_type() == llama_cpp.LLAMA_POOLING_TYPE_NONE:
+            # Генеративные модели не задают пулинг: усредняем по токенам
+            params.pooling_type = llama_cpp.LLAMA_POOLING_TYPE_MEAN
+            self._ctx.close()
+            self._ctx = internals.LlamaContext(model=llama._model, params=params, verbose=llama.verbose)
+            print("Модель не задает пулинг эмбеддингов, используется mean")
+        self.pooling = {v: k for k, v in POOLING_TYPES.items()}.get(self._ctx.pooling_type(), "model")
+        self._batch = internals.LlamaBatch(
+            n_tokens=batch_tokens, embd=0, n_seq_max=MAX_SEQUENCES, verbose=llama.verbose
+        )
+
+        self._pending: collections.deque = collections.deque()
+        self._cond = threading.Condition()
+
+        self.inputs_total = 0
+        self.batches = 0
+        self.batch_tokens_total = 0
+        self.wait_seconds_total = 0.0
+
+        self._thread = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def tokenize(self, text: str) -> List[int]:
+        # Как Llama.embed(truncate=True): длинный вход обрезается до размера батча
+        return self.llama.tokenize(text.encode("utf-8"))[: self.batch_tokens]
+
+    def submit(self, tokens: List[int]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        with self._cond:
+            self._pending.append(_Item(tokens, future))
+            self.inputs_total += 1
+            self._cond.notify()
+        return future
+
+    def _take_batch(self) -> List[_Item]:
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = self._pending[0].queued_at + self.max_wait
+            while True:
+                n_tokens = sum(len(item.tokens) for item in self._pending)
+                remaining = deadline - time.perf_counter()
+                if n_tokens >= self.batch_tokens or len(self._pending) >= MAX_SEQUENCES or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            items = []
+            budget = self.batch_tokens
+            while self._pending and len(items) < MAX_SEQUENCES:
+                if len(self._pending[0].tokens) > budget:
+                    break
+                item = self._pending.popleft()
+                items.append(item)
+                budget -= len(item.tokens)
+            return items
+
+    def _run(self):
+        while True:
+            items = self._take_batch()
+            started = time.perf_counter()
+            try:
+                vectors = self._decode(items)
+            except Exception as e:
+                for item in items:
+                    item.loop.call_soon_threadsafe(_set_exception, item.future, e)
+                continue
+
+            self.batches += 1
+            self.batch_tokens_total += sum(len(item.tokens) for item in items)
+            self.wait_seconds_total += sum(started - item.queued_at for item in items)
+            for item, vector in zip(items, vectors):
+                item.loop.call_soon_threadsafe(_set_result, item.future, vector)
+
+    def _decode(self, items: List[_Item]) -> List[np.ndarray]:
+        self._batch.reset()
+        for seq_id, item in enumerate(items):
+            self._batch.add_sequence(item.tokens, seq_id, False)
+        self._ctx.kv_cache_clear()
+        self._ctx.decode(self._batch)
+
+        vectors = []
+        for seq_id in range(len(items)):
+            ptr = llama_cpp.llama_get_embeddings_seq(self._ctx.ctx, seq_id)
+            vectors.append(np.ctypeslib.as_array(ptr, shape=(self.n_embd,)).copy())
+        return vectors
+
+    def stats(self) -> dict:
+        with self._cond:
+            pending = len(self._pending)
+        return {
+            "pooling": self.pooling,
+            "n_embd": self.n_embd,
+            "batch_tokens": self.batch_tokens,
+            "pending": pending,
+            "inputs_total": self.inputs_total,
+            "batches": self.batches,
+            "avg_batch_tokens": round(self.batch_tokens_total / max(self.batches, 1), 2),
+            "avg_inputs_per_batch": round(
+                (self.inputs_total - pending) / max(self.batches, 1), 2
+            ),
+            "avg_wait_ms": round(
+                self.wait_seconds_total * 1000 / max(self.inputs_total - pending, 1), 3
+            ),
+        }
+
+
+def _set_result(future: asyncio.Future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+def _set_exception(future: asyncio.Future, error: Exception):
+    if not future.done():
+        future.set_exception(error)
+
+
+class EmbeddingRequest(CreateEmbeddingRequest):
+    encoding_format: Literal["float", "base64"] = Field(
+        default="float",
+        description="Return vectors as JSON floats or base64-encoded little-endian float32.",
+    )
+
+
+def encode_vectors(vectors: np.ndarray, encoding_format: str) -> list:
+    if encoding_format == "base64":
+        little_endian = vectors.astype("<f4", copy=False)
+        return [base64.b64encode(row.tobytes()).decode("ascii") for row in little_endian]
+    return list(vectors)
+
+
+def embedding_response(payload: dict) -> Response:
+    if orjson is not None:
+        return Response(
+            orjson.dumps(payload, option=orjson.OPT_SERIALIZE_NUMPY),
+            media_type="application/json",
+        )
+    for item in payload["data"]:
+        if isinstance(item["embedding"], np.ndarray):
+            item["embedding"] = item["embedding"].tolist()
+    return JSONResponse(payload)
+
+
+def create_embedding_router(
+    batcher: EmbeddingBatcher,
+    cache: Optional[VectorCache],
+    model_name: str,
+) -> APIRouter:
+    """Маршрут /v1/embeddings поверх микробатчей и кэша векторов"""
+    router = APIRouter(route_class=RouteErrorHandler)
+
+    @router.post(
+        "/v1/embeddings",
+        summary="Embedding",
+        dependencies=[Depends(llama_server_app.authenticate)],
+        tags=["OpenAI V1"],
+    )
+    async def create_embedding(body: EmbeddingRequest):
+        texts = body.input if isinstance(body.input, list) else [body.input]
+        keys = [content_key(text) for text in texts]
+        vectors = np.empty((len(texts), batcher.n_embd), dtype=np.single)
+        n_tokens = [0] * len(texts)
+
+        # Повторы внутри запроса вычисляются один раз
+        misses = []
+        duplicates = []
+        first_index = {}
+        for i, key in enumerate(keys):
+            if key in first_index:
+                duplicates.append((i, first_index[key]))
+                continue
+            first_index[key] = i
+            cached = cache.get(key) if cache is not None else None
+            if cached is None:
+                misses.append(i)
+            else:
+                vectors[i], n_tokens[i] = cached
+
+        if misses:
+            tokens = await run_in_threadpool(lambda: [batcher.tokenize(texts[i]) for i in misses])
+            for i, item_tokens in zip(misses, tokens):
+                if not item_tokens:
+                    raise HTTPException(status_code=400, detail=f"Input {i} produced no tokens")
+            futures = [batcher.submit(item_tokens) for item_tokens in tokens]
+            results = await asyncio.gather(*futures)
+            for i, item_tokens, vector in zip(misses, tokens, results):
+                vectors[i] = vector
+                n_tokens[i] = len(item_tokens)
+                if cache is not None:
+                    cache.put(keys[i], vector, len(item_tokens))
+
+        for i, first in duplicates:
+            vectors[i] = vectors[first]
+            n_tokens[i] = n_tokens[first]
+
+        prompt_tokens = sum(n_tokens)
+        encoded = encode_vectors(vectors, body.encoding_format)
+        return embedding_response({
+            "object": "list",
+            "data": [
+                {"object": "embedding", "embedding": embedding, "index": i}
+                for i, embedding in enumerate(encoded)
+            ],
+            "model": body.model or model_name,
+            "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens},
+        })
+
+    @router.get("/extras/embeddings", summary="Embeddings stats", tags=["Extras"])
+    async def get_embedding_stats():
+        stats = batcher.stats()
+        stats["cache"] = cache.stats() if cache is not None else None
+        return stats
+
+    return router
+
+
+def install_embeddings(
+    app: FastAPI,
+    llama: llama_cpp.Llama,
+    pooling: str,
+    batch_tokens: int,
+    max_wait_ms: float,
+    cache_bytes: int,
+) -> EmbeddingBatcher:
+    """Перекрывает /v1/embeddings быстрым путем на весах модели llama"""
+    batcher = EmbeddingBatcher(llama, pooling, batch_tokens, max_wait_ms)
+    cache = VectorCache(cache_bytes, batcher.n_embd) if cache_bytes > 0 else None
+    override_routes(app, create_embedding_router(batcher, cache, llama.model_path))
+    return batcher
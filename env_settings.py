@@ -0,0 +1,41 @@
+"""
+Чтение и валидация дополнительных переменных окружения
+"""
+
+import os
+
+
+def read_bool(name: str, default: bool = False) -> bool:
+    """Читает логический флаг (1/true/yes/on)"""
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
+def read_int(name: str, default: int, minimum: int = 1) -> int:
+    """Читает целое число и проверяет нижнюю границу"""
+    try:
+        value = int(os.getenv(name, default))
+    except ValueError as e:
+        raise ValueError(f"Ошибка в параметре {name}: {e}")
+
+    if value < minimum:
+        if minimum == 1:
+            raise ValueError(f"{name} должен быть положительным числом")
+        raise ValueError(f"{name} должен быть не меньше {minimum}")
+
+    return value
+
+
+def read_float(name: str, default: float, minimum: float = 0.0) -> float:
+    """Читает число с плавающей точкой и проверяет нижнюю границу"""
+    try:
+        value = float(os.getenv(name, default))
+    except ValueError as e:
+        raise ValueError(f"Ошибка в параметре {name}: {e}")
+
+    if value < minimum:
+        raise ValueError(f"{name} должен быть не меньше {minimum}")
+
+    return value
@@ -0,0 +1,301 @@
+"""
+Облегченная отдача потоковых ответов completions/chat: шаблоны событий,
+быстрый JSON и объединение токенов в одно событие SSE
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import json
+import time
+from typing import Optional, Tuple
+
+import anyio
+import llama_cpp
+import llama_cpp.server.app as llama_server_app
+from fastapi import APIRouter, Depends, FastAPI, Request
+from llama_cpp.server.errors import RouteErrorHandler
+from llama_cpp.server.types import CreateChatCompletionRequest, CreateCompletionRequest
+from sse_starlette.sse import EventSourceResponse
+
+from env_settings import read_bool, read_float, read_int
+from server_hooks import override_routes
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Поля, которые исходные обработчики llama_cpp не передают в Llama
+COMPLETION_EXCLUDE = {"n", "best_of", "logit_bias_type", "user", "min_tokens"}
+CHAT_EXCLUDE = {"n", "logit_bias_type", "user", "min_tokens"}
+
+_TEXT_PLACEHOLDER = "\0"
+_ENCODED_PLACEHOLDER = json.dumps(_TEXT_PLACEHOLDER).encode("utf-8")
+
+DONE_EVENT = b"data: [DONE]\n\n"
+
+
+def read_fast_stream_settings() -> Optional[dict]:
+    """Читает настройки FAST_STREAM_*; возвращает None, если режим выключен"""
+    if not read_bool("FAST_STREAM"):
+        return None
+    return {
+        "coalesce_ms": read_float("STREAM_COALESCE_MS", 0.0),
+        "coalesce_tokens": read_int("STREAM_COALESCE_TOKENS", 0, minimum=0),
+    }
+
+
+def encode_json_string(text: str) -> bytes:
+    """Кодирует строку как JSON-литерал (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.dumps(text)
+    return json.dumps(text).encode("utf-8")
+
+
+def encode_event(chunk: dict) -> bytes:
+    if orjson is not None:
+        return b"data: " + orjson.dumps(chunk) + b"\n\n"
+    return b"data: " + json.dumps(chunk, separators=(",", ":")).encode("utf-8") + b"\n\n"
+
+
+def chunk_text(chunk: dict, chat: bool) -> Tuple[Optional[str], Optional[str]]:
+    """Текст и finish_reason чанка llama_cpp; текст None у служебного чанка с ролью"""
+    choice = chunk["choices"][0]
+    if chat:
+        delta = choice["delta"]
+        if "role" in delta:
+            return None, choice["finish_reason"]
+        return delta.get("content") or "", choice["finish_reason"]
+    return choice["text"], choice["finish_reason"]
+
+
+def token_event_template(chunk: dict, chat: bool) -> Tuple[bytes, bytes]:
+    """Префикс и суффикс события с текстом токена
+
+    Чанки одного ответа различаются только текстом, поэтому весь JSON
+    кодируется один раз, а для каждого события кодируется лишь строка.
+    """
+    choice = dict(chunk["choices"][0])
+    if chat:
+        choice["delta"] = {"content": _TEXT_PLACEHOLDER}
+    else:
+        choice["text"] = _TEXT_PLACEHOLDER
+    event = encode_event({**chunk, "choices": [choice]})
+    prefix, suffix = event.split(_ENCODED_PLACEHOLDER)
+    return prefix, suffix
+
+
+class FastStreamStats:
+    """Счетчики потоковых ответов облегченного режима"""
+
+    def __init__(self):
+        self.streams = 0
+        self.tokens = 0
+        self.events = 0
+        self.disconnects = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "streams": self.streams,
+            "tokens": self.tokens,
+            "events": self.events,
+            "tokens_per_event": round(self.tokens / max(self.events, 1), 2),
+            "disconnects": self.disconnects,
+        }
+
+
+class TokenStream:
+    """Генерация одного потокового ответа в рабочем потоке
+
+    Рабочий поток итерирует генератор llama_cpp, собирает байты событий и
+    будит цикл событий только при отправке: после coalesce_tokens токенов
+    или на первом токене спустя coalesce_ms после прошлой отправки. Если
+    оба порога нулевые, каждый токен отправляется отдельно. Первый токен
+    отправляется сразу, чтобы не увеличивать время до первого токена.
+    """
+
+    def __init__(self, chat: bool, coalesce_ms: float, coalesce_tokens: int, stats: FastStreamStats):
+        self.chat = chat
+        self.coalesce_s = coalesce_ms / 1000
+        self.coalesce_tokens = coalesce_tokens or (0 if coalesce_ms > 0 else 1)
+        self.stats = stats
+        self.cancelled = False
+        self._loop = asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+
+    def _send(self, item):
+        self._loop.call_soon_threadsafe(self._queue.put_nowait, item)
+
+    def produce(self, llama, llama_call, kwargs: dict):
+        iterator = None
+        try:
+            iterator = llama_call(llama, **kwargs)
+            template = None
+            pending = []
+            n_pending = 0
+            n_tokens = 0
+            last_flush = None
+            final = None
+
+            for chunk in iterator:
+                if self.cancelled:
+                    return
+                text, finish_reason = chunk_text(chunk, self.chat)
+                if text is None:
+                    self._send(encode_event(chunk))
+                    continue
+                if finish_reason is None:
+                    # llama_cpp выдает по чанку на каждый сгенерированный токен
+                    n_tokens += 1
+                if text:
+                    if template is None:
+                        template = token_event_template(chunk, self.chat)
+                    pending.append(text)
+                    n_pending += 1
+
+                if finish_reason is not None:
+                    final = chunk
+                    if text and not self.chat:
+                        final = {**chunk, "choices": [{**chunk["choices"][0], "text": ""}]}
+                    # Генератор дочитывается до конца: после итогового чанка
+                    # llama_cpp сохраняет состояние в кэш (префиксов, сессий)
+                    continue
+
+                if not n_pending:
+                    # Токен без текста (например, часть многобайтового символа)
+                    continue
+                now = time.perf_counter()
+                if (
+                    last_flush is None
+                    or (self.coalesce_tokens and n_pending >= self.coalesce_tokens)
+                    or (self.coalesce_s and now - last_flush >= self.coalesce_s)
+                ):
+                    self._send(template[0] + encode_json_string("".join(pending)) + template[1])
+                    self.stats.events += 1
+                    pending = []
+                    n_pending = 0
+                    last_flush = now
+
+            if pending:
+                self._send(template[0] + encode_json_string("".join(pending)) + template[1])
+                self.stats.events += 1
+            self.stats.tokens += n_tokens
+
+            if final is not None:
+                # При объединении событий число токенов знает только сервер;
+                # usage, уже посчитанный бэкендом, передается как есть
+                if "usage" not in final:
+                    final = {**final, "usage": {"completion_tokens": n_tokens}}
+                self._send(encode_event(final))
+            self._send(DONE_EVENT)
+        except Exception as e:
+            self._send(e)
+        finally:
+            if iterator is not None and hasattr(iterator, "close"):
+                iterator.close()
+            self._send(None)
+
+    async def events(self):
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def create_fast_stream_router(coalesce_ms: float, coalesce_tokens: int, stats: FastStreamStats) -> APIRouter:
+    """Маршруты completions/chat с облегченной отдачей потоковых ответов
+
+    Обычные ответы и запросы, чьи чанки отличаются от простого текста
+    (logprobs, tools, functions), передаются исходным обработчикам llama_cpp.
+    """
+    router = APIRouter(route_class=RouteErrorHandler)
+
+    def stream_response(body, body_model, kwargs, llama_call, chat):
+        server_settings = next(llama_server_app.get_server_settings())
+        interrupt_requests = server_settings.interrupt_requests if server_settings else False
+
+        async def events():
+            async with contextlib.asynccontextmanager(llama_server_app.get_llama_proxy)() as llama_proxy:
+                llama = llama_server_app.prepare_request_resources(body, llama_proxy, body_model, kwargs)
+                stream = TokenStream(chat, coalesce_ms, coalesce_tokens, stats)
+                stats.streams += 1
+                # Контекст запроса передается в рабочий поток (например, сессия)
+                worker = asyncio.get_running_loop().run_in_executor(
+                    None,
+                    contextvars.copy_context().run,
+                    stream.produce,
+                    llama,
+                    llama_call,
+                    kwargs,
+                )
+                finished = False
+                try:
+                    async for event in stream.events():
+                        yield event
+                        # Как и в llama_cpp: при ожидающем запросе поток прерывается
+                        if interrupt_requests and llama_server_app.llama_outer_lock.locked():
+                            yield DONE_EVENT
+                            break
+                    finished = True
+                finally:
+                    stream.cancelled = True
+                    if not finished:
+                        stats.disconnects += 1
+                    # Блокировка модели освобождается только после остановки генерации
+                    with anyio.CancelScope(shield=True):
+                        await worker
+
+        # Отключение клиента обнаруживает EventSourceResponse, отменяя
+        # генератор, поэтому проверка на каждом токене не нужна
+        return EventSourceResponse(
+            events(),
+            sep="\n",
+            ping_message_factory=llama_server_app._ping_message_factory,
+        )
+
+    @router.post(
+        "/v1/completions",
+        dependencies=[Depends(llama_server_app.authenticate)],
+        include_in_schema=False,
+    )
+    async def create_completion(request: Request, body: CreateCompletionRequest):
+        if not body.stream or body.logprobs is not None:
+            return await llama_server_app.create_completion(request, body)
+
+        if isinstance(body.prompt, list):
+            assert len(body.prompt) <= 1
+            body.prompt = body.prompt[0] if len(body.prompt) > 0 else ""
+
+        kwargs = body.model_dump(exclude=COMPLETION_EXCLUDE)
+        return stream_response(body, body.model, kwargs, llama_cpp.Llama.__call__, False)
+
+    @router.post(
+        "/v1/chat/completions",
+        dependencies=[Depends(llama_server_app.authenticate)],
+        include_in_schema=False,
+    )
+    async def create_chat_completion(request: Request, body: CreateChatCompletionRequest):
+        if not body.stream or body.logprobs or body.tools or body.functions:
+            return await llama_server_app.create_chat_completion(request, body)
+
+        kwargs = body.model_dump(exclude=CHAT_EXCLUDE)
+        return stream_response(
+            body, body.model, kwargs, llama_cpp.Llama.create_chat_completion, True
+        )
+
+    @router.get("/extras/fast-stream", summary="Fast stream stats", tags=["Extras"])
+    async def get_fast_stream_stats():
+        return stats.snapshot()
+
+    return router
+
+
+def install_fast_stream(app: FastAPI, coalesce_ms: float, coalesce_tokens: int) -> FastStreamStats:
+    """Перекрывает маршруты completions/chat облегченной отдачей потоков"""
+    stats = FastStreamStats()
+    override_routes(app, create_fast_stream_router(coalesce_ms, coalesce_tokens, stats))
+    return stats
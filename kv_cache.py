@@ -0,0 +1,171 @@
+"""
+Тип KV-кэша, flash attention и скользящее окно контекста для длинных промптов
+"""
+
+import os
+import threading
+from typing import List, Optional
+
+import llama_cpp
+from fastapi import APIRouter, FastAPI
+
+from env_settings import read_bool, read_int
+
+KV_CACHE_TYPES = {
+    "f16": llama_cpp.GGML_TYPE_F16,
+    "q8_0": llama_cpp.GGML_TYPE_Q8_0,
+    "q4_0": llama_cpp.GGML_TYPE_Q4_0,
+}
+
+# Байт на элемент: блоки q8_0 и q4_0 хранят 32 значения и масштаб f16
+KV_BYTES_PER_ELEMENT = {
+    llama_cpp.GGML_TYPE_F16: 2.0,
+    llama_cpp.GGML_TYPE_Q8_0: 34 / 32,
+    llama_cpp.GGML_TYPE_Q4_0: 18 / 32,
+}
+
+CONTEXT_OVERFLOW_POLICIES = ("error", "truncate")
+
+# llama_cpp генерирует сверх max_tokens, пока не завершится символ UTF-8
+# (до 3 байтовых токенов), и вычисляет последний сгенерированный токен
+GENERATION_MARGIN = 4
+
+
+def read_kv_cache_settings() -> dict:
+    """Читает KV_CACHE_TYPE и FLASH_ATTN
+
+    Квантованный V-кэш в llama.cpp работает только с flash attention,
+    поэтому без явного FLASH_ATTN=false оно включается автоматически.
+    """
+    kv_cache_type = (os.getenv("KV_CACHE_TYPE") or "f16").strip().lower()
+    if kv_cache_type not in KV_CACHE_TYPES:
+        raise ValueError(f"KV_CACHE_TYPE должен быть одним из: {', '.join(KV_CACHE_TYPES)}")
+
+    quantized = kv_cache_type != "f16"
+    flash_attn = read_bool("FLASH_ATTN", default=quantized)
+    if quantized and not flash_attn:
+        raise ValueError(f"KV_CACHE_TYPE={kv_cache_type} требует FLASH_ATTN=true")
+    return {"kv_cache_type": kv_cache_type, "flash_attn": flash_attn}
+
+
+def read_context_window_settings() -> Optional[dict]:
+    """Читает CONTEXT_OVERFLOW, CONTEXT_KEEP и CONTEXT_RESERVE; None при политике error"""
+    policy = (os.getenv("CONTEXT_OVERFLOW") or "error").strip().lower()
+    if policy not in CONTEXT_OVERFLOW_POLICIES:
+        raise ValueError(
+            f"CONTEXT_OVERFLOW должен быть одним из: {', '.join(CONTEXT_OVERFLOW_POLICIES)}"
+        )
+    if policy == "error":
+        return None
+    return {
+        "n_keep": read_int("CONTEXT_KEEP", 0, minimum=0),
+        "reserve": read_int("CONTEXT_RESERVE", 0, minimum=0) or None,
+    }
+
+
+def kv_bytes_per_element(type_k: int, type_v: int) -> tuple:
+    """Байт на элемент K и V; неизвестные типы считаются как f16"""
+    return (
+        KV_BYTES_PER_ELEMENT.get(type_k, 2.0),
+        KV_BYTES_PER_ELEMENT.get(type_v, 2.0),
+    )
+
+
+class ContextWindow:
+    """Скользящее окно: старые токены промпта отбрасываются вместо ошибки
+
+    Промпт укорачивается, только если он не помещается в контекст (с
+    запасом GENERATION_MARGIN), то есть когда llama_cpp вернул бы ошибку.
+    Тогда, как при сдвиге контекста в llama.cpp, первые n_keep токенов
+    (и BOS) сохраняются, а из середины удаляется столько самых старых
+    токенов, чтобы на ответ осталось reserve мест (по умолчанию четверть
+    контекста).
+    """
+
+    def __init__(self, n_keep: int = 0, reserve: Optional[int] = None):
+        self.n_keep = n_keep
+        self.reserve = reserve
+        self.truncated_requests = 0
+        self.dropped_tokens = 0
+        self._lock = threading.Lock()
+
+    def fit(self, tokens: List[int], n_ctx: int, bos: int) -> List[int]:
+        if len(tokens) < n_ctx - GENERATION_MARGIN:
+            return tokens
+
+        reserve = min(self.reserve or n_ctx // 4, n_ctx // 2)
+        limit = n_ctx - max(reserve, 1) - GENERATION_MARGIN
+
+        n_keep = self.n_keep + (1 if tokens and tokens[0] == bos else 0)
+        n_keep = min(n_keep, limit // 2)
+        n_drop = len(tokens) - limit
+        with self._lock:
+            self.truncated_requests += 1
+            self.dropped_tokens += n_drop
+        return tokens[:n_keep] + tokens[n_keep + n_drop:]
+
+    def wrap(self, llama: llama_cpp.Llama):
+        """Подменяет create_completion экземпляра, укорачивая слишком длинные промпты
+
+        chat-обработчики llama_cpp передают в create_completion уже
+        токенизированный промпт, поэтому окно действует и на chat.
+        """
+        create_completion = llama.create_completion
+        n_ctx = llama.n_ctx()
+
+        def windowed_create_completion(*args, **kwargs):
+            prompt = kwargs["prompt"] if "prompt" in kwargs else args[0]
+            if isinstance(prompt, str):
+                # Токенов не больше, чем байт плюс BOS
+                if len(prompt.encode("utf-8")) + 1 < n_ctx - GENERATION_MARGIN:
+                    return create_completion(*args, **kwargs)
+                tokens = llama.tokenize(prompt.encode("utf-8"), special=True) if prompt else prompt
+            else:
+                tokens = prompt
+            if tokens:
+                fitted = self.fit(tokens, n_ctx, llama.token_bos())
+                if len(fitted) != len(tokens):
+                    if "prompt" in kwargs:
+                        kwargs["prompt"] = fitted
+                    else:
+                        args = (fitted,) + args[1:]
+            return create_completion(*args, **kwargs)
+
+        llama.create_completion = windowed_create_completion
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "n_keep": self.n_keep,
+                "reserve": self.reserve,
+                "truncated_requests": self.truncated_requests,
+                "dropped_tokens": self.dropped_tokens,
+            }
+
+
+def install_context_window(
+    app: FastAPI,
+    llamas: List[llama_cpp.Llama],
+    window: ContextWindow,
+    scheduler=None,
+    registry=None,
+) -> ContextWindow:
+    """Подключает скользящее окно к экземплярам модели и планировщику батчей
+
+    С реестром моделей окно подключается и к моделям, загружаемым позже.
+    """
+    for llama in llamas:
+        window.wrap(llama)
+    if scheduler is not None:
+        scheduler.context_window = window
+    if registry is not None:
+        registry.on_load.append(lambda alias, llama: window.wrap(llama))
+
+    router = APIRouter()
+
+    @router.get("/extras/context", summary="Context window stats", tags=["Extras"])
+    async def get_context_window_stats():
+        return window.stats()
+
+    app.include_router(router)
+    return window
@@ -0,0 +1,401 @@
+"""
+Метрики в формате Prometheus: токены, TTFT, задержка между токенами,
+ожидание в очереди, запросы в работе и RSS процесса
+"""
+
+import bisect
+import json
+import os
+import resource
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import llama_cpp
+from fastapi import APIRouter, FastAPI
+from fastapi.responses import PlainTextResponse
+from starlette.concurrency import run_in_threadpool
+
+from chat_prompt import render_chat_prompt
+from env_settings import read_bool
+
+# Пути генерации, для которых собираются метрики
+METRICS_PATHS = {
+    "/v1/completions",
+    "/v1/chat/completions",
+    "/v1/embeddings",
+    "/v1/engines/copilot-codex/completions",
+}
+
+LATENCY_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+TOKEN_BUCKETS = (1, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+
+def read_metrics_enabled() -> bool:
+    """Читает флаг METRICS (по умолчанию включен)"""
+    return read_bool("METRICS", default=True)
+
+
+def _format_labels(labelnames: Sequence[str], labels: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [
+        '{}="{}"'.format(
+            name,
+            value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in zip(labelnames, labels)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Счетчик с метками; вызывается только из цикла событий, без блокировок"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, *labels: str):
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин
+
+    observe() делает один bisect и два сложения, поэтому годится для
+    вызова на каждый токен потока.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float],
+        labelnames: Sequence[str] = ("model",),
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str, count: int = 1):
+        """Учитывает значение count раз"""
+        series = self._series.get(labels)
+        if series is None:
+            # [счетчики корзин (последняя - +Inf), сумма, количество]
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += count
+        series[1] += value * count
+        series[2] += count
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in self._series.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                label_str = _format_labels(self.labelnames, labels, f'le="{le}"')
+                yield f"{self.name}_bucket{label_str} {cumulative}"
+            label_str = _format_labels(self.labelnames, labels)
+            yield f"{self.name}_sum{label_str} {total}"
+            yield f"{self.name}_count{label_str} {count}"
+
+
+def process_rss_bytes() -> int:
+    """Текущий RSS процесса; без /proc - пиковый RSS из getrusage"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def make_prompt_token_counter(llama: llama_cpp.Llama) -> Callable[[str, bytes], Optional[int]]:
+    """Возвращает функцию подсчета токенов промпта по телу запроса
+
+    Нужна для потоковых ответов: в отличие от обычных, они не содержат usage.
+    """
+
+    def count_prompt_tokens(path: str, body: bytes) -> Optional[int]:
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return None
+        if path == "/v1/chat/completions":
+            rendered = render_chat_prompt(llama, request.get("messages") or [])
+            return len(rendered[0]) if rendered is not None else None
+        prompt = request.get("prompt")
+        if isinstance(prompt, list):
+            prompt = "".join(p for p in prompt if isinstance(p, str))
+        if not isinstance(prompt, str):
+            return None
+        return len(llama.tokenize(prompt.encode("utf-8"), True, True))
+
+    return count_prompt_tokens
+
+
+class ServerMetrics:
+    """Набор метрик сервера"""
+
+    def __init__(self):
+        self.requests = Counter(
+            "llama_requests_total",
+            "Completed requests by model, path and status",
+            ("model", "path", "status"),
+        )
+        self.prompt_tokens = Histogram(
+            "llama_prompt_tokens", "Prompt tokens per request", TOKEN_BUCKETS
+        )
+        self.completion_tokens = Histogram(
+            "llama_completion_tokens", "Completion tokens per request", TOKEN_BUCKETS
+        )
+        self.ttft = Histogram(
+            "llama_time_to_first_token_seconds",
+            "Time from request arrival to the first streamed token",
+            LATENCY_BUCKETS,
+        )
+        self.inter_token = Histogram(
+            "llama_inter_token_latency_seconds",
+            "Time between consecutive streamed tokens",
+            LATENCY_BUCKETS,
+        )
+        self.queue_wait = Histogram(
+            "llama_queue_wait_seconds",
+            "Time spent waiting in the admission queue",
+            LATENCY_BUCKETS,
+        )
+        self.duration = Histogram(
+            "llama_request_duration_seconds",
+            "End-to-end request duration",
+            LATENCY_BUCKETS,
+        )
+        self.in_flight = 0
+        self.collectors = []
+
+    def register(self, collector):
+        """Добавляет источник метрик с методом render(), выдающим строки"""
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = [
+            "# HELP llama_requests_in_flight Requests currently being processed",
+            "# TYPE llama_requests_in_flight gauge",
+            f"llama_requests_in_flight {self.in_flight}",
+            "# HELP process_resident_memory_bytes Resident memory size in bytes",
+            "# TYPE process_resident_memory_bytes gauge",
+            f"process_resident_memory_bytes {process_rss_bytes()}",
+        ]
+        for metric in (
+            self.requests,
+            self.prompt_tokens,
+            self.completion_tokens,
+            self.ttft,
+            self.inter_token,
+            self.queue_wait,
+            self.duration,
+            *self.collectors,
+        ):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def _response_model(payload: bytes) -> str:
+    try:
+        return str(json.loads(payload).get("model") or "unknown")
+    except (ValueError, AttributeError):
+        return "unknown"
+
+
+def _stream_events(body: bytes) -> List[dict]:
+    """JSON-события data: из сообщения потока; [DONE] и комментарии пропускаются"""
+    events = []
+    for line in body.split(b"\n"):
+        if not line.startswith(b"data: {"):
+            continue
+        try:
+            event = json.loads(line[6:])
+        except ValueError:
+            continue
+        if isinstance(event, dict):
+            events.append(event)
+    return events
+
+
+def _is_token_event(event: dict) -> bool:
+    """Событие с очередным текстом, а не служебная роль или finish_reason"""
+    choices = event.get("choices") or [{}]
+    choice = choices[0] if isinstance(choices[0], dict) else {}
+    if "finish_reason" not in choice or choice["finish_reason"] is not None:
+        return False
+    return "role" not in (choice.get("delta") or {})
+
+
+def _observe_inter_token(histogram: Histogram, model: str, event_times: List[float], n_tokens: int):
+    """Задержки между токенами по моментам событий с текстом
+
+    При объединении токенов в одно событие (FAST_STREAM) токенов больше,
+    чем событий: промежуток до события делится поровну между пришедшими
+    в нем токенами.
+    """
+    gaps = [later - earlier for earlier, later in zip(event_times, event_times[1:])]
+    if not gaps:
+        return
+    extra = max(n_tokens - len(event_times), 0)
+    per_gap, remainder = divmod(extra, len(gaps))
+    for i, gap in enumerate(gaps):
+        count = 1 + per_gap + (1 if i < remainder else 0)
+        histogram.observe(gap / count, model, count=count)
+
+
+class MetricsMiddleware:
+    """ASGI middleware, снимающее метрики с ответов генерации
+
+    События потока разбираются как JSON, поэтому метрики не зависят от
+    того, как производитель сериализует события. Токены потокового ответа
+    берутся из usage итогового события, а без него - по событиям с текстом;
+    задержки между токенами вычисляются после ответа по моментам событий.
+    Ответы из кэша ответов учитываются только в счетчике запросов.
+    """
+
+    def __init__(
+        self,
+        app,
+        metrics: ServerMetrics,
+        count_prompt_tokens: Optional[Callable[[str, bytes], Optional[int]]] = None,
+    ):
+        self.app = app
+        self.metrics = metrics
+        self.count_prompt_tokens = count_prompt_tokens
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in METRICS_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        metrics = self.metrics
+        started = time.perf_counter()
+        request_chunks = []
+
+        async def recording_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                request_chunks.append(message.get("body", b""))
+            return message
+
+        status = 500
+        streaming = False
+        cache_hit = False
+        model = "unknown"
+        event_times: List[float] = []
+        stream_usage = {}
+        body_chunks = []
+        payload = b""
+
+        async def recording_send(message):
+            nonlocal status, streaming, cache_hit, model, stream_usage
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                for name, value in message.get("headers", []):
+                    name = name.lower()
+                    if name == b"content-type":
+                        streaming = value.startswith(b"text/event-stream")
+                    elif name == b"x-response-cache":
+                        cache_hit = True
+            elif message["type"] == "http.response.body":
+                body = message.get("body", b"")
+                if not streaming:
+                    if status == 200:
+                        body_chunks.append(body)
+                elif b"data: {" in body:
+                    for event in _stream_events(body):
+                        if model == "unknown":
+                            model = str(event.get("model") or "unknown")
+                        if _is_token_event(event):
+                            event_times.append(time.perf_counter())
+                        if isinstance(event.get("usage"), dict):
+                            stream_usage = event["usage"]
+            await send(message)
+
+        metrics.in_flight += 1
+        try:
+            await self.app(scope, recording_receive, recording_send)
+        finally:
+            metrics.in_flight -= 1
+            if not streaming and body_chunks:
+                payload = b"".join(body_chunks)
+                model = _response_model(payload)
+            metrics.requests.inc(1, model, scope["path"], str(status))
+
+        if cache_hit or status != 200:
+            return
+
+        queue_wait = scope.get("state", {}).get("queue_wait")
+        if queue_wait is not None:
+            metrics.queue_wait.observe(queue_wait, model)
+        metrics.duration.observe(time.perf_counter() - started, model)
+
+        if streaming:
+            if not event_times:
+                return
+            metrics.ttft.observe(event_times[0] - started, model)
+            completion_tokens = stream_usage.get("completion_tokens", len(event_times))
+            metrics.completion_tokens.observe(completion_tokens, model)
+            _observe_inter_token(metrics.inter_token, model, event_times, completion_tokens)
+            if "prompt_tokens" in stream_usage:
+                metrics.prompt_tokens.observe(stream_usage["prompt_tokens"], model)
+            elif self.count_prompt_tokens is not None:
+                prompt_tokens = await run_in_threadpool(
+                    self.count_prompt_tokens, scope["path"], b"".join(request_chunks)
+                )
+                if prompt_tokens is not None:
+                    metrics.prompt_tokens.observe(prompt_tokens, model)
+            return
+
+        if not payload:
+            return
+        try:
+            usage = json.loads(payload).get("usage") or {}
+        except (ValueError, AttributeError):
+            return
+        if "prompt_tokens" in usage:
+            metrics.prompt_tokens.observe(usage["prompt_tokens"], model)
+        if "completion_tokens" in usage:
+            metrics.completion_tokens.observe(usage["completion_tokens"], model)
+
+
+def install_metrics(
+    app: FastAPI,
+    metrics: ServerMetrics,
+    count_prompt_tokens: Optional[Callable[[str, bytes], Optional[int]]] = None,
+):
+    """Оборачивает приложение middleware метрик и добавляет маршрут /metrics
+
+    Должно вызываться последним, чтобы middleware было внешним и видело
+    время ожидания в очереди и ответы из кэша.
+    """
+    app.add_middleware(
+        MetricsMiddleware, metrics=metrics, count_prompt_tokens=count_prompt_tokens
+    )
+
+    router = APIRouter()
+
+    @router.get("/metrics", summary="Prometheus metrics", tags=["Extras"])
+    async def get_metrics():
+        return PlainTextResponse(
+            metrics.render(), media_type="text/plain; version=0.0.4"
+        )
+
+    app.include_router(router)
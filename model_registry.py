@@ -0,0 +1,483 @@
+"""
+Реестр моделей из YAML: ленивая загрузка, выгрузка по LRU при превышении
+бюджета RAM и замена моделей без перезапуска сервера
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Union
+
+import llama_cpp
+import llama_cpp.server.app as llama_server_app
+import yaml
+from fastapi import APIRouter, Depends, FastAPI, HTTPException
+from llama_cpp.server.model import LlamaProxy
+from llama_cpp.server.settings import ModelSettings
+from starlette.concurrency import run_in_threadpool
+
+from env_settings import read_int
+from kv_cache import kv_bytes_per_element
+from server_hooks import buffer_request_body
+
+MB = 1024 * 1024
+
+# Пути, перед которыми модель из тела запроса загружается заранее
+PREFETCH_PATHS = {
+    "/v1/completions",
+    "/v1/chat/completions",
+    "/v1/embeddings",
+}
+
+# Поля, которые запись реестра не наследует от настроек основной модели
+_MODEL_SPECIFIC_FIELDS = {
+    "model",
+    "model_alias",
+    "hf_model_repo_id",
+    "hf_pretrained_model_name_or_path",
+    "clip_model_path",
+    "lora_base",
+    "lora_path",
+    "draft_model",
+}
+
+
+def read_model_registry_settings() -> Optional[dict]:
+    """Читает MODELS_CONFIG и MODELS_RAM_BUDGET_MB; None, если реестр не задан"""
+    config_path = os.getenv("MODELS_CONFIG")
+    if not config_path:
+        return None
+
+    if not os.path.exists(config_path):
+        raise FileNotFoundError(f"Файл реестра моделей не найден: {config_path}")
+
+    budget_mb = read_int("MODELS_RAM_BUDGET_MB", 0, minimum=0)
+    return {
+        "config_path": config_path,
+        "ram_budget_bytes": budget_mb * MB if budget_mb else None,
+    }
+
+
+def load_registry_config(config_path: str, base_settings: ModelSettings):
+    """Читает YAML реестра и возвращает (настройки моделей, закрепленные, бюджет)
+
+    Каждая запись - это поля ModelSettings; незаданные общие параметры
+    (n_threads, n_batch, n_ctx, chat_format и т.д.) наследуются от основной
+    модели из MODEL_PATH. Флаг pinned: true запрещает выгрузку модели.
+    """
+    with open(config_path, "rb") as f:
+        config = yaml.safe_load(f) or {}
+
+    entries = config.get("models")
+    if not isinstance(entries, list):
+        raise ValueError(f"В файле {config_path} должен быть список models")
+
+    inherited = base_settings.model_dump(exclude=_MODEL_SPECIFIC_FIELDS)
+    models: List[ModelSettings] = []
+    pinned: Set[str] = set()
+    for entry in entries:
+        entry = dict(entry)
+        is_pinned = bool(entry.pop("pinned", False))
+        settings = ModelSettings.model_validate({**inherited, **entry})
+        if not settings.model_alias:
+            settings.model_alias = settings.model
+        models.append(settings)
+        if is_pinned:
+            pinned.add(settings.model_alias)
+
+    budget_mb = config.get("ram_budget_mb")
+    ram_budget_bytes = int(budget_mb) * MB if budget_mb else None
+    return models, pinned, ram_budget_bytes
+
+
+def estimate_kv_cache_bytes(llama: llama_cpp.Llama) -> int:
+    """Оценивает размер KV-кэша модели по метаданным GGUF, n_ctx и типу кэша"""
+    metadata = llama.metadata
+    arch = metadata.get("general.architecture")
+    try:
+        n_layer = int(metadata[f"{arch}.block_count"])
+        n_embd = int(metadata[f"{arch}.embedding_length"])
+        n_head = int(metadata[f"{arch}.attention.head_count"])
+        n_head_kv = int(metadata.get(f"{arch}.attention.head_count_kv", n_head))
+        key_length = int(metadata.get(f"{arch}.attention.key_length", n_embd // n_head))
+        value_length = int(metadata.get(f"{arch}.attention.value_length", key_length))
+    except (KeyError, ValueError, ZeroDivisionError):
+        return 0
+    k_bytes, v_bytes = kv_bytes_per_element(llama.context_params.type_k, llama.context_params.type_v)
+    return int(
+        llama.n_ctx() * n_layer * n_head_kv * (key_length * k_bytes + value_length * v_bytes)
+    )
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class ModelEntry:
+    """Модель реестра, ее экземпляр Llama (если загружена) и статистика"""
+
+    def __init__(self, settings: ModelSettings, pinned: bool = False):
+        self.settings = settings
+        self.pinned = pinned
+        self.llama: Optional[llama_cpp.Llama] = None
+        self.estimated_bytes = _file_size(settings.model)
+        self.loads = 0
+        self.unloads = 0
+        self.load_seconds: Optional[float] = None
+        self.unload_seconds: Optional[float] = None
+        self.last_used = 0.0
+
+    @property
+    def alias(self) -> str:
+        return self.settings.model_alias
+
+    @property
+    def resident(self) -> bool:
+        return self.llama is not None
+
+    def stats(self) -> dict:
+        return {
+            "model": self.settings.model,
+            "resident": self.resident,
+            "pinned": self.pinned,
+            "estimated_bytes": self.estimated_bytes,
+            "loads": self.loads,
+            "unloads": self.unloads,
+            "load_seconds": round(self.load_seconds, 3)
+            if self.load_seconds is not None
+            else None,
+            "unload_seconds": round(self.unload_seconds, 3)
+            if self.unload_seconds is not None
+            else None,
+            "idle_seconds": round(time.monotonic() - self.last_used, 3)
+            if self.resident
+            else None,
+        }
+
+
+class ModelRegistry:
+    """Замена LlamaProxy с несколькими одновременно загруженными моделями
+
+    Поддерживает интерфейс LlamaProxy (вызов по псевдониму, итерация по
+    псевдонимам), поэтому подставляется в llama_cpp.server.app._llama_proxy
+    и работает под теми же глобальными блокировками модели. Незагруженная
+    модель загружается при первом обращении; перед загрузкой выгружаются
+    давно не использовавшиеся незакрепленные модели, пока оценка занятой
+    памяти (размер GGUF плюс KV-кэш) не уложится в ram_budget_bytes.
+    """
+
+    def __init__(
+        self,
+        models: List[ModelSettings],
+        pinned: Optional[Set[str]] = None,
+        ram_budget_bytes: Optional[int] = None,
+        config_path: Optional[str] = None,
+    ):
+        assert len(models) > 0, "Реестр моделей не может быть пустым"
+        pinned = pinned or set()
+        self._entries: Dict[str, ModelEntry] = {}
+        for settings in models:
+            if not settings.model_alias:
+                settings.model_alias = settings.model
+            self._entries[settings.model_alias] = ModelEntry(
+                settings, settings.model_alias in pinned
+            )
+        self.default_alias = models[0].model_alias
+        self.ram_budget_bytes = ram_budget_bytes
+        self.config_path = config_path
+        # Вызываются с псевдонимом и экземпляром для каждой загрузки модели реестром
+        self.on_load: List[Callable[[str, llama_cpp.Llama], None]] = []
+        self._lock = threading.RLock()
+
+    def resolve(self, model: Optional[str]) -> str:
+        """Псевдоним модели; неизвестные имена ведут на модель по умолчанию, как в LlamaProxy"""
+        if model is None or model not in self._entries:
+            return self.default_alias
+        return model
+
+    def adopt(self, alias: str, llama: llama_cpp.Llama, load_seconds: Optional[float] = None):
+        """Регистрирует уже загруженный экземпляр модели"""
+        with self._lock:
+            entry = self._entries[alias]
+            entry.llama = llama
+            entry.loads += 1
+            entry.load_seconds = load_seconds
+            entry.last_used = time.monotonic()
+            entry.estimated_bytes = _file_size(entry.settings.model) + estimate_kv_cache_bytes(llama)
+
+    def __call__(self, model: Optional[str] = None) -> llama_cpp.Llama:
+        return self.load(self.resolve(model))
+
+    def __getitem__(self, model: str):
+        return self._entries[model].settings.model_dump()
+
+    def __setitem__(self, model: str, settings: Union[ModelSettings, str, bytes]):
+        if isinstance(settings, (bytes, str)):
+            settings = ModelSettings.model_validate_json(settings)
+        self.replace(model, settings)
+
+    def __iter__(self):
+        for alias in list(self._entries):
+            yield alias
+
+    def __contains__(self, alias: str) -> bool:
+        return alias in self._entries
+
+    def is_resident(self, alias: str) -> bool:
+        entry = self._entries.get(alias)
+        return entry is not None and entry.resident
+
+    def resident_bytes(self) -> int:
+        return sum(e.estimated_bytes for e in self._entries.values() if e.resident)
+
+    def load(self, alias: str) -> llama_cpp.Llama:
+        """Возвращает загруженную модель, при необходимости загружая ее"""
+        with self._lock:
+            entry = self._entries[alias]
+            if entry.llama is None:
+                self._evict(entry.estimated_bytes, keep=alias)
+                print(f"Загрузка модели {alias}")
+                started = time.perf_counter()
+                llama = LlamaProxy.load_llama_from_model_settings(entry.settings)
+                for callback in self.on_load:
+                    callback(alias, llama)
+                self.adopt(alias, llama, time.perf_counter() - started)
+                print(f"Модель {alias} загружена за {entry.load_seconds:.2f} с")
+                # Теперь известен полный размер с KV-кэшем
+                self._evict(0, keep=alias)
+            entry.last_used = time.monotonic()
+            return entry.llama
+
+    def unload(self, alias: str):
+        with self._lock:
+            entry = self._entries[alias]
+            if entry.llama is None:
+                return
+            started = time.perf_counter()
+            entry.llama.close()
+            entry.llama = None
+            entry.unloads += 1
+            entry.unload_seconds = time.perf_counter() - started
+            print(f"Модель {alias} выгружена")
+
+    def _evict(self, needed_bytes: int, keep: str):
+        if self.ram_budget_bytes is None:
+            return
+        while self.resident_bytes() + needed_bytes > self.ram_budget_bytes:
+            candidates = [
+                e
+                for e in self._entries.values()
+                if e.resident and not e.pinned and e.alias != keep
+            ]
+            if not candidates:
+                print(
+                    f"Бюджет RAM {self.ram_budget_bytes // MB} МБ превышен, "
+                    f"выгружать больше нечего"
+                )
+                return
+            self.unload(min(candidates, key=lambda e: e.last_used).alias)
+
+    def replace(self, alias: str, settings: ModelSettings, pinned: Optional[bool] = None):
+        """Заменяет настройки модели (или добавляет новую); загрузка - при следующем запросе"""
+        settings.model_alias = alias
+        with self._lock:
+            entry = self._entries.get(alias)
+            if entry is not None:
+                self.unload(alias)
+                if pinned is None:
+                    pinned = entry.pinned
+            new_entry = ModelEntry(settings, bool(pinned))
+            if entry is not None:
+                new_entry.loads, new_entry.unloads = entry.loads, entry.unloads
+                new_entry.load_seconds = entry.load_seconds
+                new_entry.unload_seconds = entry.unload_seconds
+            self._entries[alias] = new_entry
+
+    def reload(self, alias: str) -> llama_cpp.Llama:
+        """Перезагружает модель с диска с текущими настройками"""
+        with self._lock:
+            self.unload(alias)
+            return self.load(alias)
+
+    def reload_config(self, base_settings: ModelSettings) -> dict:
+        """Перечитывает YAML: измененные модели выгружаются, удаленные убираются из реестра"""
+        models, pinned, ram_budget_bytes = load_registry_config(
+            self.config_path, base_settings
+        )
+        changed, added, removed = [], [], []
+        with self._lock:
+            if ram_budget_bytes is not None:
+                self.ram_budget_bytes = ram_budget_bytes
+            new_aliases = {settings.model_alias for settings in models}
+            for settings in models:
+                alias = settings.model_alias
+                if alias == self.default_alias:
+                    continue
+                entry = self._entries.get(alias)
+                if entry is None:
+                    added.append(alias)
+                elif entry.settings.model_dump() == settings.model_dump():
+                    entry.pinned = alias in pinned
+                    continue
+                else:
+                    changed.append(alias)
+                self.replace(alias, settings, alias in pinned)
+            for alias in list(self._entries):
+                if alias not in new_aliases and alias != self.default_alias:
+                    self.unload(alias)
+                    del self._entries[alias]
+                    removed.append(alias)
+            self._evict(0, keep=self.default_alias)
+        return {"changed": changed, "added": added, "removed": removed}
+
+    def free(self):
+        for alias in list(self._entries):
+            self.unload(alias)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "default_model": self.default_alias,
+                "ram_budget_bytes": self.ram_budget_bytes,
+                "resident_bytes": self.resident_bytes(),
+                "models": {alias: e.stats() for alias, e in self._entries.items()},
+            }
+
+
+def create_model_registry(
+    default_settings: ModelSettings,
+    default_llama: llama_cpp.Llama,
+    config_path: str,
+    ram_budget_bytes: Optional[int] = None,
+) -> ModelRegistry:
+    """Создает реестр из YAML, переиспользуя модель, загруженную create_app()
+
+    Основная модель из MODEL_PATH всегда идет первой, используется по
+    умолчанию и закреплена, так как на нее ссылаются кэши и батчинг.
+    """
+    models, pinned, config_budget = load_registry_config(config_path, default_settings)
+    models = [m for m in models if m.model_alias != default_settings.model_alias]
+    pinned.add(default_settings.model_alias)
+    registry = ModelRegistry(
+        [default_settings] + models,
+        pinned=pinned,
+        ram_budget_bytes=ram_budget_bytes if ram_budget_bytes is not None else config_budget,
+        config_path=config_path,
+    )
+    registry.adopt(default_settings.model_alias, default_llama)
+    return registry
+
+
+@contextlib.asynccontextmanager
+async def _model_lock():
+    # Та же блокировка, под которой маршруты llama_cpp используют модель
+    async with contextlib.asynccontextmanager(llama_server_app.get_llama_proxy)():
+        yield
+
+
+class ModelPrefetchMiddleware:
+    """ASGI middleware, загружающее запрошенную модель в пуле потоков
+
+    Без него модель грузилась бы внутри маршрута llama_cpp прямо в цикле
+    событий, останавливая обработку остальных запросов на время загрузки.
+    """
+
+    def __init__(self, app, registry: ModelRegistry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or scope["path"] not in PREFETCH_PATHS
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        body, replay_receive = await buffer_request_body(receive)
+        try:
+            model = json.loads(body).get("model")
+        except (ValueError, AttributeError):
+            model = None
+        alias = self.registry.resolve(model if isinstance(model, str) else None)
+        if not self.registry.is_resident(alias):
+            async with _model_lock():
+                await run_in_threadpool(self.registry.load, alias)
+        await self.app(scope, replay_receive, send)
+
+
+def install_model_registry(app: FastAPI, registry: ModelRegistry, base_settings: ModelSettings):
+    """Подставляет реестр вместо LlamaProxy и добавляет маршруты управления моделями"""
+    llama_server_app._llama_proxy = registry
+    app.add_middleware(ModelPrefetchMiddleware, registry=registry)
+
+    router = APIRouter(
+        prefix="/extras/models",
+        tags=["Extras"],
+        dependencies=[Depends(llama_server_app.authenticate)],
+    )
+
+    def get_alias(alias: str) -> str:
+        if alias not in registry:
+            raise HTTPException(status_code=404, detail=f"Model {alias} not found")
+        return alias
+
+    def get_replaceable_alias(alias: str) -> str:
+        # На экземпляр основной модели ссылаются кэши, метрики и батчинг
+        if alias == registry.default_alias:
+            raise HTTPException(
+                status_code=400, detail="Default model cannot be unloaded or replaced"
+            )
+        return get_alias(alias)
+
+    @router.get("", summary="Model registry stats")
+    async def get_model_registry_stats():
+        return registry.stats()
+
+    @router.post("/reload-config", summary="Re-read the model registry YAML")
+    async def reload_model_registry_config():
+        async with _model_lock():
+            return await run_in_threadpool(registry.reload_config, base_settings)
+
+    @router.post("/{alias:path}/load", summary="Load a model")
+    async def load_model(alias: str):
+        alias = get_alias(alias)
+        async with _model_lock():
+            await run_in_threadpool(registry.load, alias)
+        return registry.stats()["models"][alias]
+
+    @router.post("/{alias:path}/unload", summary="Unload a model")
+    async def unload_model(alias: str):
+        alias = get_replaceable_alias(alias)
+        async with _model_lock():
+            await run_in_threadpool(registry.unload, alias)
+        return registry.stats()["models"][alias]
+
+    @router.post("/{alias:path}/reload", summary="Reload a model from disk")
+    async def reload_model(alias: str):
+        alias = get_replaceable_alias(alias)
+        async with _model_lock():
+            await run_in_threadpool(registry.reload, alias)
+        return registry.stats()["models"][alias]
+
+    @router.put("/{alias:path}", summary="Add or replace a model")
+    async def replace_model(alias: str, settings: dict):
+        if alias in registry:
+            get_replaceable_alias(alias)
+        inherited = base_settings.model_dump(exclude=_MODEL_SPECIFIC_FIELDS)
+        pinned = settings.pop("pinned", None)
+        try:
+            model_settings = ModelSettings.model_validate({**inherited, **settings})
+        except ValueError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+        async with _model_lock():
+            await run_in_threadpool(registry.replace, alias, model_settings, pinned)
+        return registry.stats()["models"][alias]
+
+    app.include_router(router)
@@ -0,0 +1,257 @@
+"""
+Кэш KV-состояния для общих префиксов промптов (например, системного промпта chatml)
+"""
+
+import glob
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Optional, Sequence, Tuple
+
+import llama_cpp
+from fastapi import APIRouter, FastAPI
+from llama_cpp.llama_cache import BaseLlamaCache
+
+from env_settings import read_bool, read_int
+
+MB = 1024 * 1024
+
+
+def read_prefix_cache_settings() -> Optional[dict]:
+    """Читает настройки PREFIX_CACHE_*; возвращает None, если кэш выключен"""
+    if not read_bool("PREFIX_CACHE"):
+        return None
+    return {
+        "capacity_bytes": read_int("PREFIX_CACHE_MB", 2048) * MB,
+        "disk_dir": os.getenv("PREFIX_CACHE_DIR") or None,
+        "disk_capacity_bytes": read_int("PREFIX_CACHE_DISK_MB", 8192) * MB,
+        "min_prefix_tokens": read_int("PREFIX_CACHE_MIN_TOKENS", 32),
+    }
+
+
+def state_nbytes(state: llama_cpp.LlamaState) -> int:
+    """Полный размер состояния в памяти: KV-данные, логиты и токены"""
+    return state.llama_state_size + state.scores.nbytes + state.input_ids.nbytes
+
+
+def compact_state(state: llama_cpp.LlamaState) -> llama_cpp.LlamaState:
+    """Оставляет в состоянии только строку логитов последнего токена
+
+    Llama.save_state() копирует логиты всех n_tokens позиций (n_tokens x n_vocab),
+    что для длинного промпта больше самого KV-кэша. Сэмплинг использует
+    только последнюю строку, а load_state() размножит ее по срезу scores.
+    """
+    if state.scores.shape[0] <= 1:
+        return state
+    return llama_cpp.LlamaState(
+        input_ids=state.input_ids,
+        scores=state.scores[-1:].copy(),
+        n_tokens=state.n_tokens,
+        llama_state=state.llama_state,
+        llama_state_size=state.llama_state_size,
+        seed=state.seed,
+    )
+
+
+class PrefixKVCache(BaseLlamaCache):
+    """LRU-кэш состояний llama с бюджетом по байтам и дисковым уровнем
+
+    Подключается через Llama.set_cache(). Поиск возвращает состояние с самым
+    длинным общим префиксом токенов, если этот префикс не короче
+    min_prefix_tokens; Llama.generate() затем отбрасывает лишний хвост
+    KV-кэша и вычисляет только новые токены. Вытесненные из RAM записи
+    переносятся на диск, если задан disk_dir, и возвращаются в RAM при попадании.
+    """
+
+    def __init__(
+        self,
+        capacity_bytes: int = (2 << 30),
+        disk_dir: Optional[str] = None,
+        disk_capacity_bytes: int = (8 << 30),
+        min_prefix_tokens: int = 32,
+    ):
+        super().__init__(capacity_bytes)
+        self.disk_dir = disk_dir
+        self.disk_capacity_bytes = disk_capacity_bytes
+        self.min_prefix_tokens = min_prefix_tokens
+        self._ram: "OrderedDict[Tuple[int, ...], llama_cpp.LlamaState]" = OrderedDict()
+        self._ram_bytes = 0
+        self._disk: "OrderedDict[Tuple[int, ...], Tuple[str, int]]" = OrderedDict()
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.hit_tokens = 0
+        self.evictions = 0
+
+        if disk_dir is not None:
+            # Дисковый уровень - продолжение RAM-кэша, а не постоянное хранилище;
+            # удаляются только собственные файлы кэша, остальное в каталоге не трогается
+            os.makedirs(disk_dir, exist_ok=True)
+            for path in glob.glob(os.path.join(disk_dir, "*.state")):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+    @property
+    def cache_size(self) -> int:
+        return self._ram_bytes
+
+    def _find_longest_prefix_key(
+        self,
+        key: Tuple[int, ...],
+    ) -> Optional[Tuple[int, ...]]:
+        best_len = self.min_prefix_tokens - 1
+        best_key = None
+        for k in list(self._ram.keys()) + list(self._disk.keys()):
+            prefix_len = llama_cpp.Llama.longest_token_prefix(k, key)
+            if prefix_len > best_len:
+                best_len = prefix_len
+                best_key = k
+        return best_key
+
+    def __getitem__(self, key: Sequence[int]) -> llama_cpp.LlamaState:
+        key = tuple(key)
+        with self._lock:
+            found = self._find_longest_prefix_key(key)
+            if found is None:
+                self.misses += 1
+                raise KeyError("Key not found")
+
+            if found in self._ram:
+                self._ram.move_to_end(found)
+                state = self._ram[found]
+            else:
+                state = self._load_from_disk(found)
+                self._put_ram(found, state)
+                self.disk_hits += 1
+
+            self.hits += 1
+            self.hit_tokens += llama_cpp.Llama.longest_token_prefix(found, key)
+            return state
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        with self._lock:
+            return self._find_longest_prefix_key(tuple(key)) is not None
+
+    def __setitem__(self, key: Sequence[int], value: llama_cpp.LlamaState):
+        key = tuple(key)
+        with self._lock:
+            self._put_ram(key, compact_state(value))
+
+    def _put_ram(self, key: Tuple[int, ...], state: llama_cpp.LlamaState):
+        if key in self._ram:
+            self._ram_bytes -= state_nbytes(self._ram.pop(key))
+        self._drop_disk(key)
+
+        self._ram[key] = state
+        self._ram_bytes += state_nbytes(state)
+        while self._ram_bytes > self.capacity_bytes and len(self._ram) > 1:
+            old_key, old_state = self._ram.popitem(last=False)
+            self._ram_bytes -= state_nbytes(old_state)
+            self.evictions += 1
+            if self.disk_dir is not None:
+                self._save_to_disk(old_key, old_state)
+
+    def _entry_path(self, key: Tuple[int, ...]) -> str:
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.disk_dir, f"{digest}.state")
+
+    def _save_to_disk(self, key: Tuple[int, ...], state: llama_cpp.LlamaState):
+        path = self._entry_path(key)
+        with open(path, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(path)
+        self._disk[key] = (path, size)
+        self._disk_bytes += size
+        while self._disk_bytes > self.disk_capacity_bytes and self._disk:
+            self._drop_disk(next(iter(self._disk)))
+
+    def _load_from_disk(self, key: Tuple[int, ...]) -> llama_cpp.LlamaState:
+        path, _ = self._disk[key]
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+    def _drop_disk(self, key: Tuple[int, ...]):
+        entry = self._disk.pop(key, None)
+        if entry is None:
+            return
+        path, size = entry
+        self._disk_bytes -= size
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "hit_tokens": self.hit_tokens,
+                "evictions": self.evictions,
+                "ram_entries": len(self._ram),
+                "ram_bytes": self._ram_bytes,
+                "ram_capacity_bytes": self.capacity_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+                "disk_capacity_bytes": self.disk_capacity_bytes
+                if self.disk_dir is not None
+                else 0,
+            }
+
+
+def model_cache_dir(disk_dir: Optional[str], alias: str) -> Optional[str]:
+    """Каталог дискового уровня кэша модели реестра внутри disk_dir"""
+    if disk_dir is None:
+        return None
+    digest = hashlib.blake2b(alias.encode("utf-8"), digest_size=8).hexdigest()
+    return os.path.join(disk_dir, f"model-{digest}")
+
+
+def install_prefix_cache(app: FastAPI, cache: PrefixKVCache, llamas, registry=None):
+    """Подключает кэш к моделям и добавляет маршрут статистики
+
+    С реестром моделей каждая модель, загружаемая позже, получает
+    собственный кэш с теми же бюджетами: ключи кэша - токены, и состояние
+    одной модели не подходит другой. При перезагрузке модели кэш
+    создается заново.
+    """
+    for llama in llamas:
+        llama.set_cache(cache)
+
+    model_caches = {}
+    if registry is not None:
+
+        def attach_cache(alias: str, llama: llama_cpp.Llama):
+            model_cache = PrefixKVCache(
+                cache.capacity_bytes,
+                model_cache_dir(cache.disk_dir, alias),
+                cache.disk_capacity_bytes,
+                cache.min_prefix_tokens,
+            )
+            llama.set_cache(model_cache)
+            model_caches[alias] = model_cache
+
+        registry.on_load.append(attach_cache)
+
+    router = APIRouter()
+
+    @router.get(
+        "/extras/prefix-cache", summary="Prefix cache stats", tags=["Extras"]
+    )
+    async def get_prefix_cache_stats():
+        stats = cache.stats()
+        if registry is not None:
+            stats["models"] = {alias: c.stats() for alias, c in list(model_caches.items())}
+        return stats
+
+    app.include_router(router)
@@ -0,0 +1,369 @@
+"""
+Профилирование запросов: время по фазам обработки и стеки самых медленных запросов
+"""
+
+import contextvars
+import heapq
+import itertools
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+import llama_cpp
+from llama_cpp import llama_chat_format
+from fastapi import APIRouter, FastAPI
+
+from env_settings import read_float, read_int
+
+PROFILE_MODES = ("off", "header", "all")
+PROFILE_HEADER = b"x-profile"
+
+# Порядок фаз в заголовке Server-Timing
+PHASES = ("queue", "chat_template", "tokenize", "prefill", "decode", "sample", "detokenize", "send")
+
+_current_profile: contextvars.ContextVar = contextvars.ContextVar("request_profile", default=None)
+
+
+def read_profile_mode() -> str:
+    """Читает PROFILE: off - выключено, header - по заголовку X-Profile, all - все запросы"""
+    mode = (os.getenv("PROFILE") or "off").strip().lower()
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"PROFILE должен быть одним из: {', '.join(PROFILE_MODES)}")
+    return mode
+
+
+def read_profiling_settings() -> Optional[dict]:
+    """Читает PROFILE_*; возвращает None, если профилирование выключено"""
+    mode = read_profile_mode()
+    if mode == "off":
+        return None
+    return {
+        "mode": mode,
+        "directory": os.getenv("PROFILE_DIR")
+        or os.path.join(tempfile.gettempdir(), "llama-fastapi-profiles"),
+        "top_n": read_int("PROFILE_TOP_N", 10, minimum=0),
+        "sample_interval": read_float("PROFILE_SAMPLE_MS", 10.0) / 1000,
+    }
+
+
+class RequestProfile:
+    """Время по фазам одного запроса и собранные для него стеки потоков"""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, method: str, path: str):
+        self.id = next(self._ids)
+        self.method = method
+        self.path = path
+        self.started = time.perf_counter()
+        self.started_at = time.time()
+        self.total = 0.0
+        self.status = 0
+        self.phases: Dict[str, float] = {}
+        self.chat_started: Optional[float] = None
+        self.chat_tokenize = 0.0
+        self.threads = set()
+        self.stacks: Dict[str, int] = {}
+        self.samples = 0
+
+    def add(self, phase: str, seconds: float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def breakdown(self) -> Dict[str, float]:
+        """Фазы в миллисекундах; other - время вне измеряемых фаз"""
+        total = self.total or time.perf_counter() - self.started
+        result = {phase: self.phases[phase] * 1000 for phase in PHASES if phase in self.phases}
+        result["other"] = max(total * 1000 - sum(result.values()), 0.0)
+        result["total"] = total * 1000
+        return result
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={ms:.2f}" for name, ms in self.breakdown().items())
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started_at": self.started_at,
+            "phases_ms": {name: round(ms, 3) for name, ms in self.breakdown().items()},
+            "stack_samples": self.samples,
+        }
+
+
+def _timed(method, phase_for):
+    """Обертка метода Llama, добавляющая время вызова к фазе текущего профиля"""
+
+    def wrapper(*args, **kwargs):
+        profile = _current_profile.get()
+        if profile is None:
+            return method(*args, **kwargs)
+        # Стеки потока снимаются только пока он выполняет метод модели
+        ident = threading.get_ident()
+        added = ident not in profile.threads
+        if added:
+            profile.threads.add(ident)
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            profile.add(phase_for(args), time.perf_counter() - started)
+            if added:
+                profile.threads.discard(ident)
+
+    return wrapper
+
+
+def instrument_llama(llama: llama_cpp.Llama):
+    """Оборачивает методы экземпляра Llama, из которых складываются фазы генерации
+
+    Без активного профиля обертка сводится к чтению contextvar. Вызов eval
+    с несколькими токенами считается prefill, с одним - шагом декодирования.
+    Время рендеринга chat-шаблона - от вызова обработчика чата до вызова им
+    create_completion без токенизации промпта внутри обработчика, которая
+    уже учтена в tokenize; обработчик подменяется в _chat_handlers, потому что
+    потоковые маршруты llama_cpp вызывают Llama.create_chat_completion мимо
+    атрибутов экземпляра.
+    """
+    llama.tokenize = _timed(llama.tokenize, lambda args: "tokenize")
+    llama.detokenize = _timed(llama.detokenize, lambda args: "detokenize")
+    llama.sample = _timed(llama.sample, lambda args: "sample")
+    llama.eval = _timed(llama.eval, lambda args: "prefill" if len(args[0]) > 1 else "decode")
+
+    create_completion = llama.create_completion
+
+    def timed_create_completion(*args, **kwargs):
+        profile = _current_profile.get()
+        if profile is not None and profile.chat_started is not None:
+            tokenize = profile.phases.get("tokenize", 0.0) - profile.chat_tokenize
+            profile.add("chat_template", max(time.perf_counter() - profile.chat_started - tokenize, 0.0))
+            profile.chat_started = None
+        return create_completion(*args, **kwargs)
+
+    llama.create_completion = timed_create_completion
+
+    if llama.chat_handler is None and llama.chat_format is not None:
+        chat_handler = llama._chat_handlers.get(
+            llama.chat_format
+        ) or llama_chat_format.get_chat_completion_handler(llama.chat_format)
+
+        def timed_chat_handler(*args, **kwargs):
+            profile = _current_profile.get()
+            if profile is not None:
+                profile.chat_tokenize = profile.phases.get("tokenize", 0.0)
+                profile.chat_started = time.perf_counter()
+            return chat_handler(*args, **kwargs)
+
+        llama._chat_handlers[llama.chat_format] = timed_chat_handler
+
+
+def collapse_stack(frame) -> str:
+    """Стек в свернутом формате py-spy/flamegraph: от корня к листу через ';'"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """Поток, периодически снимающий стеки потоков, выполняющих профилируемые запросы
+
+    Работает только пока есть активные профили. Стеки потока снимаются,
+    пока в нем выполняется вызванный запросом метод модели, поэтому сэмплы
+    приписываются запросу, а не всему процессу.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._active: List[RequestProfile] = []
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+        self._thread.start()
+
+    def start(self, profile: RequestProfile):
+        with self._cond:
+            self._active.append(profile)
+            self._cond.notify()
+
+    def stop(self, profile: RequestProfile):
+        with self._cond:
+            self._active.remove(profile)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+                active = list(self._active)
+
+            frames = sys._current_frames()
+            for profile in active:
+                for ident in list(profile.threads):
+                    frame = frames.get(ident)
+                    if frame is None:
+                        continue
+                    stack = collapse_stack(frame)
+                    profile.stacks[stack] = profile.stacks.get(stack, 0) + 1
+                    profile.samples += 1
+            del frames
+            time.sleep(self.interval)
+
+
+class SlowestRequests:
+    """N самых медленных профилей; их фазы и стеки сохраняются на диск"""
+
+    def __init__(self, directory: str, top_n: int):
+        self.directory = directory
+        self.top_n = top_n
+        self._heap: list = []
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, profile: RequestProfile, suffix: str) -> str:
+        return os.path.join(self.directory, f"request-{os.getpid()}-{profile.id}{suffix}")
+
+    def _write(self, profile: RequestProfile):
+        with open(self._path(profile, ".json"), "w") as f:
+            json.dump(profile.to_dict(), f, indent=2)
+        if profile.stacks:
+            with open(self._path(profile, ".collapsed"), "w") as f:
+                for stack, count in list(profile.stacks.items()):
+                    f.write(f"{stack} {count}\n")
+
+    def _remove(self, profile: RequestProfile):
+        for suffix in (".json", ".collapsed"):
+            try:
+                os.unlink(self._path(profile, suffix))
+            except FileNotFoundError:
+                pass
+
+    def offer(self, profile: RequestProfile):
+        """Сохраняет профиль, если запрос входит в N самых медленных"""
+        if self.top_n == 0:
+            return
+        with self._lock:
+            entry = (profile.total, profile.id, profile)
+            if len(self._heap) < self.top_n:
+                heapq.heappush(self._heap, entry)
+                evicted = None
+            elif profile.total > self._heap[0][0]:
+                evicted = heapq.heapreplace(self._heap, entry)[2]
+            else:
+                return
+        try:
+            self._write(profile)
+            if evicted is not None:
+                self._remove(evicted)
+        except OSError as e:
+            print(f"Не удалось сохранить профиль запроса: {e}")
+
+    def snapshot(self) -> List[dict]:
+        with self._lock:
+            entries = sorted(self._heap, reverse=True)
+        return [profile.to_dict() for _, _, profile in entries]
+
+
+class ProfilingMiddleware:
+    """ASGI middleware, профилирующее запросы к /v1/
+
+    В режиме header профилируются запросы с заголовком X-Profile: 1, в
+    режиме all - все. Время по фазам возвращается в заголовке
+    Server-Timing; в потоковых ответах заголовок отправляется до генерации,
+    поэтому полная разбивка добавляется SSE-комментарием в конце потока.
+    """
+
+    def __init__(self, app, mode: str, sampler: Optional[StackSampler], slowest: SlowestRequests):
+        self.app = app
+        self.mode = mode
+        self.sampler = sampler
+        self.slowest = slowest
+
+    def _requested(self, scope) -> bool:
+        if self.mode == "all":
+            return True
+        for name, value in scope["headers"]:
+            if name == PROFILE_HEADER:
+                return value.strip().lower() in (b"1", b"true", b"yes", b"on")
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith("/v1/") or not self._requested(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = _current_profile.set(profile)
+        streaming = False
+
+        async def profiled_send(message):
+            nonlocal streaming
+            if message["type"] == "http.response.start":
+                profile.status = message["status"]
+                queue_wait = scope.get("state", {}).get("queue_wait")
+                if queue_wait is not None:
+                    profile.phases["queue"] = queue_wait
+                headers = list(message.get("headers", []))
+                for name, value in headers:
+                    if name.lower() == b"content-type" and value.startswith(b"text/event-stream"):
+                        streaming = True
+                headers.append((b"server-timing", profile.server_timing().encode("latin-1")))
+                message = dict(message, headers=headers)
+            elif message["type"] == "http.response.body" and streaming and not message.get("more_body", False):
+                profile.total = time.perf_counter() - profile.started
+                timing = f": server-timing {profile.server_timing()}\n\n".encode("latin-1")
+                message = dict(message, body=message.get("body", b"") + timing)
+
+            started = time.perf_counter()
+            try:
+                await send(message)
+            finally:
+                profile.add("send", time.perf_counter() - started)
+
+        if self.sampler is not None:
+            self.sampler.start(profile)
+        try:
+            await self.app(scope, receive, profiled_send)
+        finally:
+            if self.sampler is not None:
+                self.sampler.stop(profile)
+            _current_profile.reset(token)
+            profile.total = time.perf_counter() - profile.started
+            self.slowest.offer(profile)
+
+
+def install_profiling(
+    app: FastAPI,
+    llamas: List[llama_cpp.Llama],
+    mode: str,
+    directory: str,
+    top_n: int,
+    sample_interval: float,
+    registry=None,
+) -> SlowestRequests:
+    """Подключает профилирование запросов и маршрут /extras/profiles
+
+    С реестром моделей профилируются и модели, загружаемые позже.
+    """
+    for llama in llamas:
+        instrument_llama(llama)
+    if registry is not None:
+        registry.on_load.append(lambda alias, llama: instrument_llama(llama))
+    sampler = StackSampler(sample_interval) if sample_interval > 0 else None
+    slowest = SlowestRequests(directory, top_n)
+    app.add_middleware(ProfilingMiddleware, mode=mode, sampler=sampler, slowest=slowest)
+
+    router = APIRouter()
+
+    @router.get("/extras/profiles", summary="Slowest profiled requests", tags=["Extras"])
+    async def get_profiles():
+        return {"mode": mode, "directory": directory, "slowest": slowest.snapshot()}
+
+    app.include_router(router)
+    return slowest
@@ -0,0 +1,156 @@
+"""
+Пул реплик модели с диспетчеризацией запросов на наименее загруженную реплику
+"""
+
+import time
+from typing import List, Optional
+
+import anyio
+from fastapi import APIRouter, FastAPI
+from llama_cpp.server.model import LlamaProxy
+from llama_cpp.server.settings import ModelSettings
+
+from env_settings import read_int
+from server_hooks import get_default_llama_proxy, install_llama_proxy
+
+
+def read_replica_count(n_threads: int) -> int:
+    """Читает и валидирует переменную окружения REPLICAS"""
+    replicas = read_int("REPLICAS", 1)
+    if replicas > n_threads:
+        raise ValueError(
+            f"REPLICAS ({replicas}) не может превышать N_THREADS ({n_threads})"
+        )
+
+    return replicas
+
+
+def split_threads(n_threads: int, replicas: int) -> List[int]:
+    """Делит N_THREADS на непересекающиеся доли для каждой реплики"""
+    base, extra = divmod(n_threads, replicas)
+    return [base + (1 if i < extra else 0) for i in range(replicas)]
+
+
+class Replica:
+    """Одна независимая копия модели и счетчики ее загрузки"""
+
+    def __init__(self, index: int, proxy, n_threads: int):
+        self.index = index
+        self.proxy = proxy
+        self.n_threads = n_threads
+        self.busy = False
+        self.requests = 0
+        self.busy_seconds = 0.0
+        self._started_at: Optional[float] = None
+
+    def stats(self) -> dict:
+        busy_seconds = self.busy_seconds
+        if self._started_at is not None:
+            busy_seconds += time.perf_counter() - self._started_at
+        return {
+            "index": self.index,
+            "n_threads": self.n_threads,
+            "busy": self.busy,
+            "requests": self.requests,
+            "busy_seconds": round(busy_seconds, 3),
+        }
+
+
+class ReplicaPool:
+    """Раздает запросы свободным репликам, выбирая наименее загруженную
+
+    Каждая реплика обслуживает не более одного запроса одновременно, поэтому
+    отдельная блокировка модели не нужна. Если свободных реплик нет, запрос
+    ждет в очереди, глубина которой доступна в stats().
+    """
+
+    def __init__(self, replicas: List[Replica]):
+        assert len(replicas) > 0, "Пул реплик не может быть пустым"
+        self.replicas = replicas
+        self.waiting = 0
+        self._condition = anyio.Condition()
+        self._created_at = time.perf_counter()
+
+    async def acquire(self) -> Replica:
+        async with self._condition:
+            self.waiting += 1
+            try:
+                while True:
+                    idle = [r for r in self.replicas if not r.busy]
+                    if idle:
+                        break
+                    await self._condition.wait()
+            finally:
+                self.waiting -= 1
+
+            replica = min(idle, key=lambda r: (r.busy_seconds, r.requests))
+            replica.busy = True
+            replica.requests += 1
+            replica._started_at = time.perf_counter()
+            return replica
+
+    async def release(self, replica: Replica):
+        async with self._condition:
+            replica.busy_seconds += time.perf_counter() - replica._started_at
+            replica._started_at = None
+            replica.busy = False
+            self._condition.notify()
+
+    async def get_llama_proxy(self):
+        """Замена llama_cpp.server.app.get_llama_proxy для пула реплик"""
+        replica = await self.acquire()
+        try:
+            yield replica.proxy
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.release(replica)
+
+    def stats(self) -> dict:
+        uptime = time.perf_counter() - self._created_at
+        replicas = [r.stats() for r in self.replicas]
+        for replica in replicas:
+            replica["utilization"] = round(replica["busy_seconds"] / uptime, 4)
+        return {
+            "queue_depth": self.waiting,
+            "busy": sum(1 for r in self.replicas if r.busy),
+            "uptime_seconds": round(uptime, 3),
+            "replicas": replicas,
+        }
+
+
+def replica_model_settings(
+    model_settings: ModelSettings, n_threads: int
+) -> ModelSettings:
+    """Возвращает копию настроек модели с долей потоков одной реплики"""
+    return model_settings.model_copy(
+        update={"n_threads": n_threads, "n_threads_batch": n_threads}
+    )
+
+
+def create_replica_pool(
+    model_settings: ModelSettings, thread_slices: List[int]
+) -> ReplicaPool:
+    """Создает пул реплик, переиспользуя модель, загруженную create_app()
+
+    Первая реплика - это LlamaProxy, уже созданный внутри create_app(),
+    остальные загружаются отдельно, каждая со своей долей потоков.
+    """
+    replicas = [Replica(0, get_default_llama_proxy(), thread_slices[0])]
+    for index, n_threads in enumerate(thread_slices[1:], start=1):
+        settings = replica_model_settings(model_settings, n_threads)
+        print(f"Загрузка реплики {index} (n_threads={n_threads})")
+        replicas.append(Replica(index, LlamaProxy(models=[settings]), n_threads))
+    return ReplicaPool(replicas)
+
+
+def install_replica_pool(app: FastAPI, pool: ReplicaPool):
+    """Подключает пул реплик к приложению и добавляет маршрут статистики"""
+    install_llama_proxy(app, pool.get_llama_proxy)
+
+    router = APIRouter()
+
+    @router.get("/extras/replicas", summary="Replica stats", tags=["Extras"])
+    async def get_replica_stats():
+        return pool.stats()
+
+    app.include_router(router)
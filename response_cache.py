@@ -0,0 +1,251 @@
+"""
+Кэш ответов для детерминированных запросов (temperature=0)
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import llama_cpp.server.app as llama_server_app
+from fastapi import APIRouter, FastAPI
+from llama_cpp.server.types import CreateChatCompletionRequest, CreateCompletionRequest
+from pydantic import ValidationError
+
+from env_settings import read_bool, read_int
+from server_hooks import buffer_request_body
+
+MB = 1024 * 1024
+
+# Пути и модели запросов, ответы на которые можно кэшировать
+_CACHEABLE_PATHS = {
+    "/v1/completions": CreateCompletionRequest,
+    "/v1/chat/completions": CreateChatCompletionRequest,
+}
+
+
+def read_response_cache_settings() -> Optional[dict]:
+    """Читает настройки RESPONSE_CACHE_*; возвращает None, если кэш выключен"""
+    if not read_bool("RESPONSE_CACHE"):
+        return None
+    return {
+        "ttl": read_int("RESPONSE_CACHE_TTL", 3600),
+        "capacity_bytes": read_int("RESPONSE_CACHE_MB", 256) * MB,
+    }
+
+
+def make_cache_key(
+    path: str, body: bytes, chat_format: Optional[str]
+) -> Optional[str]:
+    """Возвращает ключ кэша или None, если запрос недетерминирован
+
+    Тело запроса проходит через ту же pydantic-модель, что и в llama_cpp,
+    поэтому явно переданные значения по умолчанию и их отсутствие дают
+    одинаковый ключ.
+    """
+    request_model = _CACHEABLE_PATHS.get(path)
+    if request_model is None:
+        return None
+    try:
+        request = request_model.model_validate_json(body)
+    except ValidationError:
+        return None
+    if request.temperature != 0:
+        return None
+
+    normalized = request.model_dump(mode="json", exclude={"user"})
+    normalized["path"] = path
+    normalized["chat_format"] = chat_format
+    payload = json.dumps(normalized, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """LRU-кэш готовых тел ответов с TTL и бюджетом по байтам"""
+
+    def __init__(self, ttl: int = 3600, capacity_bytes: int = 256 * MB):
+        self.ttl = ttl
+        self.capacity_bytes = capacity_bytes
+        self._entries: "OrderedDict[str, Tuple[float, str, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Tuple[str, bytes]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += len(entry[2])
+            return entry[1], entry[2]
+
+    def put(self, key: str, content_type: str, body: bytes):
+        if len(body) > self.capacity_bytes:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, content_type, body)
+            self._bytes += len(body)
+            while self._bytes > self.capacity_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry[2])
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "bytes_saved": self.bytes_saved,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "capacity_bytes": self.capacity_bytes,
+                "ttl": self.ttl,
+            }
+
+
+def stream_finished(body: bytes) -> bool:
+    """Дошел ли поток SSE до конца генерации
+
+    [DONE] отправляется и после прерывания потока (interrupt_requests),
+    поэтому законченным считается только поток с чанком, у которого
+    finish_reason не null.
+    """
+    if b"data: [DONE]" not in body:
+        return False
+    for line in body.splitlines():
+        if not line.startswith(b"data: {"):
+            continue
+        try:
+            chunk = json.loads(line[len(b"data: "):])
+        except ValueError:
+            continue
+        for choice in chunk.get("choices") or []:
+            if choice.get("finish_reason") is not None:
+                return True
+    return False
+
+
+def _is_authorized(scope) -> bool:
+    server_settings = llama_server_app._server_settings
+    if server_settings is None or server_settings.api_key is None:
+        return True
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            return value.decode("latin-1") == f"Bearer {server_settings.api_key}"
+    return False
+
+
+class ResponseCacheMiddleware:
+    """ASGI middleware, отдающее закэшированные ответы completions/chat
+
+    Потоковые ответы сохраняются как готовое тело SSE и при попадании
+    воспроизводятся тем же потоком событий. Ответ попадает в кэш только
+    со статусом 200, а потоковый - только если генерация дошла до finish_reason.
+    """
+
+    def __init__(self, app, cache: ResponseCache, chat_format: Optional[str] = None):
+        self.app = app
+        self.cache = cache
+        self.chat_format = chat_format
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or scope["method"] != "POST"
+            or scope["path"] not in _CACHEABLE_PATHS
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        # Тело читается целиком, а затем заново отдается приложению
+        body, replay_receive = await buffer_request_body(receive)
+
+        key = make_cache_key(scope["path"], body, self.chat_format)
+        if key is None:
+            await self.app(scope, replay_receive, send)
+            return
+
+        cached = self.cache.get(key) if _is_authorized(scope) else None
+        if cached is not None:
+            content_type, cached_body = cached
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 200,
+                    "headers": [
+                        (b"content-type", content_type.encode("latin-1")),
+                        (b"content-length", str(len(cached_body)).encode("latin-1")),
+                        (b"x-response-cache", b"hit"),
+                    ],
+                }
+            )
+            await send({"type": "http.response.body", "body": cached_body})
+            return
+
+        status = None
+        content_type = ""
+        captured = []
+
+        async def capture_send(message):
+            nonlocal status, content_type
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                for name, value in message.get("headers", []):
+                    if name.lower() == b"content-type":
+                        content_type = value.decode("latin-1")
+            elif message["type"] == "http.response.body" and status == 200:
+                captured.append(message.get("body", b""))
+            await send(message)
+
+        await self.app(scope, replay_receive, capture_send)
+
+        if status != 200:
+            return
+        response_body = b"".join(captured)
+        if content_type.startswith("text/event-stream"):
+            if not stream_finished(response_body):
+                return
+            # Служебные ping-комментарии не нужны при воспроизведении
+            response_body = b"".join(
+                line
+                for line in response_body.splitlines(keepends=True)
+                if not line.startswith(b":")
+            )
+        self.cache.put(key, content_type, response_body)
+
+
+def install_response_cache(
+    app: FastAPI, cache: ResponseCache, chat_format: Optional[str] = None
+):
+    """Подключает кэш ответов к приложению и добавляет маршрут статистики"""
+    app.add_middleware(ResponseCacheMiddleware, cache=cache, chat_format=chat_format)
+
+    router = APIRouter()
+
+    @router.get(
+        "/extras/response-cache", summary="Response cache stats", tags=["Extras"]
+    )
+    async def get_response_cache_stats():
+        return cache.stats()
+
+    app.include_router(router)
@@ -0,0 +1,302 @@
+"""
+Генерация по JSON-схеме: кэш скомпилированных грамматик и именованные схемы
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+import llama_cpp.server.app as llama_server_app
+from fastapi import APIRouter, Depends, FastAPI, HTTPException
+from fastapi.responses import JSONResponse
+from llama_cpp.llama_grammar import json_schema_to_gbnf
+from starlette.concurrency import run_in_threadpool
+
+from env_settings import read_bool, read_int
+from server_hooks import buffer_request_body
+
+CHAT_PATH = "/v1/chat/completions"
+
+
+def read_grammar_settings() -> Optional[dict]:
+    """Читает GRAMMAR_CACHE, GRAMMAR_CACHE_SIZE и GRAMMAR_SCHEMAS; None, если кэш выключен"""
+    if not read_bool("GRAMMAR_CACHE"):
+        return None
+    schemas_path = os.getenv("GRAMMAR_SCHEMAS") or None
+    if schemas_path is not None and not os.path.exists(schemas_path):
+        raise FileNotFoundError(f"Файл схем не найден: {schemas_path}")
+    return {
+        "max_entries": read_int("GRAMMAR_CACHE_SIZE", 256),
+        "schemas_path": schemas_path,
+    }
+
+
+class SchemaError(ValueError):
+    """Некорректная схема или ссылка на незарегистрированную схему"""
+
+
+def _canonical(schema):
+    """Схема с отсортированными ключами, кроме порядка полей в properties"""
+    if isinstance(schema, list):
+        return [_canonical(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    result = {}
+    for key in sorted(schema):
+        value = schema[key]
+        if key == "properties" and isinstance(value, dict):
+            # Порядок properties задает порядок полей в грамматике
+            result[key] = [[name, _canonical(field)] for name, field in value.items()]
+        else:
+            result[key] = _canonical(value)
+    return result
+
+
+def canonical_schema(schema) -> str:
+    """Каноническая строка схемы: перестановка ключей не меняет ее, кроме порядка properties"""
+    return json.dumps(_canonical(schema), separators=(",", ":"), ensure_ascii=False)
+
+
+def schema_key(schema) -> str:
+    return hashlib.blake2b(canonical_schema(schema).encode("utf-8"), digest_size=16).hexdigest()
+
+
+class GrammarCache:
+    """LRU грамматик GBNF, скомпилированных из JSON-схем, и именованные схемы
+
+    Ключ - хэш канонического JSON схемы, поэтому порядок ключей в запросе
+    не влияет на попадание; порядок полей в properties сохраняется, так
+    как от него зависит порядок полей в ответе. Грамматики именованных схем хранятся вне LRU
+    и не вытесняются.
+    """
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._grammars: "OrderedDict[str, str]" = OrderedDict()
+        self._named: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.compile_seconds = 0.0
+
+    def _compile(self, schema) -> str:
+        started = time.perf_counter()
+        try:
+            # Так же, как _grammar_for_response_format в llama_cpp
+            grammar = json_schema_to_gbnf(json.dumps(schema))
+        except Exception as e:
+            raise SchemaError(f"Invalid JSON schema: {e}")
+        with self._lock:
+            self.compile_seconds += time.perf_counter() - started
+        return grammar
+
+    def lookup(self, schema) -> Optional[str]:
+        """Грамматика из кэша без компиляции; учитывает попадание"""
+        key = schema_key(schema)
+        with self._lock:
+            grammar = self._grammars.get(key)
+            if grammar is not None:
+                self._grammars.move_to_end(key)
+                self.hits += 1
+            return grammar
+
+    def get(self, schema) -> str:
+        """Грамматика для схемы; при промахе компилируется и кладется в кэш"""
+        grammar = self.lookup(schema)
+        if grammar is not None:
+            return grammar
+        grammar = self._compile(schema)
+        with self._lock:
+            self.misses += 1
+            self._grammars[schema_key(schema)] = grammar
+            while len(self._grammars) > self.max_entries:
+                self._grammars.popitem(last=False)
+        return grammar
+
+    def register(self, name: str, schema) -> dict:
+        """Регистрирует схему под именем; грамматика компилируется сразу"""
+        entry = {"schema": schema, "key": schema_key(schema), "grammar": self._compile(schema)}
+        with self._lock:
+            self._named[name] = entry
+        return {"name": name, "key": entry["key"]}
+
+    def unregister(self, name: str) -> bool:
+        with self._lock:
+            return self._named.pop(name, None) is not None
+
+    def named(self, name: str) -> str:
+        with self._lock:
+            entry = self._named.get(name)
+            if entry is not None:
+                self.hits += 1
+                return entry["grammar"]
+        raise SchemaError(f"Unknown schema: {name}")
+
+    def load_file(self, path: str) -> int:
+        """Регистрирует схемы из JSON-файла вида {"имя": схема, ...}"""
+        with open(path, encoding="utf-8") as f:
+            schemas = json.load(f)
+        if not isinstance(schemas, dict):
+            raise ValueError(f"Файл схем должен содержать объект имя -> схема: {path}")
+        for name, schema in schemas.items():
+            self.register(name, schema)
+        return len(schemas)
+
+    def render(self):
+        """Строки в формате Prometheus для /metrics"""
+        yield "# HELP llama_grammar_cache_hits_total Schema grammar cache hits"
+        yield "# TYPE llama_grammar_cache_hits_total counter"
+        yield f"llama_grammar_cache_hits_total {self.hits}"
+        yield "# HELP llama_grammar_cache_misses_total Schema grammar cache misses"
+        yield "# TYPE llama_grammar_cache_misses_total counter"
+        yield f"llama_grammar_cache_misses_total {self.misses}"
+        yield "# HELP llama_grammar_compile_seconds_total Time spent compiling JSON schemas to grammars"
+        yield "# TYPE llama_grammar_compile_seconds_total counter"
+        yield f"llama_grammar_compile_seconds_total {self.compile_seconds}"
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._grammars),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "compile_seconds": round(self.compile_seconds, 4),
+                "schemas": {name: entry["key"] for name, entry in self._named.items()},
+            }
+
+
+def grammar_source(response_format) -> Optional[tuple]:
+    """Что нужно для грамматики: ("schema", схема), ("name", имя) или None
+
+    Поддерживаются {"type": "json_object", "schema": ...} в стиле llama_cpp
+    и {"type": "json_schema", "json_schema": {"name": ..., "schema": ...}} в
+    стиле OpenAI; json_schema без schema ссылается на зарегистрированную схему.
+    """
+    if not isinstance(response_format, dict):
+        return None
+    kind = response_format.get("type")
+    if kind == "json_object" and "schema" in response_format:
+        return ("schema", response_format["schema"])
+    if kind == "json_schema":
+        json_schema = response_format.get("json_schema") or {}
+        if "schema" in json_schema:
+            return ("schema", json_schema["schema"])
+        if "name" in json_schema:
+            return ("name", json_schema["name"])
+        raise SchemaError("json_schema must contain schema or name")
+    return None
+
+
+class SchemaGrammarMiddleware:
+    """ASGI middleware, заменяющее response_format со схемой на готовую грамматику
+
+    chatml-обработчик llama_cpp строит грамматику из схемы заново на каждый
+    запрос. Здесь response_format убирается из тела, а в поле grammar
+    подставляется GBNF из кэша, который llama_cpp только передает сэмплеру.
+    """
+
+    def __init__(self, app, cache: GrammarCache):
+        self.app = app
+        self.cache = cache
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != CHAT_PATH or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        raw_body, replay_receive = await buffer_request_body(receive)
+        try:
+            body = json.loads(raw_body)
+            source = grammar_source(body.get("response_format"))
+        except SchemaError as e:
+            await self._reject(scope, receive, send, str(e))
+            return
+        except (ValueError, AttributeError):
+            source = None
+        if source is None:
+            await self.app(scope, replay_receive, send)
+            return
+
+        kind, value = source
+        try:
+            if kind == "name":
+                grammar = self.cache.named(value)
+            else:
+                grammar = self.cache.lookup(value)
+                if grammar is None:
+                    grammar = await run_in_threadpool(self.cache.get, value)
+        except SchemaError as e:
+            await self._reject(scope, receive, send, str(e))
+            return
+
+        del body["response_format"]
+        body["grammar"] = grammar
+        new_body = json.dumps(body).encode("utf-8")
+        scope = dict(scope)
+        scope["headers"] = [
+            (name, value) for name, value in scope["headers"] if name != b"content-length"
+        ] + [(b"content-length", str(len(new_body)).encode("latin-1"))]
+
+        body_sent = False
+
+        async def rewritten_receive():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": new_body, "more_body": False}
+            return await receive()
+
+        await self.app(scope, rewritten_receive, send)
+
+    async def _reject(self, scope, receive, send, message: str):
+        response = JSONResponse(
+            status_code=400,
+            content={
+                "error": {
+                    "message": message,
+                    "type": "invalid_request_error",
+                    "code": 400,
+                }
+            },
+        )
+        await response(scope, receive, send)
+
+
+def install_grammar_cache(app: FastAPI, max_entries: int, schemas_path: Optional[str]) -> GrammarCache:
+    """Подключает кэш грамматик и маршруты регистрации именованных схем"""
+    cache = GrammarCache(max_entries)
+    if schemas_path is not None:
+        n_schemas = cache.load_file(schemas_path)
+        print(f"Зарегистрировано схем из {schemas_path}: {n_schemas}")
+    app.add_middleware(SchemaGrammarMiddleware, cache=cache)
+
+    router = APIRouter(
+        prefix="/extras/schemas",
+        tags=["Extras"],
+        dependencies=[Depends(llama_server_app.authenticate)],
+    )
+
+    @router.get("", summary="Grammar cache stats and registered schemas")
+    async def get_grammar_cache_stats():
+        return cache.stats()
+
+    @router.put("/{name}", summary="Register a named JSON schema")
+    async def register_schema(name: str, schema: dict):
+        try:
+            return await run_in_threadpool(cache.register, name, schema)
+        except SchemaError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    @router.delete("/{name}", summary="Remove a named JSON schema")
+    async def delete_schema(name: str):
+        if not cache.unregister(name):
+            raise HTTPException(status_code=404, detail=f"Schema {name} not found")
+        return {"name": name, "deleted": True}
+
+    app.include_router(router)
+    return cache
@@ -0,0 +1,63 @@
+"""
+Точки расширения сервера llama_cpp.server
+"""
+
+import llama_cpp.server.app as llama_server_app
+from fastapi import APIRouter, FastAPI
+
+# Исходная зависимость, которую маршруты llama_cpp захватили через Depends()
+_original_get_llama_proxy = llama_server_app.get_llama_proxy
+
+
+def install_llama_proxy(app: FastAPI, get_llama_proxy):
+    """Подменяет источник LlamaProxy для всех маршрутов приложения
+
+    Маршруты completions/chat вызывают get_llama_proxy через глобальное имя
+    модуля llama_cpp.server.app, а embeddings/models/tokenize получают его
+    через Depends(), поэтому подменять нужно в обоих местах.
+    """
+    llama_server_app.get_llama_proxy = get_llama_proxy
+    app.dependency_overrides[_original_get_llama_proxy] = get_llama_proxy
+
+
+def get_default_llama_proxy():
+    """Возвращает LlamaProxy, созданный внутри create_app()"""
+    return llama_server_app._llama_proxy
+
+
+def override_routes(app: FastAPI, router: APIRouter):
+    """Подключает маршруты так, чтобы они обрабатывались раньше маршрутов llama_cpp
+
+    Starlette выбирает первый подходящий маршрут, поэтому новые маршруты
+    переносятся в начало списка, перекрывая одноименные пути create_app().
+    """
+    n_routes = len(app.router.routes)
+    app.include_router(router)
+    added = app.router.routes[n_routes:]
+    del app.router.routes[n_routes:]
+    app.router.routes[0:0] = added
+
+
+async def buffer_request_body(receive):
+    """Читает тело запроса целиком и возвращает его вместе с receive для повторной отдачи
+
+    Нужно ASGI middleware, которым тело требуется до вызова приложения.
+    """
+    chunks = []
+    more_body = True
+    while more_body:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        more_body = message.get("more_body", False)
+    body = b"".join(chunks)
+
+    body_sent = False
+
+    async def replay_receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return body, replay_receive
@@ -0,0 +1,416 @@
+"""
+Сохранение и восстановление KV-состояния llama между репликами диалога
+по идентификатору сессии
+"""
+
+import contextvars
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Sequence
+
+import llama_cpp
+import numpy as np
+from fastapi import APIRouter, FastAPI, HTTPException
+from llama_cpp.llama_cache import BaseLlamaCache
+
+from env_settings import read_bool, read_int
+
+MB = 1024 * 1024
+
+DEFAULT_SESSION_DIR = os.path.join(
+    os.path.expanduser("~"), ".cache", "llama-fastapi", "sessions"
+)
+
+SESSION_HEADER = b"x-session-id"
+SESSION_PATHS = {"/v1/completions", "/v1/chat/completions"}
+
+# Запись хранилища: заголовок, id сессии, токены, строка логитов, состояние llama.
+# Надгробие (удаление сессии) содержит только заголовок и id. Seed знаковый:
+# llama_cpp допускает отрицательный seed (-1 - случайный).
+_RECORD = struct.Struct("<4sHIIqQd")
+_STATE_MAGIC = b"KVS1"
+_TOMBSTONE_MAGIC = b"KVT1"
+
+
+def read_session_settings() -> Optional[dict]:
+    """Читает настройки SESSIONS/SESSION_*; возвращает None, если сессии выключены"""
+    if not read_bool("SESSIONS"):
+        return None
+    return {
+        "directory": os.getenv("SESSION_DIR") or DEFAULT_SESSION_DIR,
+        "capacity_bytes": read_int("SESSION_STORE_MB", 4096) * MB,
+        "ttl": read_int("SESSION_TTL", 3600),
+    }
+
+
+class _Turn:
+    """Сведения о текущем запросе сессии, заполняемые из потока генерации"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.restored_tokens: Optional[int] = None
+
+
+# Устанавливается SessionMiddleware и наследуется потоками генерации
+_current_turn: contextvars.ContextVar[Optional[_Turn]] = contextvars.ContextVar(
+    "session_turn", default=None
+)
+
+
+class _Entry:
+    __slots__ = ("offset", "size", "n_tokens", "saved_at")
+
+    def __init__(self, offset: int, size: int, n_tokens: int, saved_at: float):
+        self.offset = offset
+        self.size = size
+        self.n_tokens = n_tokens
+        self.saved_at = saved_at
+
+
+class SessionStore:
+    """Хранилище состояний сессий в одном файле, читаемом через mmap
+
+    Новые состояния дописываются в конец файла, индекс сессий хранится в
+    памяти и восстанавливается чтением файла при запуске, поэтому сессии
+    переживают перезапуск сервера. Сессии старше ttl секунд с последнего
+    сохранения удаляются, при превышении capacity_bytes вытесняются давно
+    не использовавшиеся. Когда устаревшие записи занимают больше половины
+    файла, живые записи переписываются в новый файл (компактификация).
+    """
+
+    def __init__(self, directory: str, capacity_bytes: int = (4 << 30), ttl: float = 3600):
+        self.capacity_bytes = capacity_bytes
+        self.ttl = ttl
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "sessions.kv")
+        self._lock = threading.Lock()
+        self._index: "OrderedDict[str, _Entry]" = OrderedDict()
+        self._live_bytes = 0
+        self._file = open(self.path, "a+b")
+        self._file_size = self._file.seek(0, os.SEEK_END)
+        self._map: Optional[mmap.mmap] = None
+
+        self.saves = 0
+        self.restores = 0
+        self.restored_tokens = 0
+        self.expirations = 0
+        self.evictions = 0
+        self.compactions = 0
+
+        with self._lock:
+            self._load_index()
+            self._expire()
+            self._maybe_compact()
+
+    def _mapped(self, end: int) -> mmap.mmap:
+        if self._map is None or len(self._map) < end:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _load_index(self):
+        """Восстанавливает индекс по записям файла; хвост оборванной записи отбрасывается"""
+        if self._file_size == 0:
+            return
+        data = self._mapped(self._file_size)
+        offset = 0
+        while offset + _RECORD.size <= self._file_size:
+            magic, id_len, n_tokens, n_vocab, _, state_size, saved_at = _RECORD.unpack_from(data, offset)
+            if magic not in (_STATE_MAGIC, _TOMBSTONE_MAGIC):
+                break
+            size = _RECORD.size + id_len
+            if magic == _STATE_MAGIC:
+                size += n_tokens * 4 + n_vocab * 4 + state_size
+            if offset + size > self._file_size:
+                break
+            start = offset + _RECORD.size
+            session_id = bytes(data[start:start + id_len]).decode("utf-8")
+            self._drop(session_id)
+            if magic == _STATE_MAGIC:
+                self._index[session_id] = _Entry(offset, size, n_tokens, saved_at)
+                self._live_bytes += size
+            offset += size
+
+        if offset < self._file_size:
+            print(f"Хранилище сессий: отброшен поврежденный хвост {self._file_size - offset} байт")
+            self._map.close()
+            self._map = None
+            self._file.truncate(offset)
+            self._file_size = offset
+
+    def _drop(self, session_id: str) -> bool:
+        entry = self._index.pop(session_id, None)
+        if entry is None:
+            return False
+        self._live_bytes -= entry.size
+        return True
+
+    def _append(self, record: bytes) -> int:
+        offset = self._file_size
+        self._file.write(record)
+        self._file.flush()
+        self._file_size += len(record)
+        return offset
+
+    def _tombstone(self, session_id: str):
+        encoded = session_id.encode("utf-8")
+        self._append(_RECORD.pack(_TOMBSTONE_MAGIC, len(encoded), 0, 0, 0, 0, time.time()) + encoded)
+
+    def _expire(self):
+        deadline = time.time() - self.ttl
+        for session_id in [s for s, e in self._index.items() if e.saved_at < deadline]:
+            self._drop(session_id)
+            self._tombstone(session_id)
+            self.expirations += 1
+
+    def _maybe_compact(self):
+        if self._file_size - self._live_bytes > max(self._live_bytes, 1 * MB):
+            self._compact()
+
+    def _compact(self):
+        data = self._mapped(self._file_size)
+        tmp_path = self.path + ".tmp"
+        offset = 0
+        with open(tmp_path, "wb") as f:
+            for entry in self._index.values():
+                f.write(data[entry.offset:entry.offset + entry.size])
+                entry.offset = offset
+                offset += entry.size
+            f.flush()
+            os.fsync(f.fileno())
+        self._map.close()
+        self._map = None
+        self._file.close()
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a+b")
+        self._file_size = offset
+        self.compactions += 1
+
+    def save(self, session_id: str, state: llama_cpp.LlamaState):
+        """Сохраняет состояние сессии; от логитов остается только последняя строка"""
+        encoded = session_id.encode("utf-8")
+        n_tokens = state.n_tokens
+        input_ids = np.ascontiguousarray(state.input_ids[:n_tokens], dtype=np.intc)
+        if len(state.scores):
+            last_scores = np.ascontiguousarray(state.scores[-1], dtype=np.single)
+        else:
+            last_scores = np.zeros(0, dtype=np.single)
+        llama_state = state.llama_state[:state.llama_state_size]
+        record = b"".join((
+            _RECORD.pack(
+                _STATE_MAGIC,
+                len(encoded),
+                n_tokens,
+                len(last_scores),
+                state.seed,
+                len(llama_state),
+                time.time(),
+            ),
+            encoded,
+            input_ids.tobytes(),
+            last_scores.tobytes(),
+            llama_state,
+        ))
+        with self._lock:
+            self._drop(session_id)
+            offset = self._append(record)
+            self._index[session_id] = _Entry(offset, len(record), n_tokens, time.time())
+            self._live_bytes += len(record)
+            self.saves += 1
+
+            self._expire()
+            while self._live_bytes > self.capacity_bytes and len(self._index) > 1:
+                old_id = next(iter(self._index))
+                self._drop(old_id)
+                self._tombstone(old_id)
+                self.evictions += 1
+            self._maybe_compact()
+
+    def load(self, session_id: str, n_ctx: int) -> Optional[llama_cpp.LlamaState]:
+        """Возвращает состояние сессии или None, если сессии нет или она устарела"""
+        with self._lock:
+            entry = self._index.get(session_id)
+            if entry is None:
+                return None
+            if entry.saved_at < time.time() - self.ttl:
+                self._drop(session_id)
+                self._tombstone(session_id)
+                self.expirations += 1
+                return None
+            if entry.n_tokens > n_ctx:
+                return None
+            self._index.move_to_end(session_id)
+
+            data = self._mapped(entry.offset + entry.size)
+            _, id_len, n_tokens, n_vocab, seed, state_size, _ = _RECORD.unpack_from(data, entry.offset)
+            start = entry.offset + _RECORD.size + id_len
+            input_ids = np.zeros(n_ctx, dtype=np.intc)
+            input_ids[:n_tokens] = np.frombuffer(data, dtype=np.intc, count=n_tokens, offset=start)
+            start += n_tokens * 4
+            scores = np.frombuffer(data, dtype=np.single, count=n_vocab, offset=start).reshape(1, n_vocab).copy()
+            start += n_vocab * 4
+            llama_state = bytes(data[start:start + state_size])
+            self.restores += 1
+
+        return llama_cpp.LlamaState(
+            input_ids=input_ids,
+            scores=scores,
+            n_tokens=n_tokens,
+            llama_state=llama_state,
+            llama_state_size=state_size,
+            seed=seed,
+        )
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            if not self._drop(session_id):
+                return False
+            self._tombstone(session_id)
+            self._maybe_compact()
+            return True
+
+    def record_restored(self, n_tokens: int):
+        with self._lock:
+            self.restored_tokens += n_tokens
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            self._file.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self._index),
+                "live_bytes": self._live_bytes,
+                "file_bytes": self._file_size,
+                "capacity_bytes": self.capacity_bytes,
+                "ttl": self.ttl,
+                "saves": self.saves,
+                "restores": self.restores,
+                "restored_tokens": self.restored_tokens,
+                "expirations": self.expirations,
+                "evictions": self.evictions,
+                "compactions": self.compactions,
+            }
+
+
+class SessionCache(BaseLlamaCache):
+    """Кэш llama, отдающий состояние сессии текущего запроса
+
+    Подключается через Llama.set_cache() поверх другого кэша (например,
+    кэша префиксов), которому передаются запросы без сессии. Llama
+    восстанавливает состояние сессии, если его общий префикс с промптом
+    длиннее уже вычисленного, и вычисляет только новое сообщение; после
+    ответа состояние сохраняется обратно в сессию.
+    """
+
+    def __init__(self, store: SessionStore, n_ctx: int, inner: Optional[BaseLlamaCache] = None):
+        super().__init__(store.capacity_bytes)
+        self.store = store
+        self.n_ctx = n_ctx
+        self.inner = inner
+
+    @property
+    def cache_size(self) -> int:
+        return self.inner.cache_size if self.inner is not None else 0
+
+    def __getitem__(self, key: Sequence[int]) -> llama_cpp.LlamaState:
+        turn = _current_turn.get()
+        if turn is not None:
+            state = self.store.load(turn.session_id, self.n_ctx)
+            if state is not None:
+                n_common = llama_cpp.Llama.longest_token_prefix(
+                    state.input_ids[:state.n_tokens].tolist(), key
+                )
+                if n_common > 0:
+                    turn.restored_tokens = n_common
+                    self.store.record_restored(n_common)
+                    return state
+            turn.restored_tokens = 0
+        if self.inner is None:
+            raise KeyError("Key not found")
+        return self.inner[key]
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        return self.inner is not None and key in self.inner
+
+    def __setitem__(self, key: Sequence[int], value: llama_cpp.LlamaState):
+        turn = _current_turn.get()
+        if turn is not None:
+            self.store.save(turn.session_id, value)
+        if self.inner is not None:
+            self.inner[key] = value
+
+
+def request_session_id(scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == SESSION_HEADER:
+            return value.decode("latin-1").strip() or None
+    return None
+
+
+class SessionMiddleware:
+    """ASGI middleware, связывающее запрос с сессией из заголовка X-Session-Id
+
+    Число восстановленных из сессии токенов возвращается в заголовке
+    X-Session-Tokens-Saved, если оно известно к началу ответа, и выводится в лог.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in SESSION_PATHS:
+            await self.app(scope, receive, send)
+            return
+        session_id = request_session_id(scope)
+        if session_id is None:
+            await self.app(scope, receive, send)
+            return
+
+        turn = _Turn(session_id)
+
+        async def send_with_session(message):
+            if message["type"] == "http.response.start" and turn.restored_tokens is not None:
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"x-session-tokens-saved", str(turn.restored_tokens).encode("latin-1"))
+                ]
+            await send(message)
+
+        token = _current_turn.set(turn)
+        try:
+            await self.app(scope, receive, send_with_session)
+        finally:
+            _current_turn.reset(token)
+        if turn.restored_tokens is not None:
+            print(f"Сессия {session_id}: восстановлено {turn.restored_tokens} токенов")
+
+
+def install_sessions(app: FastAPI, store: SessionStore, llamas):
+    """Подключает сессии к моделям поверх их кэшей и добавляет маршруты управления"""
+    for llama in llamas:
+        llama.set_cache(SessionCache(store, llama.n_ctx(), inner=llama.cache))
+    app.add_middleware(SessionMiddleware)
+
+    router = APIRouter()
+
+    @router.get("/extras/sessions", summary="Session store stats", tags=["Extras"])
+    async def get_session_stats():
+        return store.stats()
+
+    @router.delete("/extras/sessions/{session_id}", summary="Delete session", tags=["Extras"])
+    async def delete_session(session_id: str):
+        if not store.delete(session_id):
+            raise HTTPException(status_code=404, detail=f"Session '{session_id}' not found")
+        return {"deleted": session_id}
+
+    app.include_router(router)
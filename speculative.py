@@ -0,0 +1,207 @@
+"""
+Спекулятивное декодирование: черновая модель или prompt lookup,
+учет доли принятых черновых токенов
+"""
+
+import os
+import threading
+import time
+from typing import List, Optional
+
+import llama_cpp
+import numpy as np
+from fastapi import APIRouter, FastAPI
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+from env_settings import read_bool, read_int
+
+# Значение ModelSettings.draft_model, при котором llama_cpp подключает prompt lookup
+PROMPT_LOOKUP = "prompt-lookup-decoding"
+
+
+def read_speculative_settings() -> Optional[dict]:
+    """Читает DRAFT_MODEL_PATH, PROMPT_LOOKUP и DRAFT_TOKENS; None, если режим выключен"""
+    draft_model_path = os.getenv("DRAFT_MODEL_PATH") or None
+    if draft_model_path is None and not read_bool("PROMPT_LOOKUP"):
+        return None
+    if draft_model_path is not None and not os.path.exists(draft_model_path):
+        raise FileNotFoundError(f"Файл черновой модели не найден: {draft_model_path}")
+    return {
+        "draft_model_path": draft_model_path,
+        "draft_tokens": read_int("DRAFT_TOKENS", 8 if draft_model_path else 10),
+    }
+
+
+class SpeculativeStats:
+    """Счетчики предложенных и принятых черновых токенов
+
+    Обновляются из потоков генерации, поэтому защищены блокировкой.
+    Сводка выводится в лог не чаще раза в log_interval секунд.
+    """
+
+    def __init__(self, mode: str, draft_tokens: int, log_interval: float = 30.0):
+        self.mode = mode
+        self.draft_tokens = draft_tokens
+        self.log_interval = log_interval
+        self.proposals = 0
+        self.drafted = 0
+        self.accepted = 0
+        self._lock = threading.Lock()
+        self._last_log = time.monotonic()
+
+    def record(self, drafted: int, accepted: int):
+        with self._lock:
+            self.proposals += 1
+            self.drafted += drafted
+            self.accepted += accepted
+            now = time.monotonic()
+            if now - self._last_log < self.log_interval:
+                return
+            self._last_log = now
+        print(
+            f"Спекулятивное декодирование ({self.mode}): принято {self.accepted} "
+            f"из {self.drafted} черновых токенов ({self.acceptance_rate():.1%})"
+        )
+
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.drafted if self.drafted else 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "draft_tokens": self.draft_tokens,
+                "proposals": self.proposals,
+                "drafted_tokens": self.drafted,
+                "accepted_tokens": self.accepted,
+                "acceptance_rate": round(self.acceptance_rate(), 4),
+                "accepted_per_proposal": round(self.accepted / max(self.proposals, 1), 2),
+            }
+
+    def render(self):
+        """Строки в формате Prometheus для /metrics"""
+        yield "# HELP llama_speculative_drafted_tokens_total Draft tokens proposed for verification"
+        yield "# TYPE llama_speculative_drafted_tokens_total counter"
+        yield f"llama_speculative_drafted_tokens_total {self.drafted}"
+        yield "# HELP llama_speculative_accepted_tokens_total Draft tokens accepted by the main model"
+        yield "# TYPE llama_speculative_accepted_tokens_total counter"
+        yield f"llama_speculative_accepted_tokens_total {self.accepted}"
+        yield "# HELP llama_speculative_acceptance_rate Share of accepted draft tokens"
+        yield "# TYPE llama_speculative_acceptance_rate gauge"
+        yield f"llama_speculative_acceptance_rate {self.acceptance_rate()}"
+
+
+class DraftLlamaModel(LlamaDraftModel):
+    """Черновая модель: небольшая Llama с тем же словарем, жадно предлагающая токены
+
+    KV-кэш черновой модели переиспользуется по общему префиксу с входом,
+    поэтому на каждом шаге вычисляются только новые токены.
+    """
+
+    def __init__(self, model_path: str, n_ctx: int, n_threads: int, num_pred_tokens: int):
+        self.llama = llama_cpp.Llama(
+            model_path=model_path,
+            n_ctx=n_ctx,
+            n_threads=n_threads,
+            n_threads_batch=n_threads,
+            verbose=False,
+        )
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, /, **kwargs):
+        llama = self.llama
+        n_input = len(input_ids)
+        n_predict = min(self.num_pred_tokens, llama.n_ctx() - n_input)
+        if n_predict <= 0:
+            return np.array([], dtype=np.intc)
+
+        # Общий префикс с уже вычисленными токенами; последний токен
+        # вычисляется заново, чтобы получить свежие логиты
+        limit = min(llama.n_tokens, n_input - 1)
+        mismatch = np.nonzero(llama.input_ids[:limit] != input_ids[:limit])[0]
+        llama.n_tokens = int(mismatch[0]) if len(mismatch) else limit
+        llama.eval(input_ids[llama.n_tokens:].tolist())
+
+        eos = llama.token_eos()
+        drafts: List[int] = []
+        while True:
+            logits = np.ctypeslib.as_array(
+                llama._ctx.get_logits_ith(-1), shape=(llama.n_vocab(),)
+            )
+            token = int(np.argmax(logits))
+            drafts.append(token)
+            if token == eos or len(drafts) >= n_predict:
+                break
+            llama.eval([token])
+        return np.array(drafts, dtype=np.intc)
+
+    def close(self):
+        self.llama.close()
+
+
+class TrackedDraftModel(LlamaDraftModel):
+    """Обертка черновой модели, считающая принятые токены
+
+    Llama.generate() вызывает черновую модель после каждой проверки.
+    Если предыдущее предложение сделано для входа длины n, а новый вход
+    продолжает его и имеет длину m, то основная модель приняла m - n - 1
+    черновых токенов (плюс один собственный токен).
+    """
+
+    def __init__(self, draft: LlamaDraftModel, stats: SpeculativeStats):
+        self.draft = draft
+        self.stats = stats
+        self._pending = None
+
+    def __call__(self, input_ids, /, **kwargs):
+        n_input = len(input_ids)
+        if self._pending is not None:
+            start, drafted, last_token = self._pending
+            if n_input > start and input_ids[start - 1] == last_token:
+                self.stats.record(drafted, min(n_input - start - 1, drafted))
+        drafts = self.draft(input_ids, **kwargs)
+        self._pending = (n_input, len(drafts), input_ids[n_input - 1]) if len(drafts) else None
+        return drafts
+
+
+def create_draft_model(llama: llama_cpp.Llama, draft_model_path: Optional[str], draft_tokens: int) -> LlamaDraftModel:
+    """Создает черновую модель для экземпляра основной модели"""
+    if draft_model_path is None:
+        return LlamaPromptLookupDecoding(num_pred_tokens=draft_tokens)
+
+    draft = DraftLlamaModel(draft_model_path, llama.n_ctx(), llama.n_threads, draft_tokens)
+    if draft.llama.n_vocab() != llama.n_vocab():
+        draft.close()
+        raise ValueError(
+            f"Словарь черновой модели ({draft.llama.n_vocab()}) не совпадает "
+            f"со словарем основной модели ({llama.n_vocab()})"
+        )
+    return draft
+
+
+def install_speculative_decoding(
+    app: FastAPI,
+    llamas: List[llama_cpp.Llama],
+    draft_model_path: Optional[str],
+    draft_tokens: int,
+) -> SpeculativeStats:
+    """Подключает черновые модели к экземплярам основной модели и маршрут статистики
+
+    Экземпляры должны быть загружены с draft_model в ModelSettings, чтобы
+    llama_cpp сохранял логиты всех позиций для проверки черновика.
+    """
+    mode = "draft-model" if draft_model_path else "prompt-lookup"
+    stats = SpeculativeStats(mode, draft_tokens)
+    for llama in llamas:
+        llama.draft_model = TrackedDraftModel(
+            create_draft_model(llama, draft_model_path, draft_tokens), stats
+        )
+
+    router = APIRouter()
+
+    @router.get("/extras/speculative", summary="Speculative decoding stats", tags=["Extras"])
+    async def get_speculative_stats():
+        return stats.snapshot()
+
+    app.include_router(router)
+    return stats
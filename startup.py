@@ -0,0 +1,173 @@
+"""
+Быстрый старт: порт открывается сразу, модель загружается в фоне,
+готовность сообщается через /health/live и /health/ready
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from env_settings import read_bool, read_int
+
+MB = 1024 * 1024
+
+
+def read_startup_settings() -> dict:
+    """Читает настройки загрузки модели и прогрева"""
+    return {
+        "use_mlock": read_bool("MLOCK"),
+        "prefetch": read_bool("PREFETCH_MODEL"),
+        "warmup_prompt": os.getenv("WARMUP_PROMPT", "Hello"),
+        "warmup_tokens": read_int("WARMUP_TOKENS", 4),
+    }
+
+
+def prefetch_model_file(model_path: str, chunk_size: int = 16 * MB) -> int:
+    """Последовательно читает файл модели, чтобы его страницы попали в page cache
+
+    Модель затем отображается через mmap без случайных промахов по диску.
+    Возвращает число прочитанных байт.
+    """
+    total = 0
+    with open(model_path, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        while True:
+            n = f.readinto(view)
+            if not n:
+                break
+            total += n
+    return total
+
+
+def warmup_llama(llama, prompt: str, max_tokens: int):
+    """Прогоняет короткую генерацию, чтобы первый запрос не платил за холодный старт"""
+    llama.create_completion(prompt, max_tokens=max_tokens, temperature=0.0)
+
+
+class StartupApp:
+    """ASGI-приложение, доступное сразу после открытия порта
+
+    Отвечает на /health/live и /health/ready в любой фазе, остальные
+    запросы до готовности получают 503 с Retry-After, а после готовности
+    передаются основному приложению. Если загрузка не удалась,
+    /health/live тоже возвращает 503.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.phase = "starting"
+        self.failed = False
+        self.error: Optional[str] = None
+        self.timings: Dict[str, float] = {}
+        self._started_at = time.perf_counter()
+
+    @contextlib.contextmanager
+    def track_phase(self, name: str):
+        """Отмечает фазу старта и выводит ее длительность"""
+        self.phase = name
+        print(f"Фаза старта: {name}")
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - started, 3)
+            print(f"Фаза {name} завершена за {self.timings[name]:.2f} с")
+
+    def set_ready(self, app):
+        self.app = app
+        self.phase = "ready"
+        self.timings["total"] = round(time.perf_counter() - self._started_at, 3)
+        print(f"Сервер готов за {self.timings['total']:.2f} с с момента запуска")
+
+    def set_failed(self, error: str):
+        self.failed = True
+        self.phase = "failed"
+        self.error = error
+
+    def status(self) -> dict:
+        status = {"phase": self.phase, "timings": self.timings}
+        if self.error is not None:
+            status["error"] = self.error
+        return status
+
+    async def _send_json(self, send, status_code: int, content: dict, headers=()):
+        body = json.dumps(content).encode("utf-8")
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status_code,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode("latin-1")),
+                    *headers,
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            # У приложения llama_cpp нет обработчиков lifespan
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+
+        if scope["type"] == "http" and scope["path"] == "/health/live":
+            await self._send_json(send, 503 if self.failed else 200, self.status())
+            return
+
+        if scope["type"] == "http" and scope["path"] == "/health/ready":
+            await self._send_json(send, 200 if self.app is not None else 503, self.status())
+            return
+
+        if self.app is None:
+            if scope["type"] == "http":
+                await self._send_json(
+                    send,
+                    503,
+                    {"error": {"message": "Model is loading", "type": "not_ready"}},
+                    headers=[(b"retry-after", b"5")],
+                )
+            return
+
+        await self.app(scope, receive, send)
+
+
+def start_in_background(
+    startup: StartupApp,
+    build_app: Callable[[StartupApp], object],
+    on_failure: Optional[Callable[[], None]] = None,
+):
+    """Строит основное приложение в фоновом потоке
+
+    При ошибке вызывается on_failure (например, остановка uvicorn);
+    код выхода определяет вызывающая сторона по startup.failed.
+    """
+
+    def run():
+        try:
+            startup.set_ready(build_app(startup))
+        except SystemExit:
+            # main() уже вывел причину ошибки
+            startup.set_failed("initialization failed")
+            if on_failure is not None:
+                on_failure()
+        except BaseException as e:
+            startup.set_failed(str(e) or type(e).__name__)
+            print(f"Ошибка при старте сервера: {startup.error}")
+            if on_failure is not None:
+                on_failure()
+
+    thread = threading.Thread(target=run, name="startup", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,370 @@
+"""
+Многопроцессный режим: супервизор запускает несколько рабочих процессов
+на одном порту, с общими через mmap весами и непересекающимися наборами CPU
+"""
+
+import glob
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+from typing import Callable, List, Optional
+
+from fastapi import APIRouter, FastAPI
+
+from cpu_tuning import list_physical_cores, split_cpu_sets
+from env_settings import read_int
+from metrics import process_rss_bytes
+
+# Быстрее этого рабочий процесс считается упавшим при старте
+CRASH_WINDOW = 10.0
+MAX_RESTART_DELAY = 30.0
+
+SUPERVISOR_STATE = "supervisor.json"
+
+
+def read_worker_count() -> int:
+    """Читает WORKERS; 1 - обычный однопроцессный запуск"""
+    return read_int("WORKERS", 1)
+
+
+def read_worker_settings() -> Optional[dict]:
+    """Настройки текущего рабочего процесса, переданные супервизором; None вне супервизора"""
+    index = os.getenv("WORKER_INDEX")
+    stats_dir = os.getenv("WORKER_STATS_DIR")
+    if index is None or not stats_dir:
+        return None
+    return {"index": int(index), "stats_dir": stats_dir}
+
+
+def create_listen_socket(host: str, port: int, reuse_port: bool) -> socket.socket:
+    """Создает TCP-сокет на host:port; listen() вызывает uvicorn"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def process_pss_bytes() -> Optional[int]:
+    """PSS процесса: общие страницы (веса в page cache) делятся между процессами"""
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def write_json_atomic(path: str, payload: dict):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(payload, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path: str) -> Optional[dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class WorkerSlot:
+    """Рабочий процесс супервизора: набор CPU, pid и число перезапусков"""
+
+    def __init__(self, index: int, cpus: List[int]):
+        self.index = index
+        self.cpus = cpus
+        self.pid: Optional[int] = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.crashes = 0
+
+    def state(self) -> dict:
+        return {
+            "index": self.index,
+            "pid": self.pid,
+            "cpus": self.cpus,
+            "restarts": self.restarts,
+            "started_at": self.started_at,
+        }
+
+
+class Supervisor:
+    """Запускает рабочие процессы через fork и перезапускает упавшие
+
+    При поддержке SO_REUSEPORT каждый рабочий процесс слушает собственный
+    сокет на общем порту и ядро распределяет соединения между ними;
+    супервизор только удерживает порт, не принимая соединений. Без
+    SO_REUSEPORT рабочие процессы наследуют один слушающий сокет.
+    Модель загружается в рабочих процессах через mmap, поэтому веса
+    находятся в page cache в одном экземпляре.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        cpu_sets: List[List[int]],
+        serve_worker: Callable[[List[socket.socket]], int],
+        stats_dir: str,
+    ):
+        self.host = host
+        self.port = port
+        self.serve_worker = serve_worker
+        self.stats_dir = stats_dir
+        self.slots = [WorkerSlot(i, cpus) for i, cpus in enumerate(cpu_sets)]
+        self.reuse_port = hasattr(socket, "SO_REUSEPORT")
+        self.stopping = False
+        self._socket: Optional[socket.socket] = None
+
+    def _write_state(self):
+        write_json_atomic(
+            os.path.join(self.stats_dir, SUPERVISOR_STATE),
+            {"pid": os.getpid(), "workers": [slot.state() for slot in self.slots]},
+        )
+
+    def _spawn(self, slot: WorkerSlot):
+        # Иначе буфер вывода супервизора повторится в рабочем процессе
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = self._run_worker(slot)
+            except BaseException as e:
+                print(f"Рабочий процесс {slot.index} завершился с ошибкой: {e}")
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(code)
+
+        slot.pid = pid
+        slot.started_at = time.time()
+        self._write_state()
+        print(f"Рабочий процесс {slot.index} запущен: pid={pid}, CPU {slot.cpus}")
+
+    def _run_worker(self, slot: WorkerSlot) -> int:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, slot.cpus)
+        os.environ["N_THREADS"] = str(len(slot.cpus))
+        os.environ["WORKER_INDEX"] = str(slot.index)
+        os.environ["WORKER_STATS_DIR"] = self.stats_dir
+
+        if self.reuse_port:
+            self._socket.close()
+            sock = create_listen_socket(self.host, self.port, reuse_port=True)
+        else:
+            sock = self._socket
+        return self.serve_worker([sock])
+
+    def _stop(self, signum, frame):
+        self.stopping = True
+        for slot in self.slots:
+            if slot.pid is not None:
+                try:
+                    os.kill(slot.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+    def _restart_delay(self, slot: WorkerSlot) -> float:
+        if time.time() - slot.started_at < CRASH_WINDOW:
+            slot.crashes += 1
+        else:
+            slot.crashes = 0
+        if slot.crashes == 0:
+            return 0.0
+        return min(2.0 ** (slot.crashes - 1), MAX_RESTART_DELAY)
+
+    def run(self) -> int:
+        os.makedirs(self.stats_dir, exist_ok=True)
+        for path in glob.glob(os.path.join(self.stats_dir, "*.json")):
+            os.unlink(path)
+        self._socket = create_listen_socket(self.host, self.port, self.reuse_port)
+        if not self.reuse_port:
+            self._socket.listen(2048)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        print(
+            f"Супервизор: {len(self.slots)} рабочих процессов на {self.host}:{self.port}"
+            f"{' (SO_REUSEPORT)' if self.reuse_port else ''}"
+        )
+        for slot in self.slots:
+            self._spawn(slot)
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except ChildProcessError:
+                break
+            slot = next((slot for slot in self.slots if slot.pid == pid), None)
+            if slot is None:
+                continue
+            slot.pid = None
+            if self.stopping:
+                continue
+
+            delay = self._restart_delay(slot)
+            print(
+                f"Рабочий процесс {slot.index} (pid={pid}) завершился "
+                f"с кодом {os.waitstatus_to_exitcode(status)}, перезапуск через {delay:g} с"
+            )
+            time.sleep(delay)
+            if self.stopping:
+                continue
+            slot.restarts += 1
+            self._spawn(slot)
+
+        self._socket.close()
+        print("Супервизор: все рабочие процессы остановлены")
+        return 0
+
+
+def run_supervisor(
+    workers: int,
+    host: str,
+    port: int,
+    serve_worker: Callable[[List[socket.socket]], int],
+    stats_dir: Optional[str] = None,
+) -> int:
+    """Запускает супервизор с workers рабочими процессами на непересекающихся CPU"""
+    cpu_sets = split_cpu_sets(list_physical_cores(), workers)
+    stats_dir = stats_dir or os.path.join(
+        tempfile.gettempdir(), f"llama-fastapi-workers-{port}"
+    )
+    return Supervisor(host, port, cpu_sets, serve_worker, stats_dir).run()
+
+
+class WorkerStats:
+    """Счетчики рабочего процесса, периодически записываемые в каталог супервизора"""
+
+    def __init__(self, index: int, stats_dir: str, interval: float = 1.0):
+        self.index = index
+        self.stats_dir = stats_dir
+        self.interval = interval
+        self.started_at = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.busy_seconds = 0.0
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.stats_dir, f"worker-{self.index}.json")
+
+    def snapshot(self) -> dict:
+        return {
+            "index": self.index,
+            "pid": os.getpid(),
+            "ready": True,
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "rss_bytes": process_rss_bytes(),
+            "pss_bytes": process_pss_bytes(),
+            "updated_at": time.time(),
+        }
+
+    def write(self):
+        write_json_atomic(self.path, self.snapshot())
+
+    def start_writer(self) -> threading.Thread:
+        def run():
+            while True:
+                try:
+                    self.write()
+                except OSError as e:
+                    print(f"Не удалось записать статистику рабочего процесса: {e}")
+                time.sleep(self.interval)
+
+        thread = threading.Thread(target=run, name="worker-stats", daemon=True)
+        thread.start()
+        return thread
+
+
+class WorkerStatsMiddleware:
+    """ASGI middleware, считающее запросы рабочего процесса"""
+
+    def __init__(self, app, stats: WorkerStats):
+        self.app = app
+        self.stats = stats
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = self.stats
+        status = 500
+
+        async def recording_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats.in_flight += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, recording_send)
+        finally:
+            stats.in_flight -= 1
+            stats.busy_seconds += time.perf_counter() - started
+            stats.requests += 1
+            if status >= 500:
+                stats.errors += 1
+
+
+def aggregate_worker_stats(stats_dir: str, stale_after: float = 5.0) -> dict:
+    """Сводит состояние супервизора и статистику всех рабочих процессов"""
+    state = read_json(os.path.join(stats_dir, SUPERVISOR_STATE)) or {"workers": []}
+    now = time.time()
+    workers = []
+    totals = {"requests": 0, "errors": 0, "in_flight": 0, "rss_bytes": 0, "pss_bytes": 0}
+    for slot in state["workers"]:
+        entry = dict(slot)
+        stats = read_json(os.path.join(stats_dir, f"worker-{slot['index']}.json"))
+        # Файл от предыдущего процесса этого слота не учитывается
+        if stats is not None and stats["pid"] == slot["pid"]:
+            entry.update(stats)
+            entry["stale"] = now - stats["updated_at"] > stale_after
+            for key in totals:
+                totals[key] += stats.get(key) or 0
+        else:
+            entry["ready"] = False
+        workers.append(entry)
+    totals["workers"] = len(workers)
+    totals["ready_workers"] = sum(1 for w in workers if w["ready"])
+    totals["restarts"] = sum(w["restarts"] for w in workers)
+    return {"supervisor_pid": state.get("pid"), "totals": totals, "workers": workers}
+
+
+def install_worker_stats(app: FastAPI, index: int, stats_dir: str) -> WorkerStats:
+    """Подключает учет запросов рабочего процесса и сводный маршрут /extras/workers"""
+    stats = WorkerStats(index, stats_dir)
+    app.add_middleware(WorkerStatsMiddleware, stats=stats)
+    stats.start_writer()
+
+    router = APIRouter()
+
+    @router.get("/extras/workers", summary="Per-worker stats", tags=["Extras"])
+    async def get_worker_stats():
+        return {"worker": index, **aggregate_worker_stats(stats_dir)}
+
+    app.include_router(router)
+    return stats
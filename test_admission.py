@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки контроля допуска без загрузки модели
+"""
+
+import asyncio
+from admission import AdmissionController, AdmissionRejected
+
+def test_priority_order():
+    """Тестирует передачу слота по приоритету и время ожидания"""
+    print("Тест 1: Порядок допуска по приоритету")
+
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, max_queue=4, queue_timeout=5)
+        assert await controller.acquire(0) == 0.0
+        order = []
+
+        async def waiter(name, priority):
+            wait = await controller.acquire(priority)
+            order.append(name)
+            assert wait > 0
+            controller.release()
+
+        tasks = [
+            asyncio.create_task(waiter("batch", 1)),
+            asyncio.create_task(waiter("interactive", 0)),
+        ]
+        await asyncio.sleep(0.01)
+        assert controller.queued == 2
+        controller.release()
+        await asyncio.gather(*tasks)
+        assert order == ["interactive", "batch"]
+        assert controller.in_flight == 0
+        return controller.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["admitted"] == 3
+    print(f"✅ Успешно: {stats}")
+
+def test_shedding():
+    """Тестирует отказ 429 при полной очереди, вытеснение и 503 по таймауту"""
+    print("\nТест 2: Отказы при перегрузке")
+
+    async def scenario():
+        controller = AdmissionController(max_in_flight=1, max_queue=1, queue_timeout=0.05)
+        await controller.acquire(0)
+
+        # Запрос batch вытесняется более приоритетным interactive
+        batch = asyncio.create_task(controller.acquire(1))
+        await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(controller.acquire(0))
+        await asyncio.sleep(0.01)
+        try:
+            await batch
+            assert False, "batch должен быть вытеснен"
+        except AdmissionRejected as e:
+            assert e.status_code == 503
+
+        # Очередь заполнена запросом того же приоритета
+        try:
+            await controller.acquire(0)
+            assert False, "ожидался отказ 429"
+        except AdmissionRejected as e:
+            assert e.status_code == 429
+
+        # interactive не дождался слота
+        try:
+            await interactive
+            assert False, "ожидался таймаут"
+        except AdmissionRejected as e:
+            assert e.status_code == 503
+
+        controller.release()
+        assert controller.in_flight == 0 and controller.queued == 0
+        return controller.stats()
+
+    stats = asyncio.run(scenario())
+    assert stats["shed_for_priority"] == 1
+    assert stats["rejected_queue_full"] == 1
+    assert stats["rejected_timeout"] == 1
+    print(f"✅ Успешно: {stats}")
+
+if __name__ == "__main__":
+    test_priority_order()
+    test_shedding()
+    print("\n✅ Все тесты контроля допуска завершены")
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки вспомогательных функций пакетной генерации без загрузки модели
+"""
+
+import asyncio
+import io
+import json
+import os
+import tempfile
+from batch_infer import (
+    BatchJob,
+    format_duration,
+    read_checkpoint,
+    read_window,
+    resume_checkpoint,
+    run_pipeline,
+    write_checkpoint,
+)
+
+def test_read_window():
+    """Тестирует чтение окна строк с пропуском пустых"""
+    print("Тест 1: Чтение окна строк")
+    f = io.BytesIO(b'{"prompt": "a"}\n\n{"prompt": "b"}\n{"prompt": "c"}\n')
+    assert read_window(f, 2) == [(b'{"prompt": "a"}\n', 16), (b'{"prompt": "b"}\n', 33)]
+    offset = f.tell()
+    assert read_window(f, 2) == [(b'{"prompt": "c"}\n', 49)]
+    assert read_window(f, 2) == []
+
+    f.seek(offset)
+    assert read_window(f, 10) == [(b'{"prompt": "c"}\n', 49)]
+    print("✅ Успешно")
+
+def test_checkpoint():
+    """Тестирует сохранение и чтение контрольной точки"""
+    print("\nТест 2: Контрольная точка")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "results.jsonl.checkpoint")
+        assert read_checkpoint(path) is None
+        checkpoint = {"input_offset": 120, "output_offset": 300, "lines": 4}
+        write_checkpoint(path, checkpoint)
+        assert read_checkpoint(path) == checkpoint
+        assert os.listdir(directory) == ["results.jsonl.checkpoint"]
+
+        # Без выходного файла контрольная точка сбрасывается, а не дополняется нулями
+        output = os.path.join(directory, "results.jsonl")
+        assert resume_checkpoint(path, output) == {"input_offset": 0, "output_offset": 0, "lines": 0}
+        with open(output, "wb") as f:
+            f.write(b"x" * 100)
+        assert resume_checkpoint(path, output)["lines"] == 0
+        with open(output, "wb") as f:
+            f.write(b"x" * 300)
+        assert resume_checkpoint(path, output) == checkpoint
+    print("✅ Успешно")
+
+def test_format_duration():
+    """Тестирует формат оценки оставшегося времени"""
+    print("\nТест 3: Формат длительности")
+    assert format_duration(0) == "0:00:00"
+    assert format_duration(3725.9) == "1:02:05"
+    print("✅ Успешно")
+
+def test_prepare_non_object():
+    """Тестирует отклонение строк, не являющихся JSON-объектом"""
+    print("\nТест 4: Строка не JSON-объект")
+    job = BatchJob(llama=None, scheduler=None, default_max_tokens=16, sort_by_length=True)
+    for line in [b"[1, 2]", b'"prompt"', b"null", b"not json"]:
+        result, sequence = job.prepare(7, line)
+        assert sequence is None and result["line"] == 7 and "error" in result, result
+    print("✅ Успешно")
+
+def test_pipeline():
+    """Тестирует непрерывную подачу строк и контрольные точки по готовому префиксу"""
+    print("\nТест 5: Непрерывная подача строк")
+
+    class FakeJob:
+        """Строка с delay завершается через delay мс, строка без него - ошибкой сразу"""
+
+        def __init__(self):
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.completed = []
+
+        async def collect(self, result, delay):
+            await asyncio.sleep(delay / 1000)
+            self.in_flight -= 1
+            self.completed.append(result["line"])
+            return dict(result, text=str(delay))
+
+        def feed(self, lines):
+            fed = []
+            for line_no, line in lines:
+                result = {"line": line_no}
+                delay = json.loads(line).get("delay")
+                if delay is None:
+                    fed.append((line_no, dict(result, error="bad"), None))
+                    continue
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                fed.append((line_no, result, asyncio.ensure_future(self.collect(result, delay))))
+            return fed
+
+    # Строки завершаются не по порядку; одна медленная не задерживает подачу следующих
+    delays = [200, 1, 1, None, 1, 1, 1, 1, 1, 1]
+    data = b"".join(
+        json.dumps({"delay": d} if d is not None else {}).encode() + b"\n" for d in delays
+    )
+    checkpoints = []
+    job = FakeJob()
+    with tempfile.TemporaryFile() as output_file:
+        n_lines = asyncio.run(run_pipeline(
+            job, io.BytesIO(data), output_file, 0, 4, lambda *checkpoint: checkpoints.append(checkpoint)
+        ))
+        output_file.seek(0)
+        output = output_file.read()
+
+    results = [json.loads(line) for line in output.splitlines()]
+    assert n_lines == 10 and [r["line"] for r in results] == list(range(10))
+    assert results[3]["error"] == "bad" and results[0]["text"] == "200"
+    assert job.max_in_flight <= 4
+    # Пока первая строка генерируется, остальные проходят через планировщик
+    assert job.completed[-1] == 0, job.completed
+    # До завершения первой строки записывать нечего: одна контрольная точка в конце
+    assert checkpoints == [(len(data), len(output), 10)], checkpoints
+    print(f"✅ Успешно: контрольные точки {checkpoints}")
+
+if __name__ == "__main__":
+    test_read_window()
+    test_checkpoint()
+    test_format_duration()
+    test_prepare_non_object()
+    test_pipeline()
+    print("\n✅ Все тесты пакетной генерации завершены")
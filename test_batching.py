@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки логики непрерывного батчинга без загрузки модели
+"""
+
+import asyncio
+import collections
+import threading
+from batching import BatchScheduler, BatchSequence, stop_holdback
+
+def test_stop_holdback():
+    """Тестирует удержание хвоста, который может оказаться стоп-строкой"""
+    print("Тест 1: Удержание возможного начала стоп-строки")
+    assert stop_holdback("Hello <|im", ["<|im_end|>"]) == 4
+    assert stop_holdback("Hello", ["<|im_end|>"]) == 0
+    assert stop_holdback("abc\n", ["\n\n", "###"]) == 1
+    assert stop_holdback("abc", []) == 0
+    print("✅ Успешно")
+
+def test_sequence_stream_with_stop():
+    """Тестирует выдачу текста и остановку по стоп-строке"""
+
+    async def scenario():
+        sequence = BatchSequence([1, 2, 3], sampler=None, max_tokens=16, stop=["<|im_end|>"])
+        for piece in [b"Hel", b"lo", b" <|im", b"_end|>", b"tail"]:
+            sequence._push(piece)
+            if sequence.finished:
+                break
+        pieces = [piece async for piece in sequence.stream()]
+        return sequence, pieces
+
+    print("\nТест 2: Потоковая выдача с остановкой по стоп-строке")
+    sequence, pieces = asyncio.run(scenario())
+    assert "".join(pieces) == "Hello ", pieces
+    assert sequence.finish_reason == "stop"
+    assert not sequence.cancelled
+    print(f"✅ Успешно: {pieces}")
+
+def test_sequence_cancel_on_disconnect():
+    """Тестирует пометку последовательности как отмененной при закрытии потока"""
+
+    async def scenario():
+        sequence = BatchSequence([1], sampler=None, max_tokens=16, stop=[])
+        sequence._push(b"partial")
+        stream = sequence.stream()
+        first = await stream.__anext__()
+        await stream.aclose()
+        return sequence, first
+
+    print("\nТест 3: Отмена при отключении клиента")
+    sequence, first = asyncio.run(scenario())
+    assert first == "partial"
+    assert sequence.cancelled
+    print("✅ Успешно")
+
+def test_submit_limits():
+    """Тестирует проверку промпта и max_tokens при постановке в очередь"""
+    async def scenario():
+        # Планировщик без модели: submit использует только очередь и slot_ctx
+        scheduler = BatchScheduler.__new__(BatchScheduler)
+        scheduler.slot_ctx = 32
+        scheduler.context_window = None
+        scheduler._pending = collections.deque()
+        scheduler._cond = threading.Condition()
+        scheduler.requests_total = 0
+
+        try:
+            scheduler.submit(BatchSequence([], sampler=None, max_tokens=16, stop=[]))
+            assert False, "пустой промпт должен отклоняться"
+        except ValueError:
+            pass
+
+        limits = []
+        for max_tokens in [0, -1, 8, 100]:
+            sequence = BatchSequence([1, 2, 3, 4], sampler=None, max_tokens=max_tokens, stop=[])
+            scheduler.submit(sequence)
+            limits.append(sequence.max_tokens)
+        return scheduler, limits
+
+    print("\nТест 4: Пустой промпт и max_tokens <= 0")
+    scheduler, limits = asyncio.run(scenario())
+    # max_tokens <= 0 - до конца контекста слота
+    assert limits == [28, 28, 8, 28], limits
+    assert scheduler.requests_total == 4
+    print(f"✅ Успешно: {limits}")
+
+if __name__ == "__main__":
+    test_stop_holdback()
+    test_sequence_stream_with_stop()
+    test_sequence_cancel_on_disconnect()
+    test_submit_limits()
+    print("\n✅ Все тесты батчинга завершены")
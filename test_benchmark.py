@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки нагрузочного теста на заглушке модели
+"""
+
+import asyncio
+import json
+
+import httpx
+from llama_cpp.server.settings import ModelSettings
+from benchmark import (
+    FakeLlama,
+    build_app,
+    compare_with_baseline,
+    make_request_bodies,
+    parse_length_distribution,
+    percentile,
+    patched_environ,
+    run_benchmark,
+    send_request,
+    serve_in_background,
+)
+
+def test_fake_llama():
+    """Тестирует детерминированность заглушки и chat handler поверх нее"""
+    print("Тест 1: Заглушка модели")
+    llama = FakeLlama(ModelSettings(model="fake.gguf", n_ctx=256, chat_format="chatml"))
+    first = llama("one two three", max_tokens=4)
+    assert first["choices"][0]["text"] == llama("one two three", max_tokens=4)["choices"][0]["text"]
+    assert first["usage"] == {"prompt_tokens": 4, "completion_tokens": 4, "total_tokens": 8}
+
+    chunks = list(llama.create_chat_completion(
+        messages=[{"role": "user", "content": "hi"}], max_tokens=3, stream=True
+    ))
+    assert sum(1 for c in chunks if c["choices"][0]["delta"].get("content")) == 3
+    assert chunks[-1]["choices"][0]["finish_reason"] == "length"
+    print("✅ Успешно")
+
+def test_statistics():
+    """Тестирует перцентили, распределения длины и сравнение с базой"""
+    print("\nТест 2: Статистика и сравнение с базой")
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2, 4], 50) == 2
+    assert percentile(list(range(1, 101)), 99) == 99
+
+    config = {"seed": 1, "prompt_lengths": "choice:2,5", "requests": 10,
+              "max_tokens": 4, "stream": False, "endpoint": "completions"}
+    bodies = make_request_bodies(config)
+    assert bodies == make_request_bodies(config)
+    assert {len(b["prompt"].split()) for b in bodies} <= {2, 5}
+    try:
+        parse_length_distribution("normal:5")
+        assert False, "ожидалась ошибка"
+    except ValueError:
+        pass
+
+    baseline = {"req_per_s": 10.0, "tokens_per_s": 100.0, "errors": {},
+                "ttft": {"p50": 0.1}, "latency": {"p50": 0.5}}
+    same = dict(baseline, req_per_s=9.5, latency={"p50": 0.52})
+    assert compare_with_baseline(same, baseline, 0.1) == []
+    worse = dict(baseline, tokens_per_s=80.0, ttft={"p50": 0.2})
+    regressions = compare_with_baseline(worse, baseline, 0.1)
+    assert len(regressions) == 2
+    print(f"✅ Успешно: {regressions}")
+
+def test_end_to_end():
+    """Тестирует короткий прогон приложения из Main.main() без GGUF"""
+    print("\nТест 3: Прогон нагрузки")
+    results = run_benchmark({
+        "concurrency": 1, "requests": 4, "endpoint": "chat", "stream": True,
+        "prompt_lengths": "fixed:8", "max_tokens": 4,
+        "token_delay_ms": 0.0, "prefill_delay_ms": 0.0, "seed": 0,
+    })
+    assert results["errors"] == {}, results["errors"]
+    assert results["requests"] == 4 and results["req_per_s"] > 0
+    assert results["ttft"]["p50"] <= results["latency"]["p50"]
+    print(f"✅ Успешно: {results['req_per_s']} запр/с")
+
+    print("\nТест 4: Конкурентные потоки не обрываются")
+    results = run_benchmark({
+        "concurrency": 4, "requests": 8, "endpoint": "completions", "stream": True,
+        "prompt_lengths": "fixed:8", "max_tokens": 8,
+        "token_delay_ms": 2.0, "prefill_delay_ms": 0.0, "seed": 0,
+    })
+    assert results["errors"] == {}, results["errors"]
+    print(f"✅ Успешно: {results['requests']} запросов")
+
+def test_interrupted_stream():
+    """Тестирует учет потока без finish_reason как ошибки"""
+    print("\nТест 5: Оборванный поток")
+
+    def stream_of(finish_reason):
+        chunks = [{"choices": [{"text": "a", "finish_reason": None}]}]
+        if finish_reason is not None:
+            chunks.append({"choices": [{"text": "", "finish_reason": finish_reason}]})
+        body = "".join(f"data: {json.dumps(chunk)}\n\n" for chunk in chunks) + "data: [DONE]\n\n"
+        return httpx.MockTransport(lambda request: httpx.Response(200, text=body))
+
+    async def scenario(finish_reason):
+        async with httpx.AsyncClient(transport=stream_of(finish_reason), base_url="http://test") as client:
+            return await send_request(client, "/v1/completions", {"stream": True}, "completions")
+
+    assert asyncio.run(scenario(None))["status"] == "interrupted"
+    sample = asyncio.run(scenario("length"))
+    assert sample["status"] == 200 and sample["tokens"] == 1
+    print("✅ Успешно")
+
+def test_fast_stream_tokens():
+    """Тестирует подсчет токенов при FAST_STREAM с объединением событий"""
+    print("\nТест 6: FAST_STREAM с объединением по 4 токена")
+
+    async def scenario(base_url):
+        async with httpx.AsyncClient(base_url=base_url) as client:
+            samples = []
+            for endpoint, path in (("completions", "/v1/completions"), ("chat", "/v1/chat/completions")):
+                body = {"max_tokens": 10, "stream": True}
+                if endpoint == "chat":
+                    body["messages"] = [{"role": "user", "content": "раз два три"}]
+                else:
+                    body["prompt"] = "раз два три"
+                samples.append(await send_request(client, path, body, endpoint))
+            return samples
+
+    with patched_environ({"FAST_STREAM": "1", "STREAM_COALESCE_TOKENS": "4"}):
+        app = build_app(0.0, 0.0)
+    with serve_in_background(app) as base_url:
+        samples = asyncio.run(scenario(base_url))
+    # Событий меньше, чем токенов, но число токенов берется из usage
+    assert [sample["tokens"] for sample in samples] == [10, 10], samples
+    print("✅ Успешно")
+
+if __name__ == "__main__":
+    test_fake_llama()
+    test_statistics()
+    test_end_to_end()
+    test_interrupted_stream()
+    test_fast_stream_tokens()
+    print("\n✅ Все тесты нагрузочного теста завершены")
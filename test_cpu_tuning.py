@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки автоподбора потоков без загрузки модели
+"""
+
+import os
+import tempfile
+from cpu_tuning import (
+    choose_thread_settings,
+    detect_cpu_topology,
+    load_cached_tuning,
+    parse_cpu_list,
+    save_cached_tuning,
+)
+
+def test_topology_detection():
+    """Тестирует разбор списков CPU и определение топологии хоста"""
+    print("Тест 1: Топология CPU")
+    assert parse_cpu_list("0-3,8,10-11") == [0, 1, 2, 3, 8, 10, 11]
+    topology = detect_cpu_topology()
+    assert 1 <= topology["physical_cores"] <= topology["logical_cpus"]
+    assert topology["numa_nodes"] >= 1
+    assert len(topology["cores"]) == topology["physical_cores"]
+    assert sum(len(core) for core in topology["cores"]) == topology["logical_cpus"]
+    print(f"✅ Успешно: {topology}")
+
+def test_choice():
+    """Тестирует выбор потоков для SMT, NUMA и квоты cgroup"""
+    print("\nТест 2: Выбор потоков и размера батча")
+    smt = {"logical_cpus": 16, "physical_cores": 8, "numa_nodes": 1,
+           "largest_numa_node_cpus": 16, "cgroup_cpu_limit": None}
+    settings, reason = choose_thread_settings(smt)
+    assert settings == {"n_threads": 8, "n_threads_batch": 16, "n_batch": 512}
+
+    numa = dict(smt, logical_cpus=64, physical_cores=32, numa_nodes=2, largest_numa_node_cpus=32)
+    settings, reason = choose_thread_settings(numa)
+    assert settings["n_threads"] == 16 and settings["n_threads_batch"] == 64
+    assert "NUMA" in reason
+
+    quota = dict(smt, cgroup_cpu_limit=2.5)
+    settings, reason = choose_thread_settings(quota)
+    assert settings == {"n_threads": 2, "n_threads_batch": 2, "n_batch": 256}
+    assert "cgroup" in reason
+    print(f"✅ Успешно: {reason}")
+
+def test_tuning_cache():
+    """Тестирует сохранение результата замера на диск"""
+    print("\nТест 3: Кэш результата замера")
+    with tempfile.TemporaryDirectory() as directory:
+        cache_path = os.path.join(directory, "nested", "autotune.json")
+        assert load_cached_tuning(cache_path, "host") is None
+        tuning = {"n_threads": 4, "n_threads_batch": 8, "n_batch": 512}
+        save_cached_tuning(cache_path, "host", tuning)
+        save_cached_tuning(cache_path, "other", {"n_threads": 1})
+        assert load_cached_tuning(cache_path, "host") == tuning
+    print("✅ Успешно")
+
+if __name__ == "__main__":
+    test_topology_detection()
+    test_choice()
+    test_tuning_cache()
+    print("\n✅ Все тесты автоподбора потоков завершены")
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки кэша векторов и кодирования эмбеддингов без загрузки модели
+"""
+
+import base64
+import os
+import numpy as np
+from embeddings import VectorCache, content_key, encode_vectors, read_embedding_settings
+
+def test_vector_cache():
+    """Тестирует LRU-вытеснение и хранение векторов в общем массиве"""
+    print("Тест 1: Кэш векторов")
+    cache = VectorCache(capacity_bytes=2 * 4 * 4, n_embd=4)
+    assert cache.capacity == 2
+    a, b, c = (content_key(text) for text in ("a", "b", "c"))
+    cache.put(a, np.full(4, 1.0, dtype=np.single), 3)
+    cache.put(b, np.full(4, 2.0, dtype=np.single), 5)
+    vector, n_tokens = cache.get(a)
+    assert list(vector) == [1.0] * 4 and n_tokens == 3
+    # Вытесняется давно не использовавшийся b, строка массива переиспользуется
+    cache.put(c, np.full(4, 3.0, dtype=np.single), 7)
+    assert cache.get(b) is None
+    assert cache.get(c)[0][0] == 3.0
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["evictions"] == 1 and stats["hits"] == 2
+    assert VectorCache(0, n_embd=4).capacity == 0
+    print(f"✅ Успешно: {stats}")
+
+def test_encoding():
+    """Тестирует base64 float32 и JSON-представление векторов"""
+    print("\nТест 2: Кодирование векторов")
+    vectors = np.array([[0.5, -1.25, 3.0], [1.0, 2.0, 4.0]], dtype=np.single)
+    encoded = encode_vectors(vectors, "base64")
+    decoded = np.frombuffer(base64.b64decode(encoded[1]), dtype="<f4")
+    assert np.array_equal(decoded, vectors[1])
+    assert len(encoded[0]) == 16
+    assert [list(v) for v in encode_vectors(vectors, "float")] == vectors.tolist()
+    print("✅ Успешно")
+
+def test_settings():
+    """Тестирует чтение EMBEDDINGS и EMBEDDING_POOLING"""
+    print("\nТест 3: Настройки")
+    names = ("EMBEDDINGS", "EMBEDDING_MODEL_PATH", "EMBEDDING_POOLING")
+    saved = {name: os.environ.pop(name, None) for name in names}
+    try:
+        assert read_embedding_settings() is None
+        os.environ["EMBEDDINGS"] = "1"
+        settings = read_embedding_settings()
+        assert settings["pooling"] == "model" and settings["model_path"] is None
+        os.environ["EMBEDDING_POOLING"] = "rank"
+        try:
+            read_embedding_settings()
+            assert False, "ожидалась ошибка"
+        except ValueError:
+            pass
+    finally:
+        for name, value in saved.items():
+            os.environ.pop(name, None)
+            if value is not None:
+                os.environ[name] = value
+    print("✅ Успешно")
+
+if __name__ == "__main__":
+    test_vector_cache()
+    test_encoding()
+    test_settings()
+    print("\n✅ Все тесты эмбеддингов завершены")
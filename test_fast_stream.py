@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки облегченной отдачи потоков без загрузки модели
+"""
+
+import asyncio
+import json
+from fast_stream import FastStreamStats, TokenStream, encode_json_string, token_event_template
+
+def make_chunk(text, finish_reason=None):
+    return {
+        "id": "cmpl-1",
+        "object": "text_completion",
+        "created": 1,
+        "model": "m",
+        "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": finish_reason}],
+    }
+
+def test_template():
+    """Тестирует, что событие из шаблона совпадает с полным JSON чанка"""
+    print("Тест 1: Шаблон события")
+    prefix, suffix = token_event_template(make_chunk("x"), chat=False)
+    for text in ["привет", 'кавычка " и \\', "\n\t"]:
+        event = prefix + encode_json_string(text) + suffix
+        assert event.startswith(b"data: ") and event.endswith(b"\n\n")
+        assert json.loads(event[6:]) == make_chunk(text)
+    # Конверт события кодируется компактно
+    assert b'"finish_reason":null' in prefix + suffix
+    print("✅ Успешно")
+
+def run_stream(n_tokens, coalesce_ms, coalesce_tokens, usage=None):
+    def llama_call(llama, **kwargs):
+        for i in range(n_tokens):
+            yield make_chunk(f" t{i}")
+        final = make_chunk("", "length")
+        if usage is not None:
+            final["usage"] = usage
+        yield final
+
+    async def collect():
+        stream = TokenStream(False, coalesce_ms, coalesce_tokens, FastStreamStats())
+        worker = asyncio.get_running_loop().run_in_executor(
+            None, stream.produce, None, llama_call, {}
+        )
+        events = [event async for event in stream.events()]
+        await worker
+        return events
+
+    events = asyncio.run(collect())
+    assert events[-1] == b"data: [DONE]\n\n"
+    chunks = [json.loads(event[6:]) for event in events[:-1]]
+    return chunks[:-1], chunks[-1]
+
+def test_coalescing():
+    """Тестирует объединение токенов по количеству и итоговое событие с usage"""
+    print("\nТест 2: Объединение токенов")
+    tokens, final = run_stream(7, 0, 0)
+    assert len(tokens) == 7
+
+    tokens, final = run_stream(7, 0, 3)
+    # Первый токен отправляется сразу, затем по 3
+    assert [t["choices"][0]["text"] for t in tokens] == [" t0", " t1 t2 t3", " t4 t5 t6"]
+    assert final["choices"][0]["finish_reason"] == "length"
+    # Токены считаются по чанкам llama_cpp, а не по событиям
+    assert final["usage"] == {"completion_tokens": 7}
+
+    tokens, final = run_stream(5, 60000, 0)
+    assert len(tokens) == 2 and tokens[1]["choices"][0]["text"] == " t1 t2 t3 t4"
+    print("✅ Успешно")
+
+def test_backend_usage():
+    """Тестирует передачу usage из итогового чанка бэкенда"""
+    print("\nТест 3: usage бэкенда")
+    usage = {"prompt_tokens": 3, "completion_tokens": 5, "total_tokens": 8}
+    tokens, final = run_stream(5, 0, 4, usage)
+    assert len(tokens) == 2
+    assert final["usage"] == usage
+    print(f"✅ Успешно: {final['usage']}")
+
+if __name__ == "__main__":
+    test_template()
+    test_coalescing()
+    test_backend_usage()
+    print("\n✅ Все тесты облегченной отдачи потоков завершены")
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки настроек KV-кэша и скользящего окна контекста без загрузки модели
+"""
+
+import os
+import llama_cpp
+from kv_cache import ContextWindow, kv_bytes_per_element, read_context_window_settings, read_kv_cache_settings
+
+BOS = 1
+
+class FakeLlama:
+    """Заглушка: один токен на символ, create_completion возвращает промпт"""
+
+    def n_ctx(self):
+        return 64
+
+    def token_bos(self):
+        return BOS
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return [BOS] + list(text)
+
+    def create_completion(self, prompt, max_tokens=16, **kwargs):
+        return prompt
+
+def with_env(env, func):
+    saved = {name: os.environ.get(name) for name in env}
+    os.environ.update(env)
+    try:
+        return func()
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+def test_kv_cache_settings():
+    """Тестирует KV_CACHE_TYPE, FLASH_ATTN и оценку байт на элемент"""
+    print("Тест 1: Тип KV-кэша")
+
+    assert with_env({"KV_CACHE_TYPE": "f16", "FLASH_ATTN": ""}, read_kv_cache_settings) == {"kv_cache_type": "f16", "flash_attn": False}
+    # Квантованный V-кэш включает flash attention
+    assert with_env({"KV_CACHE_TYPE": "q4_0", "FLASH_ATTN": ""}, read_kv_cache_settings)["flash_attn"] is True
+    for env in ({"KV_CACHE_TYPE": "q8_0", "FLASH_ATTN": "false"}, {"KV_CACHE_TYPE": "q5_1", "FLASH_ATTN": ""}):
+        try:
+            with_env(env, read_kv_cache_settings)
+            assert False, "ожидалась ValueError"
+        except ValueError:
+            pass
+
+    assert kv_bytes_per_element(llama_cpp.GGML_TYPE_Q8_0, llama_cpp.GGML_TYPE_F16) == (34 / 32, 2.0)
+    assert with_env({"CONTEXT_OVERFLOW": "error"}, read_context_window_settings) is None
+    settings = with_env({"CONTEXT_OVERFLOW": "truncate", "CONTEXT_KEEP": "8", "CONTEXT_RESERVE": "0"}, read_context_window_settings)
+    assert settings == {"n_keep": 8, "reserve": None}
+    print(f"✅ Успешно: {settings}")
+
+def test_fit():
+    """Тестирует отбрасывание старых токенов с сохранением начала"""
+    print("\nТест 2: Скользящее окно")
+
+    window = ContextWindow(n_keep=2)
+    tokens = [BOS] + list(range(100, 200))
+    # Промпт, помещающийся в контекст, не меняется, даже если места на ответ мало
+    assert window.fit(tokens[:59], 64, BOS) == tokens[:59]
+    assert window.stats()["truncated_requests"] == 0
+
+    fitted = window.fit(tokens, 64, BOS)
+    # На ответ остается четверть контекста
+    assert len(fitted) == 64 - 16 - 4
+    # BOS и n_keep токенов сохраняются, дальше идут самые новые токены
+    assert fitted[:3] == tokens[:3] and fitted[3:] == tokens[-(len(fitted) - 3):]
+
+    assert len(ContextWindow(reserve=8).fit(tokens, 64, BOS)) == 64 - 8 - 4
+    assert len(ContextWindow(reserve=1000).fit(tokens, 64, BOS)) == 64 - 32 - 4
+    stats = window.stats()
+    assert stats["truncated_requests"] == 1
+    print(f"✅ Успешно: {stats}")
+
+def test_wrap():
+    """Тестирует укорачивание промптов в create_completion"""
+    print("\nТест 3: Обертка create_completion")
+
+    llama = FakeLlama()
+    window = ContextWindow()
+    window.wrap(llama)
+    assert llama.create_completion("коротко", max_tokens=8) == "коротко"
+    # Chat передает max_tokens=None; длинный, но помещающийся промпт не трогается
+    assert llama.create_completion(prompt=[BOS] + [5] * 55, max_tokens=None) == [BOS] + [5] * 55
+    prompt = llama.create_completion("x" * 200, max_tokens=8)
+    assert isinstance(prompt, list) and len(prompt) == 44 and prompt[0] == BOS
+    prompt = llama.create_completion(prompt=[BOS] + [5] * 100, max_tokens=None)
+    assert len(prompt) == 44
+    print(f"✅ Успешно: {window.stats()}")
+
+if __name__ == "__main__":
+    print("🧪 Тестирование KV-кэша и окна контекста\n")
+    test_kv_cache_settings()
+    test_fit()
+    test_wrap()
+    print("\n🎉 Все тесты пройдены!")
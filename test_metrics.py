@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки метрик без загрузки модели
+"""
+
+import asyncio
+import json
+from metrics import Histogram, MetricsMiddleware, ServerMetrics
+
+def test_histogram_render():
+    """Тестирует накопительные корзины и формат Prometheus"""
+    print("Тест 1: Гистограмма")
+    histogram = Histogram("latency_seconds", "Latency", (0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 2.0):
+        histogram.observe(value, "tiny")
+    lines = list(histogram.render())
+    assert 'latency_seconds_bucket{model="tiny",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{model="tiny",le="1.0"} 3' in lines
+    assert 'latency_seconds_bucket{model="tiny",le="+Inf"} 4' in lines
+    assert 'latency_seconds_count{model="tiny"} 4' in lines
+    print("✅ Успешно")
+
+def test_middleware_stream():
+    """Тестирует TTFT, задержку между токенами и подсчет токенов потока"""
+    print("\nТест 2: Метрики потокового ответа")
+
+    def event(delta, finish_reason=None):
+        chunk = {
+            "model": "tiny",
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+        return f"data: {json.dumps(chunk)}\r\n\r\n".encode()
+
+    async def app(scope, receive, send):
+        await receive()
+        scope.setdefault("state", {})["queue_wait"] = 0.01
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream; charset=utf-8")],
+        })
+        for body in (
+            event({"role": "assistant"}),
+            event({"content": "При"}),
+            event({"content": "вет"}),
+            event({}, "stop"),
+            b"data: [DONE]\r\n\r\n",
+        ):
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def scenario():
+        metrics = ServerMetrics()
+        middleware = MetricsMiddleware(app, metrics, lambda path, body: 7)
+        scope = {"type": "http", "path": "/v1/chat/completions", "headers": []}
+
+        async def receive():
+            return {"type": "http.request", "body": b"{}", "more_body": False}
+
+        async def send(message):
+            pass
+
+        await middleware(scope, receive, send)
+        return metrics
+
+    metrics = asyncio.run(scenario())
+    text = metrics.render()
+    assert 'llama_requests_total{model="tiny",path="/v1/chat/completions",status="200"} 1.0' in text
+    assert 'llama_completion_tokens_sum{model="tiny"} 2.0' in text
+    assert 'llama_prompt_tokens_sum{model="tiny"} 7.0' in text
+    assert 'llama_inter_token_latency_seconds_count{model="tiny"} 1' in text
+    assert 'llama_queue_wait_seconds_count{model="tiny"} 1' in text
+    assert "llama_requests_in_flight 0" in text
+    print("✅ Успешно")
+
+def test_middleware_coalesced_stream():
+    """Тестирует компактные события с несколькими токенами и usage в конце"""
+    print("\nТест 3: Объединенные события потока")
+
+    def event(text, finish_reason=None, **extra):
+        chunk = {"model": "tiny", "choices": [{"index": 0, "text": text, "finish_reason": finish_reason}]}
+        return b"data: " + json.dumps({**chunk, **extra}, separators=(",", ":")).encode() + b"\n\n"
+
+    async def app(scope, receive, send):
+        await receive()
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [(b"content-type", b"text/event-stream; charset=utf-8")],
+        })
+        for body in (
+            event(" a"),
+            b": ping\n\n",
+            event(" b c d e"),
+            event("", "length", usage={"completion_tokens": 5}),
+            b"data: [DONE]\n\n",
+        ):
+            await send({"type": "http.response.body", "body": body, "more_body": True})
+        await send({"type": "http.response.body", "body": b""})
+
+    async def scenario():
+        metrics = ServerMetrics()
+        middleware = MetricsMiddleware(app, metrics)
+        scope = {"type": "http", "path": "/v1/completions", "headers": []}
+
+        async def receive():
+            return {"type": "http.request", "body": b"{}", "more_body": False}
+
+        async def send(message):
+            pass
+
+        await middleware(scope, receive, send)
+        return metrics
+
+    text = asyncio.run(scenario()).render()
+    assert 'llama_completion_tokens_sum{model="tiny"} 5.0' in text
+    assert 'llama_time_to_first_token_seconds_count{model="tiny"} 1' in text
+    # Второе событие несет 4 токена: 4 задержки между токенами, а не одна
+    assert 'llama_inter_token_latency_seconds_count{model="tiny"} 4' in text
+    print("✅ Успешно")
+
+if __name__ == "__main__":
+    test_histogram_render()
+    test_middleware_stream()
+    test_middleware_coalesced_stream()
+    print("\n✅ Все тесты метрик завершены")
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки реестра моделей без загрузки моделей
+"""
+
+import os
+import tempfile
+from llama_cpp.server.model import LlamaProxy
+from llama_cpp.server.settings import ModelSettings
+from fastapi import FastAPI
+from model_registry import ModelRegistry, load_registry_config
+from prefix_cache import PrefixKVCache, install_prefix_cache
+
+class FakeLlama:
+    """Заглушка Llama без метаданных"""
+    metadata = {}
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def set_cache(self, cache):
+        self.cache = cache
+
+def make_model_file(directory, name, size):
+    path = os.path.join(directory, name)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    return path
+
+def test_config_inheritance():
+    """Тестирует наследование общих параметров и флаг pinned"""
+    print("Тест 1: Чтение YAML реестра")
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = os.path.join(directory, "models.yaml")
+        with open(config_path, "w") as f:
+            f.write(
+                "ram_budget_mb: 64\n"
+                "models:\n"
+                "  - model: a.gguf\n"
+                "    model_alias: a\n"
+                "    pinned: true\n"
+                "  - model: b.gguf\n"
+                "    n_ctx: 512\n"
+            )
+        base = ModelSettings(model="main.gguf", n_ctx=4096, n_threads=3, chat_format="chatml")
+        models, pinned, budget = load_registry_config(config_path, base)
+    assert [m.model_alias for m in models] == ["a", "b.gguf"]
+    assert models[0].n_ctx == 4096 and models[0].n_threads == 3
+    assert models[0].chat_format == "chatml"
+    assert models[1].n_ctx == 512
+    assert pinned == {"a"}
+    assert budget == 64 * 1024 * 1024
+    print("✅ Успешно")
+
+def test_lru_eviction():
+    """Тестирует ленивую загрузку и выгрузку по LRU в пределах бюджета"""
+    print("\nТест 2: Выгрузка по бюджету RAM")
+    original_loader = LlamaProxy.load_llama_from_model_settings
+    LlamaProxy.load_llama_from_model_settings = staticmethod(FakeLlama)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            models = [
+                ModelSettings(model=make_model_file(directory, name, 100), model_alias=name)
+                for name in ("main", "a", "b")
+            ]
+            registry = ModelRegistry(models, pinned={"main"}, ram_budget_bytes=250)
+            main = registry("main")
+            a = registry("a")
+            assert registry.is_resident("a")
+            registry("main")
+
+            # Для b не хватает бюджета: выгружается давно не использованная a
+            b = registry("b")
+            assert a.closed and not registry.is_resident("a")
+            assert not main.closed and registry.is_resident("b")
+            assert registry("unknown") is main
+
+            registry.replace("b", ModelSettings(model=models[2].model, n_ctx=256))
+            assert b.closed and not registry.is_resident("b")
+            stats = registry.stats()
+    finally:
+        LlamaProxy.load_llama_from_model_settings = original_loader
+
+    assert stats["models"]["a"]["unloads"] == 1
+    assert stats["models"]["b"]["loads"] == 1
+    assert stats["resident_bytes"] == 100
+    print(f"✅ Успешно: {stats['resident_bytes']} байт в памяти")
+
+def test_on_load_prefix_cache():
+    """Тестирует собственный кэш префиксов у моделей, загруженных реестром"""
+    print("\nТест 3: Кэш префиксов для загружаемых моделей")
+    original_loader = LlamaProxy.load_llama_from_model_settings
+    LlamaProxy.load_llama_from_model_settings = staticmethod(FakeLlama)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            models = [
+                ModelSettings(model=make_model_file(directory, name, 100), model_alias=name)
+                for name in ("main", "a")
+            ]
+            registry = ModelRegistry(models)
+            main = registry("main")
+            cache = PrefixKVCache(disk_dir=os.path.join(directory, "cache"))
+            install_prefix_cache(FastAPI(), cache, [main], registry)
+            assert main.cache is cache
+
+            a = registry("a")
+            assert isinstance(a.cache, PrefixKVCache) and a.cache is not cache
+            assert os.path.dirname(a.cache.disk_dir) == cache.disk_dir
+            # После перезагрузки кэш создается заново
+            assert registry.reload("a").cache is not a.cache
+    finally:
+        LlamaProxy.load_llama_from_model_settings = original_loader
+    print("✅ Успешно")
+
+if __name__ == "__main__":
+    test_config_inheritance()
+    test_lru_eviction()
+    test_on_load_prefix_cache()
+    print("\n✅ Все тесты реестра моделей завершены")
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки кэша префиксов KV без загрузки модели
+"""
+
+import os
+import tempfile
+import numpy as np
+import llama_cpp
+from prefix_cache import PrefixKVCache, compact_state, state_nbytes
+
+def make_state(tokens, state_bytes=1000, n_vocab=8):
+    """Создает фиктивное состояние llama для заданных токенов"""
+    input_ids = np.zeros(64, dtype=np.intc)
+    input_ids[: len(tokens)] = tokens
+    return llama_cpp.LlamaState(
+        input_ids=input_ids,
+        scores=np.ones((len(tokens), n_vocab), dtype=np.single),
+        n_tokens=len(tokens),
+        llama_state=b"\0" * state_bytes,
+        llama_state_size=state_bytes,
+        seed=0,
+    )
+
+def test_prefix_lookup():
+    """Тестирует поиск по самому длинному общему префиксу"""
+    print("Тест 1: Поиск по общему префиксу")
+    cache = PrefixKVCache(capacity_bytes=1 << 20, min_prefix_tokens=4)
+    system_prompt = list(range(1, 9))
+    cache[system_prompt + [100, 101]] = make_state(system_prompt + [100, 101])
+
+    state = cache[system_prompt + [200]]
+    assert state.n_tokens == 10
+    # Сохраняется только последняя строка логитов
+    assert state.scores.shape == (1, 8)
+
+    try:
+        cache[[1, 2, 3, 50]]
+        assert False, "префикс короче min_prefix_tokens не должен давать попадание"
+    except KeyError:
+        pass
+
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1
+    assert stats["hit_tokens"] == 8
+    print(f"✅ Успешно: {stats}")
+
+def test_lru_eviction_to_disk():
+    """Тестирует вытеснение по бюджету байтов на диск и возврат в RAM"""
+    print("\nТест 2: LRU-вытеснение на диск")
+    with tempfile.TemporaryDirectory() as disk_dir:
+        entry_bytes = state_nbytes(compact_state(make_state([1] * 4)))
+        cache = PrefixKVCache(
+            capacity_bytes=entry_bytes * 2,
+            disk_dir=disk_dir,
+            min_prefix_tokens=2,
+        )
+        cache[[1, 1, 1, 1]] = make_state([1, 1, 1, 1])
+        cache[[2, 2, 2, 2]] = make_state([2, 2, 2, 2])
+        cache[[1, 1, 5]]  # освежаем первую запись
+        cache[[3, 3, 3, 3]] = make_state([3, 3, 3, 3])
+
+        stats = cache.stats()
+        assert stats["ram_entries"] == 2, stats
+        assert stats["disk_entries"] == 1, stats
+        assert stats["evictions"] == 1
+
+        # Вытесненная запись [2, 2, 2, 2] находится на диске и возвращается в RAM
+        state = cache[[2, 2, 2, 9]]
+        assert state.n_tokens == 4
+        stats = cache.stats()
+        assert stats["disk_hits"] == 1
+        assert stats["ram_bytes"] <= stats["ram_capacity_bytes"]
+
+        # Новый кэш удаляет только свои файлы .state, чужие файлы остаются
+        other_path = os.path.join(disk_dir, "model.gguf")
+        with open(other_path, "wb") as f:
+            f.write(b"GGUF")
+        PrefixKVCache(disk_dir=disk_dir)
+        assert os.listdir(disk_dir) == ["model.gguf"]
+        print(f"✅ Успешно: {stats}")
+
+if __name__ == "__main__":
+    test_prefix_lookup()
+    test_lru_eviction_to_disk()
+    print("\n✅ Все тесты кэша префиксов завершены")
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки профилирования запросов без загрузки модели
+"""
+
+import asyncio
+import os
+import tempfile
+import time
+from profiling import (
+    ProfilingMiddleware,
+    RequestProfile,
+    SlowestRequests,
+    StackSampler,
+    _current_profile,
+    instrument_llama,
+)
+
+class FakeLlama:
+    """Заглушка с методами, которые оборачивает профилирование"""
+
+    chat_handler = object()
+    chat_format = None
+
+    def tokenize(self, text, add_bos=True, special=False):
+        return [1, 2, 3]
+
+    def detokenize(self, tokens):
+        return b"abc"
+
+    def sample(self):
+        return 1
+
+    def eval(self, tokens):
+        time.sleep(0.01)
+
+    def create_completion(self, prompt):
+        self.eval(self.tokenize(prompt))
+        self.eval([1])
+        return {"text": self.detokenize([self.sample()]).decode()}
+
+def make_app(llama):
+    async def app(scope, receive, send):
+        result = await asyncio.to_thread(llama.create_completion, "привет")
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"application/json")]})
+        await send({"type": "http.response.body", "body": result["text"].encode()})
+    return app
+
+async def call(app, headers):
+    scope = {"type": "http", "method": "POST", "path": "/v1/completions", "headers": headers}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return dict(messages[0]["headers"])
+
+def test_phase_breakdown():
+    """Тестирует разбивку по фазам и заголовок Server-Timing"""
+    print("Тест 1: Время по фазам")
+
+    profile = RequestProfile("POST", "/v1/completions")
+    profile.add("prefill", 0.02)
+    profile.add("decode", 0.01)
+    profile.add("decode", 0.01)
+    profile.total = 0.05
+    breakdown = profile.breakdown()
+    assert round(breakdown["decode"]) == 20
+    assert round(breakdown["other"]) == 10
+    assert list(breakdown) == ["prefill", "decode", "other", "total"]
+    assert profile.server_timing().startswith("prefill;dur=20.00, decode;dur=20.00")
+    print(f"✅ Успешно: {profile.server_timing()}")
+
+def test_middleware():
+    """Тестирует профилирование по заголовку и сбор стеков"""
+    print("\nТест 2: Middleware профилирования")
+
+    llama = FakeLlama()
+    instrument_llama(llama)
+    with tempfile.TemporaryDirectory() as directory:
+        slowest = SlowestRequests(directory, top_n=5)
+        app = ProfilingMiddleware(make_app(llama), "header", StackSampler(0.001), slowest)
+
+        headers = asyncio.run(call(app, []))
+        assert b"server-timing" not in headers
+        headers = asyncio.run(call(app, [(b"x-profile", b"1")]))
+        timing = headers[b"server-timing"].decode()
+        assert "prefill;dur=" in timing and "decode;dur=" in timing and "tokenize;dur=" in timing
+
+        [profile] = slowest.snapshot()
+        assert profile["status"] == 200 and profile["stack_samples"] > 0
+        files = sorted(os.listdir(directory))
+        assert [f.rsplit(".", 1)[1] for f in files] == ["collapsed", "json"]
+        with open(os.path.join(directory, files[0])) as f:
+            stack, count = f.readline().rsplit(" ", 1)
+        assert stack.startswith("_bootstrap") and int(count) > 0
+    print(f"✅ Успешно: {timing}")
+
+def test_slowest_requests():
+    """Тестирует хранение только N самых медленных профилей"""
+    print("\nТест 3: Самые медленные запросы")
+
+    with tempfile.TemporaryDirectory() as directory:
+        slowest = SlowestRequests(directory, top_n=2)
+        for total in (0.3, 0.1, 0.5, 0.2):
+            profile = RequestProfile("POST", "/v1/completions")
+            profile.total = total
+            slowest.offer(profile)
+        totals = [p["phases_ms"]["total"] for p in slowest.snapshot()]
+        assert totals == [500.0, 300.0]
+        assert len(os.listdir(directory)) == 2
+    print(f"✅ Успешно: {totals}")
+
+def test_chat_template():
+    """Тестирует, что токенизация внутри обработчика чата не входит в chat_template"""
+    print("\nТест 4: Шаблон чата и потоки запроса")
+
+    class FakeChatLlama(FakeLlama):
+        chat_handler = None
+        chat_format = "fake"
+
+        def __init__(self):
+            self._chat_handlers = {"fake": self.handle_chat}
+
+        def tokenize(self, text, add_bos=True, special=False):
+            time.sleep(0.05)
+            return [1, 2, 3]
+
+        def handle_chat(self, llama, messages):
+            time.sleep(0.01)
+            return llama.create_completion(prompt=llama.tokenize(messages[0].encode()))
+
+        def create_completion(self, prompt):
+            return {"text": ""}
+
+    llama = FakeChatLlama()
+    instrument_llama(llama)
+    profile = RequestProfile("POST", "/v1/chat/completions")
+    token = _current_profile.set(profile)
+    try:
+        llama._chat_handlers["fake"](llama=llama, messages=["привет"])
+    finally:
+        _current_profile.reset(token)
+
+    assert profile.phases["tokenize"] >= 0.05
+    assert 0.01 <= profile.phases["chat_template"] < 0.05, profile.phases
+    # Поток снимается с профиля, когда вызов метода модели завершен
+    assert profile.threads == set()
+    print(f"✅ Успешно: {profile.breakdown()}")
+
+if __name__ == "__main__":
+    print("🧪 Тестирование профилирования запросов\n")
+    test_phase_breakdown()
+    test_middleware()
+    test_slowest_requests()
+    test_chat_template()
+    print("\n🎉 Все тесты пройдены!")
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки пула реплик без загрузки модели
+"""
+
+import anyio
+from replicas import Replica, ReplicaPool, split_threads
+
+def test_split_threads():
+    """Тестирует деление потоков между репликами"""
+    print("Тест 1: Деление N_THREADS между репликами")
+    slices = split_threads(16, 3)
+    assert slices == [6, 5, 5], slices
+    assert sum(slices) == 16
+    print(f"✅ Успешно: {slices}")
+
+def test_least_loaded_dispatch():
+    """Тестирует выбор наименее загруженной свободной реплики и очередь"""
+
+    async def scenario():
+        pool = ReplicaPool([Replica(i, f"proxy-{i}", 4) for i in range(2)])
+
+        # Реплика 0 уже отработала дольше, поэтому первый запрос уходит на 1
+        pool.replicas[0].busy_seconds = 5.0
+        first = await pool.acquire()
+        assert first.index == 1, first.index
+
+        second = await pool.acquire()
+        assert second.index == 0, second.index
+
+        # Обе реплики заняты - третий запрос должен ждать в очереди
+        acquired = []
+
+        async def waiter():
+            replica = await pool.acquire()
+            acquired.append(replica.index)
+            await pool.release(replica)
+
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(waiter)
+            await anyio.sleep(0.01)
+            assert pool.stats()["queue_depth"] == 1
+            await pool.release(first)
+
+        assert acquired == [1], acquired
+        await pool.release(second)
+
+        stats = pool.stats()
+        assert stats["queue_depth"] == 0
+        assert stats["busy"] == 0
+        assert [r["requests"] for r in stats["replicas"]] == [1, 2]
+        return stats
+
+    print("\nТест 2: Диспетчеризация на наименее загруженную реплику")
+    stats = anyio.run(scenario)
+    print(f"✅ Успешно: {stats}")
+
+if __name__ == "__main__":
+    test_split_threads()
+    test_least_loaded_dispatch()
+    print("\n✅ Все тесты пула реплик завершены")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки кэша ответов без загрузки модели
+"""
+
+import json
+import time
+import asyncio
+from response_cache import ResponseCache, ResponseCacheMiddleware, make_cache_key, stream_finished
+
+def test_cache_key_normalization():
+    """Тестирует нормализацию ключа и отбор детерминированных запросов"""
+    print("Тест 1: Нормализация ключа кэша")
+    messages = [{"role": "user", "content": "Извлеки дату"}]
+    explicit = json.dumps({"messages": messages, "temperature": 0, "top_p": 0.95})
+    implicit = json.dumps({"temperature": 0.0, "messages": messages})
+    key = make_cache_key("/v1/chat/completions", explicit.encode(), "chatml")
+    assert key is not None
+    assert key == make_cache_key("/v1/chat/completions", implicit.encode(), "chatml")
+
+    # chat_format и stream входят в ключ
+    assert key != make_cache_key("/v1/chat/completions", implicit.encode(), "llama-2")
+    streamed = json.dumps({"messages": messages, "temperature": 0, "stream": True})
+    assert key != make_cache_key("/v1/chat/completions", streamed.encode(), "chatml")
+
+    # Недетерминированные и некорректные запросы не кэшируются
+    sampled = json.dumps({"messages": messages, "temperature": 0.7})
+    assert make_cache_key("/v1/chat/completions", sampled.encode(), "chatml") is None
+    assert make_cache_key("/v1/chat/completions", b"{", "chatml") is None
+    assert make_cache_key("/v1/embeddings", explicit.encode(), "chatml") is None
+    print("✅ Успешно")
+
+def test_ttl_and_lru():
+    """Тестирует истечение TTL и вытеснение по бюджету байтов"""
+    print("\nТест 2: TTL и LRU-вытеснение")
+    cache = ResponseCache(ttl=3600, capacity_bytes=10)
+    cache.put("a", "application/json", b"12345")
+    cache.put("b", "application/json", b"12345")
+    assert cache.get("a") == ("application/json", b"12345")
+    cache.put("c", "application/json", b"12345")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+
+    expiring = ResponseCache(ttl=0, capacity_bytes=10)
+    expiring.put("a", "application/json", b"1")
+    time.sleep(0.01)
+    assert expiring.get("a") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 2 and stats["misses"] == 1
+    assert stats["bytes_saved"] == 10
+    assert stats["evictions"] == 1
+    print(f"✅ Успешно: {stats}")
+
+def test_interrupted_stream():
+    """Тестирует, что прерванный поток с [DONE] не считается законченным"""
+    print("\nТест 3: Прерванный поток")
+
+    def event(finish_reason):
+        chunk = {"choices": [{"index": 0, "delta": {"content": "а"}, "finish_reason": finish_reason}]}
+        return f"data: {json.dumps(chunk)}\r\n\r\n".encode()
+
+    done = b"data: [DONE]\r\n\r\n"
+    interrupted = event(None) + event(None) + done
+    finished = event(None) + event("length") + b": ping\r\n\r\n" + done
+    assert not stream_finished(interrupted)
+    assert not stream_finished(event("stop"))
+    assert stream_finished(finished)
+
+    # Через middleware прерванный поток в кэш не попадает, законченный - попадает
+    cache = ResponseCache(ttl=3600, capacity_bytes=1024 * 1024)
+    request = json.dumps({"prompt": "привет", "temperature": 0, "stream": True}).encode()
+
+    async def run(stream_body):
+        async def app(scope, receive, send):
+            await receive()
+            await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/event-stream")]})
+            await send({"type": "http.response.body", "body": stream_body})
+
+        async def receive():
+            return {"type": "http.request", "body": request, "more_body": False}
+
+        async def send(message):
+            pass
+
+        scope = {"type": "http", "method": "POST", "path": "/v1/completions", "headers": []}
+        await ResponseCacheMiddleware(app, cache)(scope, receive, send)
+
+    asyncio.run(run(interrupted))
+    assert cache.stats()["entries"] == 0
+    asyncio.run(run(finished))
+    assert cache.stats()["entries"] == 1
+    print("✅ Успешно")
+
+if __name__ == "__main__":
+    test_cache_key_normalization()
+    test_ttl_and_lru()
+    test_interrupted_stream()
+    print("\n✅ Все тесты кэша ответов завершены")
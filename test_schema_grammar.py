@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки кэша грамматик JSON-схем без загрузки модели
+"""
+
+import asyncio
+import json
+from llama_cpp.llama_chat_format import _grammar_for_response_format
+from schema_grammar import GrammarCache, SchemaError, SchemaGrammarMiddleware, grammar_source, schema_key
+
+SCHEMA = {
+    "type": "object",
+    "properties": {"name": {"type": "string"}, "age": {"type": "integer"}},
+    "required": ["name", "age"],
+}
+
+def test_cache():
+    """Тестирует LRU по каноническому хэшу схемы и счетчики"""
+    print("Тест 1: Кэш грамматик")
+
+    cache = GrammarCache(max_entries=2)
+    grammar = cache.get(SCHEMA)
+    assert "root ::=" in grammar
+    # Порядок ключей не влияет на ключ кэша
+    reordered = {"required": ["name", "age"], "properties": SCHEMA["properties"], "type": "object"}
+    assert schema_key(reordered) == schema_key(SCHEMA)
+    assert cache.get(reordered) is grammar
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Порядок полей в properties сохраняется и входит в ключ
+    swapped = dict(SCHEMA, properties={"age": SCHEMA["properties"]["age"], "name": SCHEMA["properties"]["name"]})
+    assert schema_key(swapped) != schema_key(SCHEMA)
+
+    cache.get({"type": "string"})
+    cache.get({"type": "integer"})
+    assert cache.lookup(SCHEMA) is None
+    assert cache.stats()["entries"] == 2
+    print(f"✅ Успешно: {cache.stats()}")
+
+def test_matches_stock_grammar():
+    """Тестирует, что грамматика из кэша совпадает с грамматикой llama_cpp"""
+    print("\nТест 2: Совпадение с llama_cpp")
+
+    schema = {
+        "type": "object",
+        "properties": {"reasoning": {"type": "string"}, "answer": {"type": "integer"}},
+        "required": ["reasoning", "answer"],
+    }
+    grammar = GrammarCache().get(schema)
+    stock = _grammar_for_response_format({"type": "json_object", "schema": schema}, verbose=False)
+    assert grammar == stock._grammar
+    root = next(line for line in grammar.splitlines() if line.startswith("root ::="))
+    assert root.index("reasoning-kv") < root.index("answer-kv")
+    print(f"✅ Успешно: {root}")
+
+def test_named_schemas():
+    """Тестирует регистрацию схем по имени и ошибки"""
+    print("\nТест 3: Именованные схемы")
+
+    cache = GrammarCache(max_entries=1)
+    cache.register("person", SCHEMA)
+    cache.get({"type": "string"})
+    cache.get({"type": "integer"})
+    # Именованные схемы не вытесняются из LRU
+    assert cache.named("person") == cache._compile(SCHEMA)
+    assert grammar_source({"type": "json_schema", "json_schema": {"name": "person"}}) == ("name", "person")
+    assert grammar_source({"type": "json_object"}) is None
+    for call in (lambda: cache.named("missing"), lambda: grammar_source({"type": "json_schema", "json_schema": {}})):
+        try:
+            call()
+            assert False, "ожидалась SchemaError"
+        except SchemaError:
+            pass
+    assert cache.unregister("person") and not cache.unregister("person")
+    print(f"✅ Успешно: {cache.stats()['hits']} попаданий")
+
+def test_middleware():
+    """Тестирует замену response_format на grammar в теле запроса"""
+    print("\nТест 4: Подстановка грамматики в запрос")
+
+    cache = GrammarCache()
+    cache.register("person", SCHEMA)
+    received = {}
+
+    async def app(scope, receive, send):
+        message = await receive()
+        received["body"] = json.loads(message["body"])
+        received["headers"] = dict(scope["headers"])
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"{}"})
+
+    async def call(body):
+        raw = json.dumps(body).encode()
+        scope = {"type": "http", "method": "POST", "path": "/v1/chat/completions",
+                 "headers": [(b"content-length", str(len(raw)).encode())]}
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": raw, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        await SchemaGrammarMiddleware(app, cache)(scope, receive, send)
+        return messages[0]["status"]
+
+    messages = [{"role": "user", "content": "привет"}]
+    assert asyncio.run(call({"messages": messages, "response_format": {"type": "json_schema", "json_schema": {"name": "person"}}})) == 200
+    assert "response_format" not in received["body"]
+    assert received["body"]["grammar"] == cache.named("person")
+    assert int(received["headers"][b"content-length"]) == len(json.dumps(received["body"]).encode())
+
+    assert asyncio.run(call({"messages": messages, "response_format": {"type": "json_schema", "json_schema": {"name": "nope"}}})) == 400
+    assert asyncio.run(call({"messages": messages, "response_format": {"type": "text"}})) == 200
+    assert received["body"]["response_format"] == {"type": "text"}
+    print("✅ Успешно")
+
+if __name__ == "__main__":
+    print("🧪 Тестирование кэша грамматик JSON-схем\n")
+    test_cache()
+    test_matches_stock_grammar()
+    test_named_schemas()
+    test_middleware()
+    print("\n🎉 Все тесты пройдены!")
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки хранилища сессий KV без загрузки модели
+"""
+
+import os
+import tempfile
+import time
+import numpy as np
+import llama_cpp
+from sessions import SessionCache, SessionStore, _current_turn, _Turn
+
+def make_state(tokens, state_bytes=1000, n_vocab=8, n_ctx=64, seed=7):
+    """Создает фиктивное состояние llama для заданных токенов"""
+    input_ids = np.zeros(n_ctx, dtype=np.intc)
+    input_ids[: len(tokens)] = tokens
+    return llama_cpp.LlamaState(
+        input_ids=input_ids,
+        scores=np.arange(len(tokens) * n_vocab, dtype=np.single).reshape(len(tokens), n_vocab),
+        n_tokens=len(tokens),
+        llama_state=bytes(range(256)) * (state_bytes // 256),
+        llama_state_size=state_bytes // 256 * 256,
+        seed=seed,
+    )
+
+def test_save_restore():
+    """Тестирует сохранение, восстановление после перезапуска и удаление"""
+    print("Тест 1: Сохранение и восстановление")
+    with tempfile.TemporaryDirectory() as directory:
+        store = SessionStore(directory)
+        original = make_state([1, 2, 3, 4])
+        store.save("chat-1", original)
+        store.close()
+
+        store = SessionStore(directory)
+        state = store.load("chat-1", n_ctx=64)
+        assert state.n_tokens == 4 and state.seed == 7
+        assert list(state.input_ids[:4]) == [1, 2, 3, 4] and len(state.input_ids) == 64
+        assert np.array_equal(state.scores, original.scores[-1:])
+        assert state.llama_state == original.llama_state
+        assert store.load("chat-1", n_ctx=2) is None
+
+        assert store.delete("chat-1") and not store.delete("chat-1")
+        store.close()
+        assert SessionStore(directory).load("chat-1", n_ctx=64) is None
+
+        # Отрицательный seed сохраняется без ошибки и восстанавливается как есть
+        store = SessionStore(directory)
+        store.save("chat-2", make_state([5, 6], seed=-1))
+        store.close()
+        assert SessionStore(directory).load("chat-2", n_ctx=64).seed == -1
+    print("✅ Успешно")
+
+def test_limits_and_compaction():
+    """Тестирует TTL, вытеснение по размеру, компактификацию и поврежденный хвост"""
+    print("\nТест 2: Ограничения и компактификация")
+    with tempfile.TemporaryDirectory() as directory:
+        store = SessionStore(directory, ttl=3600)
+        store.save("old", make_state([1, 2]))
+        store._index["old"].saved_at = time.time() - 7200
+        assert store.load("old", n_ctx=64) is None
+        assert store.stats()["expirations"] == 1
+
+        store.save("s0", make_state([0, 0]))
+        store.capacity_bytes = store.stats()["live_bytes"] * 3
+        for i in range(1, 5):
+            store.save(f"s{i}", make_state([i, i]))
+        assert store.stats()["sessions"] == 3 and store.stats()["evictions"] == 2
+        assert store.load("s0", n_ctx=64) is None and store.load("s4", n_ctx=64) is not None
+
+        for _ in range(2000):
+            store.save("s4", make_state([4, 4]))
+        stats = store.stats()
+        assert stats["compactions"] >= 1
+        assert stats["file_bytes"] < stats["live_bytes"] + 2 * 1024 * 1024
+        assert store.load("s3", n_ctx=64).n_tokens == 2
+        store.close()
+
+        with open(os.path.join(directory, "sessions.kv"), "ab") as f:
+            f.write(b"KVS1 truncated")
+        store = SessionStore(directory)
+        assert store.stats()["sessions"] == 3
+        store.close()
+    print(f"✅ Успешно: {stats}")
+
+def test_session_cache():
+    """Тестирует выдачу состояния сессии llama и передачу остальных запросов кэшу"""
+    print("\nТест 3: Кэш llama для сессий")
+    with tempfile.TemporaryDirectory() as directory:
+        store = SessionStore(directory)
+        cache = SessionCache(store, n_ctx=64)
+        try:
+            cache[[1, 2, 3]]
+            assert False, "без сессии и внутреннего кэша ожидался промах"
+        except KeyError:
+            pass
+
+        turn = _Turn("chat-1")
+        token = _current_turn.set(turn)
+        try:
+            cache[[1, 2, 3, 4]] = make_state([1, 2, 3, 4])
+            state = cache[[1, 2, 3, 4, 5, 6]]
+            assert state.n_tokens == 4 and turn.restored_tokens == 4
+        finally:
+            _current_turn.reset(token)
+        assert store.stats()["restored_tokens"] == 4
+        store.close()
+    print("✅ Успешно")
+
+if __name__ == "__main__":
+    test_save_restore()
+    test_limits_and_compaction()
+    test_session_cache()
+    print("\n✅ Все тесты сессий завершены")
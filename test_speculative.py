@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки учета спекулятивного декодирования без загрузки модели
+"""
+
+import os
+import numpy as np
+from speculative import SpeculativeStats, TrackedDraftModel, read_speculative_settings
+
+class FixedDraft:
+    """Черновая модель, всегда предлагающая одни и те же токены"""
+
+    def __init__(self, tokens):
+        self.tokens = np.array(tokens, dtype=np.intc)
+
+    def __call__(self, input_ids, **kwargs):
+        return self.tokens
+
+def test_acceptance_tracking():
+    """Тестирует вывод числа принятых токенов по длине следующего входа"""
+    print("Тест 1: Учет принятых черновых токенов")
+    stats = SpeculativeStats("draft-model", 3)
+    draft = TrackedDraftModel(FixedDraft([4, 5, 6]), stats)
+
+    draft(np.array([1, 2, 3], dtype=np.intc))
+    # Приняты 4 и 5, третий токен основная модель выбрала сама
+    draft(np.array([1, 2, 3, 4, 5, 9], dtype=np.intc))
+    assert (stats.drafted, stats.accepted) == (3, 2)
+
+    # Все черновые токены приняты, плюс собственный токен модели
+    draft(np.array([1, 2, 3, 4, 5, 9, 4, 5, 6, 7], dtype=np.intc))
+    assert (stats.drafted, stats.accepted) == (6, 5)
+
+    # Новый запрос с другим промптом не учитывается как продолжение
+    draft(np.array([8, 8], dtype=np.intc))
+    assert stats.proposals == 2
+    snapshot = stats.snapshot()
+    assert snapshot["acceptance_rate"] == round(5 / 6, 4)
+    assert "llama_speculative_accepted_tokens_total 5" in list(stats.render())
+    print(f"✅ Успешно: {snapshot}")
+
+def test_settings():
+    """Тестирует чтение DRAFT_MODEL_PATH, PROMPT_LOOKUP и DRAFT_TOKENS"""
+    print("\nТест 2: Настройки")
+    saved = {name: os.environ.pop(name, None) for name in ("DRAFT_MODEL_PATH", "PROMPT_LOOKUP", "DRAFT_TOKENS")}
+    try:
+        assert read_speculative_settings() is None
+        os.environ["PROMPT_LOOKUP"] = "1"
+        assert read_speculative_settings() == {"draft_model_path": None, "draft_tokens": 10}
+        os.environ["DRAFT_MODEL_PATH"] = "/nonexistent/draft.gguf"
+        try:
+            read_speculative_settings()
+            assert False, "ожидалась ошибка"
+        except FileNotFoundError:
+            pass
+        os.environ["DRAFT_MODEL_PATH"] = __file__
+        os.environ["DRAFT_TOKENS"] = "5"
+        assert read_speculative_settings() == {"draft_model_path": __file__, "draft_tokens": 5}
+    finally:
+        for name, value in saved.items():
+            os.environ.pop(name, None)
+            if value is not None:
+                os.environ[name] = value
+    print("✅ Успешно")
+
+if __name__ == "__main__":
+    test_acceptance_tracking()
+    test_settings()
+    print("\n✅ Все тесты спекулятивного декодирования завершены")
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки быстрого старта и проб готовности
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+from startup import StartupApp, prefetch_model_file
+
+def call(app, path):
+    """Выполняет GET-запрос к ASGI-приложению и возвращает (статус, тело)"""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": path, "headers": []}
+    asyncio.run(app(scope, receive, send))
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return messages[0]["status"], json.loads(body) if body else None
+
+def test_probes():
+    """Тестирует ответы проб до и после готовности"""
+    print("Тест 1: /health/live и /health/ready")
+    startup = StartupApp()
+    with startup.track_phase("load"):
+        assert call(startup, "/health/ready")[1]["phase"] == "load"
+
+    assert call(startup, "/health/live")[0] == 200
+    assert call(startup, "/health/ready")[0] == 503
+    assert call(startup, "/v1/models")[0] == 503
+
+    async def inner(scope, receive, send):
+        await send({"type": "http.response.start", "status": 204, "headers": []})
+        await send({"type": "http.response.body", "body": b""})
+
+    startup.set_ready(inner)
+    status, body = call(startup, "/health/ready")
+    assert status == 200 and "load" in body["timings"]
+    assert call(startup, "/v1/models")[0] == 204
+
+    startup.set_failed("boom")
+    assert call(startup, "/health/live")[0] == 503
+    print(f"✅ Успешно: {body}")
+
+def test_prefetch():
+    """Тестирует чтение файла модели в page cache"""
+    print("\nТест 2: Предзагрузка файла модели")
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "model.gguf")
+        with open(path, "wb") as f:
+            f.write(b"\1" * 100000)
+        assert prefetch_model_file(path, chunk_size=4096) == 100000
+    print("✅ Успешно")
+
+if __name__ == "__main__":
+    test_probes()
+    test_prefetch()
+    print("\n✅ Все тесты быстрого старта завершены")
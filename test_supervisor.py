@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки многопроцессного режима без запуска рабочих процессов
+"""
+
+import os
+import tempfile
+import time
+from cpu_tuning import split_cpu_sets
+from supervisor import (
+    SUPERVISOR_STATE,
+    Supervisor,
+    WorkerStats,
+    aggregate_worker_stats,
+    write_json_atomic,
+)
+
+def test_cpu_sets():
+    """Тестирует деление CPU на непересекающиеся наборы по физическим ядрам"""
+    print("Тест 1: Наборы CPU рабочих процессов")
+    cores = [[0, 8], [1, 9], [2, 10], [3, 11]]
+    assert split_cpu_sets(cores, 2) == [[0, 1, 8, 9], [2, 3, 10, 11]]
+    assert split_cpu_sets(cores, 3) == [[0, 1, 8, 9], [2, 10], [3, 11]]
+    # Наборов больше, чем ядер: делятся логические CPU
+    assert split_cpu_sets([[0, 1], [2, 3]], 3) == [[0, 1], [2], [3]]
+    try:
+        split_cpu_sets([[0]], 2)
+        assert False, "ожидалась ошибка"
+    except ValueError:
+        pass
+    print("✅ Успешно")
+
+def test_restart_delay():
+    """Тестирует экспоненциальную задержку перезапуска при падениях на старте"""
+    print("\nТест 2: Задержка перезапуска")
+    supervisor = Supervisor("127.0.0.1", 0, [[0]], lambda sockets: 0, tempfile.gettempdir())
+    slot = supervisor.slots[0]
+    slot.started_at = time.time() - 3600
+    assert supervisor._restart_delay(slot) == 0.0
+    slot.started_at = time.time()
+    delays = [supervisor._restart_delay(slot) for _ in range(7)]
+    assert delays == [1.0, 2.0, 4.0, 8.0, 16.0, 30.0, 30.0]
+    print(f"✅ Успешно: {delays}")
+
+def test_aggregation():
+    """Тестирует сводку статистики рабочих процессов"""
+    print("\nТест 3: Сводная статистика")
+    with tempfile.TemporaryDirectory() as stats_dir:
+        write_json_atomic(os.path.join(stats_dir, SUPERVISOR_STATE), {
+            "pid": 1,
+            "workers": [
+                {"index": 0, "pid": os.getpid(), "cpus": [0], "restarts": 2, "started_at": 0},
+                {"index": 1, "pid": 12345, "cpus": [1], "restarts": 0, "started_at": 0},
+            ],
+        })
+        stats = WorkerStats(0, stats_dir)
+        stats.requests = 3
+        stats.write()
+        # Файл предыдущего процесса слота 1 не учитывается
+        write_json_atomic(os.path.join(stats_dir, "worker-1.json"), dict(stats.snapshot(), index=1, pid=999))
+
+        result = aggregate_worker_stats(stats_dir)
+        assert result["totals"]["requests"] == 3
+        assert result["totals"]["ready_workers"] == 1 and result["totals"]["restarts"] == 2
+        assert result["workers"][0]["ready"] and not result["workers"][0]["stale"]
+        assert not result["workers"][1]["ready"]
+    print(f"✅ Успешно: {result['totals']}")
+
+if __name__ == "__main__":
+    test_cpu_sets()
+    test_restart_delay()
+    test_aggregation()
+    print("\n✅ Все тесты многопроцессного режима завершены")
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Тестовый скрипт для проверки маршрутизатора по стоимости в токенах без загрузки модели
+"""
+
+import asyncio
+from token_router import CachedTokenizer, TokenBudgetRouter, estimate_cost
+
+class FakeLlama:
+    """Токенизатор-заглушка: один токен на слово"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def tokenize(self, text, add_bos=True, special=False):
+        self.calls += 1
+        return [1] + [2] * len(text.split())
+
+    def n_ctx(self):
+        return 4096
+
+async def run_in_order(router, requests):
+    """Занимает единственный слот, ставит запросы в очередь и возвращает порядок допуска"""
+    await router.acquire(1, "short")
+    order = []
+
+    async def waiter(name, cost):
+        lane = router.lane_for(cost)
+        await router.acquire(cost, lane)
+        order.append(name)
+        await asyncio.sleep(0)
+        router.release(lane)
+
+    tasks = []
+    for name, cost in requests:
+        tasks.append(asyncio.create_task(waiter(name, cost)))
+        await asyncio.sleep(0)
+    router.release("short")
+    await asyncio.gather(*tasks)
+    return order
+
+def test_lanes():
+    """Тестирует приоритет короткой полосы и порядок внутри полос"""
+    print("Тест 1: Полосы коротких и длинных запросов")
+
+    router = TokenBudgetRouter(slots=1, policy="lanes", long_tokens=100, long_slots=1)
+    order = asyncio.run(run_in_order(router, [("long1", 500), ("short1", 20), ("long2", 200), ("short2", 50)]))
+    assert order == ["short1", "short2", "long1", "long2"], order
+    stats = router.stats()
+    assert stats["lanes"]["long"]["requests"] == 2
+    assert stats["lanes"]["short"]["requests"] == 3
+    assert router.in_flight == 0
+    print(f"✅ Успешно: {order}")
+
+def test_sjf_and_long_slots():
+    """Тестирует SJF и ограничение слотов длинной полосы"""
+    print("\nТест 2: SJF и лимит длинной полосы")
+
+    router = TokenBudgetRouter(slots=1, policy="sjf", long_tokens=100)
+    order = asyncio.run(run_in_order(router, [("c", 300), ("a", 10), ("b", 120)]))
+    assert order == ["a", "b", "c"], order
+
+    async def scenario():
+        router = TokenBudgetRouter(slots=3, policy="lanes", long_tokens=100, long_slots=1)
+        await router.acquire(500, "long")
+        second = asyncio.create_task(router.acquire(500, "long"))
+        await asyncio.sleep(0.01)
+        # Свободные слоты есть, но длинная полоса заполнена
+        assert not second.done() and router.in_flight == 1
+        assert await router.acquire(10, "short") == 0.0
+        router.release("long")
+        await second
+        return router.lanes["long"].in_flight
+
+    assert asyncio.run(scenario()) == 1
+    print(f"✅ Успешно: {order}")
+
+def test_starvation_guard():
+    """Тестирует обслуживание вне очереди после max_wait"""
+    print("\nТест 3: Защита от голодания длинных запросов")
+
+    async def scenario():
+        router = TokenBudgetRouter(slots=1, policy="lanes", long_tokens=100, max_wait=0.05)
+        await router.acquire(1, "short")
+        long_task = asyncio.create_task(router.acquire(500, "long"))
+        await asyncio.sleep(0.1)
+        short_task = asyncio.create_task(router.acquire(10, "short"))
+        await asyncio.sleep(0)
+        router.release("short")
+        await long_task
+        assert not short_task.done()
+        router.release("long")
+        await short_task
+        router.release("short")
+        return router
+
+    router = asyncio.run(scenario())
+    assert router.promoted == 1
+    print(f"✅ Успешно: {router.stats()['promoted_after_max_wait']}")
+
+def test_cached_tokenizer():
+    """Тестирует кэш токенизации и оценку стоимости"""
+    print("\nТест 4: Кэш токенизатора и оценка стоимости")
+
+    llama = FakeLlama()
+    tokenizer = CachedTokenizer(llama, max_entries=2)
+    body = {"prompt": "раз два три", "max_tokens": 10}
+    assert estimate_cost(tokenizer, "completion", body, 4096, 256) == 14
+    assert estimate_cost(tokenizer, "completion", body, 4096, 256) == 14
+    assert llama.calls == 1 and tokenizer.hits == 1
+
+    # Готовые токены не токенизируются, max_tokens ограничен контекстом
+    assert estimate_cost(tokenizer, "completion", {"prompt": [1, 2, 3], "max_tokens": 8000}, 4096, 256) == 4096
+    assert estimate_cost(tokenizer, "completion", {"prompt": "а", "max_tokens": None}, 4096, 256) == 258
+    assert llama.calls == 2
+    print(f"✅ Успешно: попаданий {tokenizer.hits}, промахов {tokenizer.misses}")
+
+if __name__ == "__main__":
+    print("🧪 Тестирование маршрутизатора по стоимости в токенах\n")
+    test_lanes()
+    test_sjf_and_long_slots()
+    test_starvation_guard()
+    test_cached_tokenizer()
+    print("\n🎉 Все тесты пройдены!")
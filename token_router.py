@@ -0,0 +1,386 @@
+"""
+Маршрутизатор запросов по стоимости в токенах: короткие интерактивные
+запросы не ждут за длинными prefill
+"""
+
+import asyncio
+import collections
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import llama_cpp
+from fastapi import APIRouter, FastAPI
+from starlette.concurrency import run_in_threadpool
+
+from chat_prompt import render_chat_prompt
+from env_settings import read_bool, read_float, read_int
+from metrics import LATENCY_BUCKETS, Histogram
+from server_hooks import buffer_request_body
+
+# Пути генерации и вид тела запроса
+ROUTED_PATHS = {
+    "/v1/completions": "completion",
+    "/v1/chat/completions": "chat",
+    "/v1/engines/copilot-codex/completions": "completion",
+}
+
+POLICIES = ("lanes", "sjf")
+LANES = ("short", "long")
+
+# Значение max_tokens по умолчанию в CreateCompletionRequest llama_cpp
+COMPLETION_DEFAULT_MAX_TOKENS = 16
+
+
+def read_router_settings(default_slots: int) -> Optional[dict]:
+    """Читает настройки ROUTER_*; возвращает None, если маршрутизатор выключен"""
+    if not read_bool("ROUTER"):
+        return None
+    policy = (os.getenv("ROUTER_POLICY") or "lanes").strip().lower()
+    if policy not in POLICIES:
+        raise ValueError(f"ROUTER_POLICY должен быть одним из: {', '.join(POLICIES)}")
+    slots = read_int("ROUTER_SLOTS", default_slots)
+    return {
+        "slots": slots,
+        "policy": policy,
+        "long_tokens": read_int("ROUTER_LONG_TOKENS", 1024),
+        "long_slots": read_int("ROUTER_LONG_SLOTS", max(slots // 2, 1)),
+        "max_wait": read_float("ROUTER_MAX_WAIT", 30.0),
+        "default_max_tokens": read_int("ROUTER_DEFAULT_MAX_TOKENS", 256),
+    }
+
+
+def percentile(values, q: float) -> Optional[float]:
+    """Перцентиль по методу ближайшего ранга"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(len(ordered) * q / 100 + 0.999999) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+class CachedTokenizer:
+    """Подсчет токенов промпта с LRU-кэшем по хэшу тела
+
+    Клиенты повторяют одни и те же системные промпты и истории диалогов,
+    поэтому повторная токенизация (и рендеринг chat-шаблона) не нужна.
+    """
+
+    def __init__(self, llama: llama_cpp.Llama, max_entries: int = 4096):
+        self.llama = llama
+        self.max_entries = max_entries
+        self._counts: "OrderedDict[bytes, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _tokenize(self, kind: str, payload) -> int:
+        if kind == "chat":
+            rendered = render_chat_prompt(self.llama, payload)
+            if rendered is not None:
+                return len(rendered[0])
+            text = "\n".join(str(m.get("content") or "") for m in payload)
+        else:
+            if isinstance(payload, list):
+                if payload and isinstance(payload[0], int):
+                    return len(payload)
+                payload = payload[0] if payload else ""
+            text = payload
+        return len(self.llama.tokenize(text.encode("utf-8"), True, True))
+
+    def count(self, kind: str, payload) -> int:
+        key = hashlib.blake2b(
+            json.dumps([kind, payload], sort_keys=True).encode("utf-8"), digest_size=16
+        ).digest()
+        with self._lock:
+            n_tokens = self._counts.get(key)
+            if n_tokens is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return n_tokens
+            self.misses += 1
+
+        n_tokens = self._tokenize(kind, payload)
+        with self._lock:
+            self._counts[key] = n_tokens
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+        return n_tokens
+
+
+class _Waiter:
+    __slots__ = ("cost", "seq", "lane", "future", "enqueued_at")
+
+    def __init__(self, cost: int, seq: int, lane: str, future: asyncio.Future):
+        self.cost = cost
+        self.seq = seq
+        self.lane = lane
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+
+class LaneStats:
+    """Задержки одной полосы: гистограммы для /metrics и недавние значения для перцентилей"""
+
+    def __init__(self, window: int = 1024):
+        self.requests = 0
+        self.in_flight = 0
+        self.queued = 0
+        self.queue_waits = collections.deque(maxlen=window)
+        self.latencies = collections.deque(maxlen=window)
+
+    def snapshot(self) -> dict:
+        def summary(values) -> dict:
+            values = list(values)
+            return {
+                f"p{q}": round(percentile(values, q), 4) if values else None
+                for q in (50, 95, 99)
+            }
+
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "queue_wait_seconds": summary(self.queue_waits),
+            "latency_seconds": summary(self.latencies),
+        }
+
+
+class TokenBudgetRouter:
+    """Раздает слоты модели по оценке стоимости запроса в токенах
+
+    Стоимость - длина промпта плюс max_tokens. Политика "lanes" делит
+    запросы на короткую и длинную полосы по порогу long_tokens: короткие
+    обслуживаются первыми, длинные занимают не больше long_slots слотов,
+    внутри полосы - в порядке поступления. Политика "sjf" выбирает самый
+    дешевый ожидающий запрос. Запрос, прождавший дольше max_wait секунд,
+    обслуживается вне очереди, чтобы длинные не голодали.
+    """
+
+    def __init__(
+        self,
+        slots: int,
+        policy: str = "lanes",
+        long_tokens: int = 1024,
+        long_slots: int = 1,
+        max_wait: float = 30.0,
+    ):
+        self.slots = slots
+        self.policy = policy
+        self.long_tokens = long_tokens
+        self.long_slots = long_slots
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._waiters: list = []
+        self._counter = itertools.count()
+        self.lanes = {lane: LaneStats() for lane in LANES}
+        self.promoted = 0
+
+        self.queue_wait = Histogram(
+            "llama_router_queue_wait_seconds",
+            "Time spent waiting in the token-budget router by lane",
+            LATENCY_BUCKETS,
+            ("lane",),
+        )
+        self.latency = Histogram(
+            "llama_router_request_duration_seconds",
+            "Request duration including router wait by lane",
+            LATENCY_BUCKETS,
+            ("lane",),
+        )
+
+    def lane_for(self, cost: int) -> str:
+        return "long" if cost >= self.long_tokens else "short"
+
+    def _eligible(self, waiter: _Waiter) -> bool:
+        if self.policy == "lanes" and waiter.lane == "long":
+            return self.lanes["long"].in_flight < self.long_slots
+        return True
+
+    def _pick(self) -> Optional[_Waiter]:
+        eligible = [w for w in self._waiters if self._eligible(w)]
+        if not eligible:
+            return None
+        oldest = min(eligible, key=lambda w: w.seq)
+        if time.perf_counter() - oldest.enqueued_at >= self.max_wait:
+            self.promoted += 1
+            return oldest
+        if self.policy == "sjf":
+            return min(eligible, key=lambda w: (w.cost, w.seq))
+        short = [w for w in eligible if w.lane == "short"]
+        return min(short or eligible, key=lambda w: w.seq)
+
+    def _grant(self, lane: str):
+        self.in_flight += 1
+        self.lanes[lane].in_flight += 1
+        self.lanes[lane].requests += 1
+
+    def _dispatch(self):
+        while self.in_flight < self.slots:
+            waiter = self._pick()
+            if waiter is None:
+                return
+            self._waiters.remove(waiter)
+            self.lanes[waiter.lane].queued -= 1
+            if not waiter.future.done():
+                self._grant(waiter.lane)
+                waiter.future.set_result(None)
+
+    async def acquire(self, cost: int, lane: str) -> float:
+        """Ждет слот и возвращает время ожидания"""
+        waiter = _Waiter(cost, next(self._counter), lane, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self.lanes[lane].queued += 1
+        self._dispatch()
+        if waiter.future.done():
+            return 0.0
+        try:
+            await asyncio.shield(waiter.future)
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self.lanes[lane].queued -= 1
+            elif waiter.future.done() and not waiter.future.cancelled():
+                # Слот уже был передан этому запросу - возвращаем его
+                self.release(lane)
+            raise
+        return time.perf_counter() - waiter.enqueued_at
+
+    def release(self, lane: str):
+        self.in_flight -= 1
+        self.lanes[lane].in_flight -= 1
+        self._dispatch()
+
+    def observe(self, lane: str, queue_wait: float, latency: float):
+        self.lanes[lane].queue_waits.append(queue_wait)
+        self.lanes[lane].latencies.append(latency)
+        self.queue_wait.observe(queue_wait, lane)
+        self.latency.observe(latency, lane)
+
+    def render(self):
+        """Строки в формате Prometheus для /metrics"""
+        yield from self.queue_wait.render()
+        yield from self.latency.render()
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "slots": self.slots,
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "long_tokens": self.long_tokens,
+            "long_slots": self.long_slots,
+            "promoted_after_max_wait": self.promoted,
+            "lanes": {lane: stats.snapshot() for lane, stats in self.lanes.items()},
+        }
+
+
+def estimate_cost(
+    tokenizer: CachedTokenizer, kind: str, body: dict, n_ctx: int, default_max_tokens: int
+) -> int:
+    """Стоимость запроса: токены промпта плюс ожидаемое число токенов ответа"""
+    if kind == "chat":
+        n_prompt = tokenizer.count(kind, body.get("messages") or [])
+        max_tokens = body.get("max_tokens")
+        if max_tokens is None:
+            max_tokens = default_max_tokens
+    else:
+        n_prompt = tokenizer.count(kind, body.get("prompt", ""))
+        max_tokens = body.get("max_tokens", COMPLETION_DEFAULT_MAX_TOKENS)
+        if max_tokens is None or max_tokens <= 0:
+            max_tokens = default_max_tokens
+    return n_prompt + min(max_tokens, max(n_ctx - n_prompt, 0))
+
+
+class TokenRouterMiddleware:
+    """ASGI middleware, пропускающее запросы генерации через TokenBudgetRouter
+
+    Тело запроса читается и токенизируется до постановки в очередь.
+    Полоса и оценка стоимости возвращаются в заголовках X-Router-Lane и
+    X-Router-Cost, ожидание - в X-Router-Wait-Ms и в scope["state"]["queue_wait"].
+    """
+
+    def __init__(self, app, router: TokenBudgetRouter, tokenizer: CachedTokenizer, default_max_tokens: int):
+        self.app = app
+        self.router = router
+        self.tokenizer = tokenizer
+        self.n_ctx = tokenizer.llama.n_ctx()
+        self.default_max_tokens = default_max_tokens
+
+    async def __call__(self, scope, receive, send):
+        kind = ROUTED_PATHS.get(scope["path"]) if scope["type"] == "http" else None
+        if kind is None or scope["method"] != "POST":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        raw_body, receive = await buffer_request_body(receive)
+        try:
+            body = json.loads(raw_body)
+            cost = await run_in_threadpool(
+                estimate_cost, self.tokenizer, kind, body, self.n_ctx, self.default_max_tokens
+            )
+        except Exception:
+            # Некорректное тело отклонит обработчик llama_cpp
+            await self.app(scope, receive, send)
+            return
+
+        router = self.router
+        lane = router.lane_for(cost)
+        wait = await router.acquire(cost, lane)
+        state = scope.setdefault("state", {})
+        state["queue_wait"] = state.get("queue_wait", 0.0) + wait
+        headers = [
+            (b"x-router-lane", lane.encode("latin-1")),
+            (b"x-router-cost", str(cost).encode("latin-1")),
+            (b"x-router-wait-ms", f"{wait * 1000:.1f}".encode("latin-1")),
+        ]
+
+        async def send_with_lane(message):
+            if message["type"] == "http.response.start":
+                message = dict(message)
+                message["headers"] = list(message.get("headers", [])) + headers
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_lane)
+        finally:
+            router.release(lane)
+            router.observe(lane, wait, time.perf_counter() - started)
+
+
+def install_token_router(
+    app: FastAPI,
+    llama: llama_cpp.Llama,
+    slots: int,
+    policy: str,
+    long_tokens: int,
+    long_slots: int,
+    max_wait: float,
+    default_max_tokens: int,
+) -> TokenBudgetRouter:
+    """Подключает маршрутизатор по стоимости в токенах и маршрут статистики"""
+    router = TokenBudgetRouter(slots, policy, long_tokens, long_slots, max_wait)
+    tokenizer = CachedTokenizer(llama)
+    app.add_middleware(
+        TokenRouterMiddleware,
+        router=router,
+        tokenizer=tokenizer,
+        default_max_tokens=default_max_tokens,
+    )
+
+    stats_router = APIRouter()
+
+    @stats_router.get("/extras/router", summary="Token-budget router stats", tags=["Extras"])
+    async def get_router_stats():
+        stats = router.stats()
+        stats["tokenizer_cache"] = {"hits": tokenizer.hits, "misses": tokenizer.misses}
+        return stats
+
+    app.include_router(stats_router)
+    return router